@@ -1,37 +1,75 @@
-from settings import SIZE
+import hashlib
+
+from settings import LOGSIZE, HASH_FUNCTION
+
+# returns (digest function, bits it gives)
+def make_digest(name):
+    if name == 'xxhash':
+        # optional, only needed if we ask for it
+        import xxhash
+        return xxhash.xxh3_128_digest, 128
+    hash = getattr(hashlib, name)
+    return (lambda data: hash(data).digest()), hash().digest_size * 8
+
+digest, DIGEST_BITS = make_digest(HASH_FUNCTION)
+if LOGSIZE > DIGEST_BITS:
+    raise ValueError("LOGSIZE = %s but %s only gives %s bits" % (LOGSIZE, HASH_FUNCTION, DIGEST_BITS))
+
+# Id of a key (str or bytes) on the ring. Unlike the builtin hash() of a str,
+# which is salted per process, every process agrees on it.
+def ring_hash(key):
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    # the top LOGSIZE bits of the digest
+    return int.from_bytes(digest(key), "big") >> (DIGEST_BITS - LOGSIZE)
 
 # Helper function to determine if a key falls within a range
 def inrange(c, a, b):
 	# is c in [a,b)?, if a == b then it assumes a full circle
 	# on the DHT, so it returns True.
-	a = a % SIZE
-	b = b % SIZE
-	c = c % SIZE
+	# ids are already reduced (node.id(offset) is), c in [0, SIZE) and a, b
+	# in [0, SIZE] give the right answer without any modulo (SIZE == 0)
 	if a < b:
-		return a <= c and c < b
+		return a <= c < b
 	return a <= c or c < b
 
+# ip, port and virtual node: a process can host many nodes on the same
+# socket, each with its own id (see vnodes.py). Virtual node 0 is the plain
+# node every process has.
 class Address(object):
-    def __init__(self, ip, port):
+    __slots__ = ('ip', 'port', 'vnode', 'id_')
+
+    def __init__(self, ip, port, vnode = 0):
         self.ip = ip
         self.port = int(port)
+        self.vnode = int(vnode)
+        # our id on the ring, hashing is not cheap so we do it once
+        if self.vnode:
+            self.id_ = ring_hash(f"{self.ip}:{self.port}#{self.vnode}")
+        else:
+            self.id_ = ring_hash(f"{self.ip}:{self.port}")
 
     def __hash__(self):
         # Hash value within DHT ring size
-        return hash(f"{self.ip}:{self.port}") % SIZE
+        return self.id_
+
+    def as_tuple(self):
+        # as found on the wire
+        return (self.ip, self.port, self.vnode)
 
     # Needed for set() and sorted()
     def __eq__(self, other):
         if not isinstance(other, Address):
             return False
-        return (self.ip, self.port) == (other.ip, other.port)
+        return (self.ip, self.port, self.vnode) == (other.ip, other.port, other.vnode)
 
     def __lt__(self, other):
         # Defines < operator so sorted() works
         if not isinstance(other, Address):
             return NotImplemented
-        return (self.ip, self.port) < (other.ip, other.port)
+        return (self.ip, self.port, self.vnode) < (other.ip, other.port, other.vnode)
 
     def __str__(self):
+        if self.vnode:
+            return f'["{self.ip}", {self.port}, {self.vnode}]'
         return f'["{self.ip}", {self.port}]'
-
@@ -0,0 +1,472 @@
+#!/bin/python
+import sys
+import socket
+import random
+import asyncio
+import traceback
+import collections
+
+from address import Address, inrange
+from async_remote import READ_LIMIT, to_remote
+from settings import *
+from network import *
+from logger import Logger
+from cache import LookupCache
+from liveness import detector
+
+# asyncio counterpart of chord.Local. Every node is a handful of tasks on
+# the event loop instead of four threads, so a single process can host
+# hundreds of them. It speaks the same protocol as Local, so both kinds of
+# nodes can live on the same ring.
+
+async def retry_on_socket_error(retry_limit, func):
+	retry_count = 0
+	while retry_count < retry_limit:
+		try:
+			return await func()
+		except socket.error:
+			# exp retry time
+			await asyncio.sleep(2 ** retry_count)
+			retry_count += 1
+	raise RetryLimitReached(func.__name__)
+
+class RetryLimitReached(Exception):
+	pass
+
+# class representing a local peer running on an event loop
+class AsyncLocal(object):
+	def __init__(self, local_address, remote_address = None):
+		self.address_ = local_address
+		print("self id = %s" % self.id())
+		self.logger_ = Logger(str(self.id()), LOG_FILE.format(
+			ip = local_address.ip, port = local_address.port, vnode = local_address.vnode, id = self.id()))
+		# owners of the keys we looked up lately
+		self.lookup_cache_ = LookupCache()
+		self.shutdown_ = False
+		# list of successors
+		self.successors_ = []
+		self.finger_ = [None for x in range(LOGSIZE)]
+		self.predecessor_ = None
+		self.remote_address_ = remote_address
+		# maintenance tasks, we don't have them until we start
+		self.tasks_ = {}
+		# writers of the connections being served
+		self.connections_ = set()
+		self.server_ = None
+		self.closed_ = asyncio.Event()
+		# initially no commands
+		self.command_ = []
+		# per command: requests being handled and total served
+		self.active_ = collections.Counter()
+		self.served_ = collections.Counter()
+
+	# is this id within our range?
+	def is_ours(self, id):
+		assert id >= 0 and id < SIZE
+		return inrange(id, self.predecessor_.id(1), self.id(1))
+
+	def shutdown(self):
+		if self.shutdown_:
+			return
+		self.shutdown_ = True
+		for task in self.tasks_.values():
+			task.cancel()
+		if self.server_:
+			self.server_.close()
+		# peers holding keep-alive connections to us must notice we are gone
+		for writer in list(self.connections_):
+			writer.close()
+		self.closed_.set()
+		self.logger_.info("execution terminated")
+
+	async def wait_closed(self):
+		await self.closed_.wait()
+
+	async def start(self):
+		self.server_ = await asyncio.start_server(self.serve_connection,
+			self.address_.ip, self.address_.port, backlog = LISTEN_BACKLOG, limit = READ_LIMIT)
+		await self.join(self.remote_address_)
+		# start the maintenance tasks
+		self.tasks_['stabilize'] = asyncio.ensure_future(
+			self.repeat(STABILIZE_INT, self.stabilize, STABILIZE_RET))
+		self.tasks_['fix_fingers'] = asyncio.ensure_future(
+			self.repeat(FIX_FINGERS_INT, self.fix_fingers))
+		self.tasks_['update_successors'] = asyncio.ensure_future(
+			self.repeat(UPDATE_SUCCESSORS_INT, self.update_successors, UPDATE_SUCCESSORS_RET))
+		self.logger_.info("started")
+
+	async def repeat(self, sleep_time, func, retry_limit = None):
+		try:
+			while 1:
+				await asyncio.sleep(sleep_time)
+				if self.shutdown_:
+					return
+				if retry_limit is None:
+					try:
+						await func()
+					except socket.error:
+						# we will have another go on the next round
+						pass
+				else:
+					await retry_on_socket_error(retry_limit, func)
+		except RetryLimitReached as e:
+			print("Retry count limit reached, aborting.. (%s)" % e)
+			self.shutdown()
+		except Exception:
+			# same as a dying Local daemon, at least let us know about it
+			traceback.print_exc()
+
+	async def ping(self):
+		return True
+
+	async def alive(self):
+		return True
+
+	async def join(self, remote_address = None):
+		if remote_address:
+			remote = to_remote(remote_address.as_tuple())
+			self.finger_[0] = await remote.find_successor(self.id())
+		else:
+			self.finger_[0] = self
+
+		self.logger_.info("joined")
+
+	async def stabilize(self):
+		self.logger_.debug("stabilize")
+		suc = await self.successor()
+		# same rules as Local.stabilize
+		if suc.id() != self.finger_[0].id():
+			self.finger_[0] = suc
+		x = self.predecessor() if suc is self else await suc.predecessor()
+		if x != None and \
+		   inrange(x.id(), self.id(1), suc.id()) and \
+		   self.id(1) != suc.id() and \
+		   await x.alive():
+			self.finger_[0] = x
+			self.lookup_cache_.invalidate_node(x.id())
+		# We notify our new successor about us
+		await (await self.successor()).notify(self)
+
+	async def notify(self, remote):
+		self.logger_.debug("notify")
+		if self.predecessor() == None or \
+		   inrange(remote.id(), self.predecessor().id(1), self.id()) or \
+		   not await self.predecessor().alive():
+			self.predecessor_ = remote
+			self.lookup_cache_.invalidate_node(remote.id())
+
+	async def fix_fingers(self):
+		# Randomly select an entry in finger_ table and update its value
+		self.logger_.debug("fix_fingers")
+		# fingers starting before our successor are our successor, see
+		# Local.fix_fingers
+		suc = await self.successor()
+		first = 1
+		while first < LOGSIZE and inrange(self.id(1<<first), self.id(1), suc.id(1)):
+			self.finger_[first] = suc
+			first += 1
+		if first == LOGSIZE:
+			return
+		i = random.randrange(first, LOGSIZE)
+		# the cache is no good here, we want to know what the ring looks like now
+		self.finger_[i] = (await self.route(self.id(1<<i)))[0]
+
+	async def update_successors(self):
+		self.logger_.debug("update successor")
+		suc = await self.successor()
+		# if we are not alone in the ring, calculate
+		if suc.id() != self.id():
+			successors = [suc]
+			suc_list = await suc.get_successors()
+			if suc_list and len(suc_list):
+				successors += suc_list
+			# if everything worked, we update
+			self.successors_ = successors
+
+	def get_successors(self):
+		self.logger_.debug("get_successors")
+		return [node.address_.as_tuple() for node in self.successors_[:N_SUCCESSORS-1]]
+
+	def id(self, offset = 0):
+		if not offset:
+			return self.address_.id_
+		return (self.address_.id_ + offset) % SIZE
+
+	async def successor(self):
+		for remote in [self.finger_[0]] + self.successors_:
+			if await remote.alive():
+				self.finger_[0] = remote
+				return remote
+		# unlike Local we can't exit the process, there may be other nodes
+		# living on it
+		print("No successor available, aborting")
+		self.shutdown()
+		raise ConnectionError("no successor available")
+
+	def predecessor(self):
+		return self.predecessor_
+
+	async def find_successor(self, id, recursive = None):
+		# same as Local.find_successor
+		owner = self.lookup_cache_.get(id)
+		if owner is not None:
+			if await owner.alive():
+				return owner
+			self.lookup_cache_.invalidate_owner(owner.address_)
+		owner, hops, start = await self.route(id, recursive)
+		if owner is not self:
+			self.lookup_cache_.put(start, owner)
+		return owner
+
+	def invalidate_lookup(self, id):
+		self.lookup_cache_.invalidate(id)
+
+	async def route(self, id, recursive = None):
+		# same as Local.route
+		self.logger_.debug("find_successor")
+		if self.predecessor() and \
+		   inrange(id, self.predecessor().id(1), self.id(1)):
+			return self, 0, self.predecessor().id()
+		if RECURSIVE_LOOKUP if recursive is None else recursive:
+			return await self.find_successor_recursive(id, 0)
+		node, hops = await self.trace_predecessor(id)
+		return await node.successor(), hops, node.id()
+
+	async def find_successors_batch(self, ids):
+		# same as Local.find_successors_batch, the groups are sent
+		# concurrently
+		self.logger_.debug("find_successors_batch")
+		result = {}
+		groups = {}
+		suc = await self.successor()
+		for id in dict.fromkeys(ids):
+			if self.predecessor() and \
+			   inrange(id, self.predecessor().id(1), self.id(1)):
+				result[id] = self
+			elif suc.id() == self.id() or inrange(id, self.id(1), suc.id(1)):
+				result[id] = suc
+			else:
+				owner = self.lookup_cache_.get(id)
+				if owner is not None and await owner.alive():
+					result[id] = owner
+					continue
+				node = await self.closest_preceding_finger(id)
+				if node is self:
+					result[id] = suc
+					continue
+				key = node.address_.as_tuple()
+				groups.setdefault(key, (node, []))[1].append(id)
+		for successors in await asyncio.gather(
+				*[node.find_successors_batch(group) for node, group in groups.values()]):
+			result.update(successors)
+		return result
+
+	async def find_predecessor(self, id):
+		return (await self.trace_predecessor(id))[0]
+
+	async def trace_predecessor(self, id):
+		self.logger_.debug("find_predecessor")
+		node = self
+		hops = 0
+		# If we are alone in the ring, we are the pred(id)
+		if (await node.successor()).id() == node.id():
+			return node, hops
+		while not inrange(id, node.id(1), (await node.successor()).id(1)):
+			node = await node.closest_preceding_finger(id)
+			hops += 1
+		return node, hops
+
+	async def find_successor_recursive(self, id, hops):
+		# same as Local.find_successor_recursive
+		self.logger_.debug("find_successor_recursive")
+		if self.predecessor() and \
+		   inrange(id, self.predecessor().id(1), self.id(1)):
+			return self, hops, self.predecessor().id()
+		suc = await self.successor()
+		if suc.id() == self.id() or inrange(id, self.id(1), suc.id(1)):
+			return suc, hops, self.id()
+		node = await self.closest_preceding_finger(id)
+		if node is self:
+			return suc, hops, (id - 1) % SIZE
+		return await node.find_successor_recursive(id, hops + 1)
+
+	async def closest_preceding_finger(self, id):
+		self.logger_.debug("closest_preceding_finger")
+		for remote in reversed(self.successors_ + self.finger_):
+			if remote != None and inrange(remote.id(), self.id(1), id) and await remote.alive():
+				return remote
+		return self
+
+	async def serve_connection(self, reader, writer):
+		# requests on a connection are handled concurrently. Binary replies
+		# carry the id of their request and go out as soon as they are ready,
+		# text replies go out in order
+		self.connections_.add(writer)
+		replies = asyncio.Queue()
+		replier = None
+		handling = set()
+		try:
+			# binary clients start with MAGIC, anything else speaks text
+			first = await asyncio.wait_for(reader.readexactly(1), CONN_IDLE_TIMEOUT)
+			binary = first == MAGIC[:1]
+			if binary:
+				if first + await reader.readexactly(len(MAGIC) - 1) != MAGIC:
+					return
+				writer.write(MAGIC)
+			else:
+				replier = asyncio.ensure_future(self.write_replies(writer, replies))
+			while not self.shutdown_:
+				if binary:
+					header = await asyncio.wait_for(reader.readexactly(HEADER.size), CONN_IDLE_TIMEOUT)
+					length, request_id, opcode, vnode = HEADER.unpack(header)
+					command, request = decode_request(opcode, await reader.readexactly(length))
+					if vnode != self.address_.vnode:
+						# we don't host virtual nodes, see vnodes.py
+						error = ("no virtual node %s" % vnode).encode("utf-8")
+						writer.write(HEADER.pack(len(error), request_id, OP_ERROR, 0) + error)
+						continue
+					task = asyncio.ensure_future(self.reply(writer, request_id, command, request))
+					handling.add(task)
+					task.add_done_callback(handling.discard)
+				else:
+					# the first byte may be the CR of an empty request (a ping)
+					line = await asyncio.wait_for(reader.readuntil(b"\n" if first == b"\r" else b"\r\n"), CONN_IDLE_TIMEOUT)
+					vnode, command, request = decode_text_request((first + line)[:-2].decode("utf-8"))
+					first = b""
+					if vnode != self.address_.vnode:
+						break
+					replies.put_nowait((command, asyncio.ensure_future(self.handle_request(command, request))))
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+				ValueError, KeyError, IndexError, socket.error):
+			pass
+		finally:
+			if replier:
+				replies.put_nowait((None, None))
+				await replier
+			else:
+				# nobody is going to get the rest of the replies
+				for task in handling:
+					task.cancel()
+				writer.close()
+			self.connections_.discard(writer)
+
+	async def reply(self, writer, request_id, command, request):
+		try:
+			result = await self.handle_request(command, request)
+			opcode, _, kind = command_kinds(command)
+			body = encode(kind, result)
+			# a single write, frames of different replies can't get mixed
+			writer.write(HEADER.pack(len(body), request_id, opcode, 0) + body)
+			await writer.drain()
+			if command == 'shutdown':
+				self.shutdown()
+		except socket.error:
+			writer.close()
+		except Exception:
+			traceback.print_exc()
+			writer.close()
+
+	async def write_replies(self, writer, replies):
+		try:
+			while 1:
+				command, task = await replies.get()
+				if task is None:
+					break
+				result = await task
+				writer.write(encode_text_reply(command, result).encode("utf-8") + b"\r\n")
+				await writer.drain()
+				if command == 'shutdown':
+					self.shutdown()
+		except socket.error:
+			pass
+		except Exception:
+			traceback.print_exc()
+		finally:
+			writer.close()
+			# nobody is going to get the rest of the replies
+			while not replies.empty():
+				command, task = replies.get_nowait()
+				if task is not None:
+					task.cancel()
+
+	async def handle_request(self, command, request):
+		self.active_[command] += 1
+		try:
+			return await self.dispatch(command, request)
+		finally:
+			self.active_[command] -= 1
+			self.served_[command] += 1
+
+	async def dispatch(self, command, request):
+		# arguments and replies are plain values, see network.py
+		result = None
+		if command == 'get_successor':
+			successor = await self.successor()
+			result = successor.address_.as_tuple()
+		if command == 'get_predecessor':
+			# we can only reply if we have a predecessor
+			if self.predecessor_ != None:
+				predecessor = self.predecessor_
+				result = predecessor.address_.as_tuple()
+		if command == 'find_successor':
+			successor = await self.find_successor(request)
+			result = successor.address_.as_tuple()
+		if command == 'find_successors_batch':
+			successors = await self.find_successors_batch(request)
+			result = [successors[id].address_.as_tuple() for id in request]
+		if command == 'find_successor_recursive':
+			successor, hops, start = await self.find_successor_recursive(*request)
+			result = (successor.address_.as_tuple(), hops, start)
+		if command == 'closest_preceding_finger':
+			closest = await self.closest_preceding_finger(request)
+			result = closest.address_.as_tuple()
+		if command == 'notify':
+			npredecessor = to_remote(request)
+			# it just talked to us
+			detector.alive(npredecessor.address_)
+			await self.notify(npredecessor)
+		if command == 'get_successors':
+			result = self.get_successors()
+		if command == 'stats':
+			result = self.stats()
+		if command == 'shutdown':
+			self.logger_.info("shutdown started")
+
+		# or it could be a user specified operation, callbacks may be
+		# plain functions or coroutines
+		for t in self.command_:
+			if command == t[0]:
+				result = t[1](request)
+				if asyncio.iscoroutine(result):
+					result = await result
+		return result
+
+	def stats(self):
+		return {'connections': len(self.connections_),
+				'active': dict(+self.active_),
+				'served': dict(self.served_),
+				'liveness': detector.stats(),
+				'lookup_cache': self.lookup_cache_.stats()}
+
+	def register_command(self, cmd, callback):
+		self.command_.append((cmd, callback))
+
+	def unregister_command(self, cmd):
+		self.command_ = [t for t in self.command_ if (True if t[0] != cmd else False)]
+
+# hosts n nodes on consecutive ports in a single process
+async def main(port, n, remote_address = None):
+	nodes = []
+	for i in range(n):
+		local = AsyncLocal(Address("127.0.0.1", port + i), remote_address)
+		await local.start()
+		remote_address = remote_address or local.address_
+		nodes.append(local)
+	await asyncio.gather(*[local.wait_closed() for local in nodes])
+
+if __name__ == "__main__":
+	# usage: python async_chord.py <first port> [<n nodes> [<remote port>]]
+	port = int(sys.argv[1])
+	n = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	remote_address = Address("127.0.0.1", sys.argv[3]) if len(sys.argv) > 3 else None
+	asyncio.run(main(port, n, remote_address))
@@ -0,0 +1,363 @@
+import time
+import socket
+import struct
+import asyncio
+import weakref
+import collections
+
+from address import Address
+from settings import SIZE, POOL_MAX_PEERS, POOL_MAX_IDLE, POOL_IDLE_TIMEOUT, RPC_TIMEOUT, WIRE_PROTOCOL
+from network import *
+from liveness import detector, ALIVE, UNKNOWN
+
+# biggest reply we accept on a single line (text protocol)
+READ_LIMIT = 1 << 24
+
+# a keep-alive connection to a peer speaking the text protocol, replies
+# come back in order so it is used by one RPC at a time
+class AsyncConnection(object):
+    def __init__(self, reader, writer):
+        self.reader_ = reader
+        self.writer_ = writer
+
+    @classmethod
+    async def open(cls, address, timeout = RPC_TIMEOUT):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address.ip, address.port, limit = READ_LIMIT), timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out connecting to %s" % address)
+        return cls(reader, writer)
+
+    async def request(self, command, value = None, timeout = RPC_TIMEOUT, vnode = 0):
+        try:
+            return await asyncio.wait_for(self.exchange(command, value, vnode), timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("no reply to '%s'" % command)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise ConnectionError("connection closed by peer")
+
+    async def exchange(self, command, value, vnode):
+        self.writer_.write(encode_text_request(command, value, vnode).encode("utf-8") + b"\r\n")
+        await self.writer_.drain()
+        line = await self.reader_.readuntil(b"\r\n")
+        return decode_text_reply(command, line[:-2].decode("utf-8"))
+
+    def close(self):
+        self.writer_.close()
+
+# a keep-alive connection to a peer speaking the binary protocol, shared by
+# every coroutine talking to that peer. Replies are matched to requests by
+# id, so a request waiting on a slow one (say a find_successor that calls
+# back into us) doesn't end up waiting on itself.
+class AsyncChannel(object):
+    def __init__(self, address, reader, writer):
+        self.address_ = address
+        self.reader_ = reader
+        self.writer_ = writer
+        # request id -> (future, reply kind)
+        self.waiting_ = {}
+        self.next_id_ = 0
+        self.closed_ = False
+        self.last_used_ = time.time()
+        self.task_ = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, address, timeout = RPC_TIMEOUT):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address.ip, address.port, limit = READ_LIMIT), timeout)
+            writer.write(MAGIC)
+            try:
+                if await asyncio.wait_for(reader.readexactly(len(MAGIC)), timeout) != MAGIC:
+                    raise ConnectionError("%s doesn't speak the binary protocol" % address)
+            except BaseException:
+                writer.close()
+                raise
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out connecting to %s" % address)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("connection closed by peer")
+        return cls(address, reader, writer)
+
+    async def request(self, command, value = None, timeout = RPC_TIMEOUT, vnode = 0):
+        if self.closed_:
+            raise ConnectionError("connection to %s is closed" % self.address_)
+        opcode, body = encode_request(command, value)
+        request_id = self.next_id_
+        self.next_id_ = (self.next_id_ + 1) & 0xffffffff
+        future = asyncio.get_event_loop().create_future()
+        self.waiting_[request_id] = (future, command_kinds(command)[2])
+        self.last_used_ = time.time()
+        try:
+            # write() never blocks, so frames of different requests can't be
+            # mixed up on the wire
+            self.writer_.write(HEADER.pack(len(body), request_id, opcode, vnode) + body)
+            await asyncio.wait_for(self.writer_.drain(), timeout)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # the reply may still come, it will just be thrown away
+            raise socket.timeout("no reply to '%s' from %s" % (command, self.address_))
+        finally:
+            self.waiting_.pop(request_id, None)
+
+    async def read_replies(self):
+        try:
+            while True:
+                length, request_id, opcode, _ = HEADER.unpack(await self.reader_.readexactly(HEADER.size))
+                body = await self.reader_.readexactly(length)
+                future, kind = self.waiting_.pop(request_id, (None, None))
+                if future is None or future.done():
+                    continue
+                if opcode == OP_ERROR:
+                    future.set_exception(RemoteError(str(body, "utf-8")))
+                    continue
+                try:
+                    future.set_result(decode(kind, body))
+                except (ValueError, KeyError, IndexError, struct.error) as e:
+                    future.set_exception(ConnectionError("bad reply: %s" % e))
+        except asyncio.CancelledError:
+            self.fail(ConnectionError("connection to %s closed" % self.address_))
+            raise
+        except (asyncio.IncompleteReadError, socket.error):
+            self.fail(ConnectionError("connection closed by peer"))
+
+    def in_flight(self):
+        return len(self.waiting_)
+
+    def fail(self, error):
+        """Closes the channel, every request waiting on it gets error"""
+        self.closed_ = True
+        waiting = list(self.waiting_.values())
+        self.waiting_.clear()
+        for future, _ in waiting:
+            if not future.done():
+                future.set_exception(error)
+        self.writer_.close()
+
+    def close(self):
+        if not self.closed_:
+            self.task_.cancel()
+            self.fail(ConnectionError("connection to %s closed" % self.address_))
+
+# asyncio counterpart of remote.ConnectionPool
+class AsyncConnectionPool(object):
+    def __init__(self, max_peers = POOL_MAX_PEERS, max_idle = POOL_MAX_IDLE,
+                 idle_timeout = POOL_IDLE_TIMEOUT):
+        self.max_peers_ = max_peers
+        self.max_idle_ = max_idle
+        self.idle_timeout_ = idle_timeout
+        # (ip, port) -> [(connection, last time used)], least recently used peer first
+        self.idle_ = collections.OrderedDict()
+
+    async def acquire(self, address, timeout = RPC_TIMEOUT):
+        """Returns (connection, reused)"""
+        now = time.time()
+        conns = self.idle_.get((address.ip, address.port), [])
+        while conns:
+            conn, last_used = conns.pop()
+            if now - last_used < self.idle_timeout_:
+                return conn, True
+            conn.close()
+        return await AsyncConnection.open(address, timeout), False
+
+    def release(self, address, conn):
+        key = (address.ip, address.port)
+        conns = self.idle_.setdefault(key, [])
+        self.idle_.move_to_end(key)
+        if len(conns) < self.max_idle_:
+            conns.append((conn, time.time()))
+        else:
+            conn.close()
+        # bound the number of peers we keep connections to
+        while len(self.idle_) > self.max_peers_:
+            _, conns = self.idle_.popitem(last = False)
+            for conn, _ in conns:
+                conn.close()
+
+    def failed(self, address, conn, error):
+        # also on cancellation, a late reply would be taken for the answer
+        # to the next request
+        conn.close()
+        if isinstance(error, socket.error):
+            self.evict(address)
+
+    def evict(self, address):
+        for conn, _ in self.idle_.pop((address.ip, address.port), []):
+            conn.close()
+
+    def clear(self):
+        for conns in self.idle_.values():
+            for conn, _ in conns:
+                conn.close()
+        self.idle_.clear()
+
+# asyncio counterpart of remote.ChannelPool
+class AsyncChannelPool(object):
+    def __init__(self, max_peers = POOL_MAX_PEERS, idle_timeout = POOL_IDLE_TIMEOUT):
+        self.max_peers_ = max_peers
+        self.idle_timeout_ = idle_timeout
+        # (ip, port) -> channel, least recently used peer first
+        self.channels_ = collections.OrderedDict()
+        # (ip, port) -> future of a channel being opened
+        self.opening_ = {}
+
+    async def acquire(self, address, timeout = RPC_TIMEOUT):
+        """Returns (channel, reused)"""
+        key = (address.ip, address.port)
+        channel = self.channels_.get(key)
+        if channel and not channel.closed_ and \
+           (channel.in_flight() or time.time() - channel.last_used_ < self.idle_timeout_):
+            self.channels_.move_to_end(key)
+            return channel, True
+        if channel:
+            del self.channels_[key]
+            channel.close()
+        # coroutines asking for the same peer at the same time share one
+        # connection attempt
+        if key in self.opening_:
+            return await asyncio.shield(self.opening_[key]), False
+        opening = asyncio.ensure_future(AsyncChannel.open(address, timeout))
+        self.opening_[key] = opening
+        try:
+            channel = await asyncio.shield(opening)
+        finally:
+            del self.opening_[key]
+        self.channels_[key] = channel
+        # bound the number of peers we keep connections to, channels with
+        # requests in flight are left alone
+        for other in list(self.channels_):
+            if len(self.channels_) <= self.max_peers_:
+                break
+            if not self.channels_[other].in_flight():
+                self.channels_.pop(other).close()
+        return channel, False
+
+    def release(self, address, channel):
+        pass
+
+    def failed(self, address, channel, error):
+        # a late reply is matched by id and thrown away, so neither a timeout
+        # nor a cancellation (nor an error reply) makes the channel useless
+        if not isinstance(error, socket.error) or isinstance(error, (socket.timeout, RemoteError)):
+            return
+        channel.close()
+        key = (address.ip, address.port)
+        if self.channels_.get(key) is channel:
+            del self.channels_[key]
+
+    def evict(self, address):
+        channel = self.channels_.pop((address.ip, address.port), None)
+        if channel:
+            channel.close()
+
+    def clear(self):
+        for channel in self.channels_.values():
+            channel.close()
+        self.channels_.clear()
+
+# shared by every AsyncRemote in the process
+pool = AsyncChannelPool() if WIRE_PROTOCOL == 'binary' else AsyncConnectionPool()
+
+# (ip, port, virtual node) -> AsyncRemote, same as remote.registry
+registry = weakref.WeakValueDictionary()
+
+def to_remote(address):
+    if address is None:
+        return None
+    address = endpoint(address)
+    remote = registry.get(address)
+    if remote is None:
+        remote = registry[address] = AsyncRemote(Address(*address))
+    return remote
+
+# asyncio counterpart of Remote, every RPC is a coroutine with a timeout
+# and can be cancelled. Many of them can be in flight to the same peer.
+class AsyncRemote(object):
+    __slots__ = ('address_', 'id_', '__weakref__')
+
+    def __init__(self, remote_address):
+        self.address_ = remote_address
+        self.id_ = remote_address.id_
+
+    def __str__(self):
+        return f"AsyncRemote {self.address_}"
+
+    def id(self, offset=0):
+        if not offset:
+            return self.id_
+        return (self.id_ + offset) % SIZE
+
+    async def call(self, command, value = None, timeout = RPC_TIMEOUT):
+        while True:
+            try:
+                conn, reused = await pool.acquire(self.address_, timeout)
+            except socket.error:
+                detector.failed(self.address_)
+                raise
+            try:
+                response = await conn.request(command, value, timeout, self.address_.vnode)
+            except BaseException as e:
+                pool.failed(self.address_, conn, e)
+                # a pooled connection may have been closed on the other end
+                # while idle, in that case try again with a fresh one
+                if reused and isinstance(e, socket.error) and not isinstance(e, (socket.timeout, RemoteError)):
+                    continue
+                if isinstance(e, socket.error):
+                    detector.failed(self.address_)
+                raise
+            pool.release(self.address_, conn)
+            # every answer tells us the peer is alive
+            detector.alive(self.address_)
+            return response
+
+    async def ping(self, timeout = RPC_TIMEOUT):
+        try:
+            await self.call("", timeout = timeout)
+            return True
+        except socket.error:
+            return False
+
+    async def alive(self, timeout = RPC_TIMEOUT):
+        # same as Remote.alive
+        state = detector.state(self.address_)
+        if state == UNKNOWN:
+            return await self.ping(timeout)
+        return state == ALIVE
+
+    async def command(self, msg, timeout = RPC_TIMEOUT):
+        # commands registered by the upper layers, "name request"
+        command = msg.split(' ')[0]
+        return await self.call(command, msg[len(command) + 1:], timeout)
+
+    async def get_successors(self, timeout = RPC_TIMEOUT):
+        return [to_remote(address) for address in await self.call("get_successors", timeout = timeout)]
+
+    async def successor(self, timeout = RPC_TIMEOUT):
+        return to_remote(await self.call("get_successor", timeout = timeout))
+
+    async def predecessor(self, timeout = RPC_TIMEOUT):
+        return to_remote(await self.call("get_predecessor", timeout = timeout))
+
+    async def find_successor(self, id, timeout = RPC_TIMEOUT):
+        return to_remote(await self.call("find_successor", id, timeout))
+
+    async def find_successors_batch(self, ids, timeout = RPC_TIMEOUT):
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return {}
+        addresses = await self.call("find_successors_batch", ids, timeout)
+        return dict(zip(ids, [to_remote(address) for address in addresses]))
+
+    async def find_successor_recursive(self, id, hops = 0, timeout = RPC_TIMEOUT):
+        address, hops, start = await self.call("find_successor_recursive", (id, hops), timeout)
+        return to_remote(address), hops, start
+
+    async def closest_preceding_finger(self, id, timeout = RPC_TIMEOUT):
+        return to_remote(await self.call("closest_preceding_finger", id, timeout))
+
+    async def notify(self, node, timeout = RPC_TIMEOUT):
+        await self.call("notify", node.address_.as_tuple(), timeout)
+
+    async def stats(self, timeout = RPC_TIMEOUT):
+        return await self.call("stats", timeout = timeout)
@@ -0,0 +1,109 @@
+#!/bin/python
+import sys
+import json
+import time
+import socket
+import threading
+
+from address import Address, inrange
+from vnodes import Host, MAX_VNODES
+from dht import DFS
+from settings import SIZE, STABILIZE_INT, LOAD_BALANCE_INT, LOAD_IMBALANCE, LOAD_MIN_RATE
+
+# Adaptive load balancing, after Felber et al. (ICCCN-06): a node getting
+# many more requests than its successor gives it the top of its range,
+# until both get about the same. Ids are hashes, we can't just pick one,
+# so a Host moves one of its virtual nodes instead: it starts another one
+# whose id falls about where the range should end, hands it the bottom of
+# the range, and lets the old one leave (the top goes to the successor).
+# A Host has MAX_VNODES ids to choose from, spread all over the ring.
+class Balancer(object):
+    def __init__(self, host, interval = LOAD_BALANCE_INT, imbalance = LOAD_IMBALANCE,
+                 min_rate = LOAD_MIN_RATE):
+        # the Host must have put a DFS on each of its virtual nodes
+        self.host_ = host
+        self.interval_ = interval
+        self.imbalance_ = imbalance
+        self.min_rate_ = min_rate
+        self.moves_ = 0
+        self.shutdown_ = False
+
+    def start(self):
+        self.thread_ = threading.Thread(target = self.run)
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def shutdown(self):
+        self.shutdown_ = True
+
+    def run(self):
+        while not self.shutdown_:
+            time.sleep(self.interval_)
+            try:
+                self.balance()
+            except socket.error:
+                # the ring is changing, we will have another look later
+                pass
+
+    def balance(self):
+        """One round, moves at most one virtual node, True if it did"""
+        for vnode, dfs in list(self.host_.layers_.items()):
+            index = self.plan(dfs)
+            if index is not None:
+                self.move(vnode, index)
+                return True
+        return False
+
+    def plan(self, dfs):
+        # virtual node to move dfs's node to, None if it is fine where it is
+        local = dfs.local_
+        predecessor = local.predecessor()
+        successor = local.successor()
+        if predecessor is None or predecessor.id() == local.id() or successor is local:
+            return None
+        ours = dfs.load_.rate(predecessor.id(), local.id())
+        if ours < self.min_rate_:
+            return None
+        theirs = json.loads(successor.command("load"))['rate']
+        if ours < self.imbalance_ * theirs:
+            return None
+        # we want to keep (predecessor, split], the rest evens us out
+        split = dfs.load_.split(predecessor.id(), local.id(), (ours - theirs) / 2)
+        best = None
+        for index in range(MAX_VNODES):
+            if index in self.host_.nodes_:
+                continue
+            id = Address(self.host_.ip_, self.host_.port_, index).id_
+            if not inrange(id, predecessor.id(1), local.id()):
+                continue
+            distance = min((id - split) % SIZE, (split - id) % SIZE)
+            if best is None or distance < best[0]:
+                best = (distance, index)
+        return best[1] if best else None
+
+    def move(self, vnode, index):
+        host = self.host_
+        with host.mutex_:
+            new = host.add(index)
+            # the new node takes the bottom of our range as soon as the ring
+            # sends its requests there (see DFS.join)
+            deadline = time.time() + 10 * STABILIZE_INT
+            host.layers_[index].joined_.wait(10 * STABILIZE_INT)
+            # and we wait until it knows who comes after us
+            while time.time() < deadline and len(new.successors_) < 2:
+                time.sleep(STABILIZE_INT / 4)
+            # the top goes to our successor
+            host.remove(vnode)
+            self.moves_ += 1
+
+    def stats(self):
+        return {'moves': self.moves_,
+                'load': dict((vnode, dfs.load_.stats()) for vnode, dfs in list(self.host_.layers_.items()))}
+
+if __name__ == "__main__":
+    # usage: python balance.py <port> <k> [<remote port>], a DFS host that
+    # balances its load
+    remote_address = Address("127.0.0.1", sys.argv[3]) if len(sys.argv) > 3 else None
+    host = Host("127.0.0.1", sys.argv[1], remote_address, int(sys.argv[2]), attach = DFS)
+    host.start()
+    Balancer(host).start()
@@ -0,0 +1,355 @@
+import errno
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from settings import BLOCK_CACHE_SIZE, READ_AHEAD, PARALLEL_REQUESTS
+
+# Blocks of the files a client (say FUSEDFS) is using, so reads and writes
+# of a few bytes don't cost a DHT request each. Writes stay here (dirty)
+# until the file is flushed (fsync, release) or they are evicted, then go
+# to the DFS a run of blocks at a time, the runs in parallel. A block we
+# changed only part of is merged with what the DFS has then (DFS.update,
+# a compare and swap), so we don't undo what others wrote in the rest of
+# it since we read it. The blocks a
+# read misses are fetched at once (the DFS asks their owners in parallel),
+# sequential reads fetch READ_AHEAD blocks more in the background. Clean
+# blocks are dropped when the file is opened again, somebody else may have
+# changed it (close to open consistency, like NFS).
+#
+# We don't hold the lock while we wait for the DFS, reads and writes of
+# other files go on meanwhile.
+class BlockCache(object):
+    def __init__(self, dfs, size = BLOCK_CACHE_SIZE, read_ahead = READ_AHEAD):
+        self.dfs_ = dfs
+        self.block_size_ = dfs.block_size_
+        self.size_ = size
+        self.read_ahead_ = read_ahead
+        self.mutex_ = threading.RLock()
+        # read ahead and write back runs, the DFS caps the requests they
+        # have in flight
+        self.pool_ = ThreadPoolExecutor(max_workers = PARALLEL_REQUESTS)
+        # (path, block) -> bytearray, least recently used first
+        self.blocks_ = collections.OrderedDict()
+        self.bytes_ = 0
+        # path -> blocks of it we have, and those we changed
+        self.files_ = {}
+        self.dirty_ = {}
+        # (path, block) being written back, they stay until we know how
+        # it went
+        self.writing_ = set()
+        # (path, block) -> [[start, end], ...] bytes of it we changed
+        self.ranges_ = {}
+        # path -> its size counting what we haven't written back
+        self.sizes_ = {}
+        # path -> where the last read ended, to notice sequential reads
+        self.next_read_ = {}
+        # path -> times we dropped what we had of it, a fetch that started
+        # before may bring old blocks
+        self.generation_ = {}
+        # (path, block) being read ahead -> future of the fetch
+        self.loading_ = {}
+        self.hits_ = 0
+        self.misses_ = 0
+        self.read_ahead_blocks_ = 0
+        self.written_back_ = 0
+
+    def get(self, path, block):
+        data = self.blocks_.get((path, block))
+        if data is not None:
+            self.blocks_.move_to_end((path, block))
+        return data
+
+    def put(self, path, block, data):
+        old = self.blocks_.pop((path, block), None)
+        self.bytes_ += len(data) - (len(old) if old is not None else 0)
+        self.blocks_[(path, block)] = data
+        self.files_.setdefault(path, set()).add(block)
+
+    def drop(self, path, block):
+        data = self.blocks_.pop((path, block))
+        self.bytes_ -= len(data)
+        self.files_[path].discard(block)
+
+    def evict(self, dirty = True):
+        """Makes room, least recently used first (the last block we used
+        stays whatever its size). Call it without the lock: dirty blocks
+        are written back before they go (with dirty, else only clean ones
+        go), those we can't write back stay. False if there were some"""
+        if self.bytes_ <= self.size_:
+            return True
+        victims = {}
+        with self.mutex_:
+            room = self.bytes_
+            for path, block in list(self.blocks_)[:-1]:
+                if room <= self.size_:
+                    break
+                if (path, block) in self.writing_ or \
+                   not dirty and block in self.dirty_.get(path, ()):
+                    continue
+                room -= len(self.blocks_[(path, block)])
+                if block in self.dirty_.get(path, ()):
+                    victims.setdefault(path, []).append(block)
+                else:
+                    self.drop(path, block)
+        evicted = True
+        for path, blocks in victims.items():
+            evicted = self.write_back(path, blocks) and evicted
+            with self.mutex_:
+                # unless they didn't make it, or were written again meanwhile
+                for block in blocks:
+                    if (path, block) in self.blocks_ and (path, block) not in self.writing_ and \
+                       block not in self.dirty_.get(path, ()):
+                        self.drop(path, block)
+        return evicted
+
+    def changed(self, path, block, start, end):
+        # adds [start, end) to the bytes we changed of block
+        ranges = []
+        for first, last in self.ranges_.get((path, block), []):
+            if last < start or first > end:
+                ranges.append([first, last])
+            else:
+                start, end = min(start, first), max(end, last)
+        ranges.append([start, end])
+        self.ranges_[(path, block)] = sorted(ranges)
+
+    def load(self, path, first, count):
+        """Fetches count blocks of path from first, returns {block: data}
+        of those there are (what we changed rather than what the DFS has),
+        None if we couldn't"""
+        with self.mutex_:
+            generation = self.generation_.get(path, 0)
+        data = self.dfs_.fetch(path, count * self.block_size_, first * self.block_size_)
+        if data is None:
+            return None
+        data = memoryview(data)
+        blocks = {}
+        with self.mutex_:
+            current = self.generation_.get(path, 0) == generation
+            for i in range(count):
+                piece = data[i * self.block_size_:(i + 1) * self.block_size_]
+                if not piece:
+                    break
+                # what we changed is newer
+                if first + i in self.dirty_.get(path, ()):
+                    blocks[first + i] = self.get(path, first + i)
+                    continue
+                blocks[first + i] = bytearray(piece)
+                if current:
+                    self.put(path, first + i, blocks[first + i])
+        # readers don't wait for write backs, writers make room for those
+        self.evict(dirty = False)
+        return blocks
+
+    def read_ahead(self, path, first):
+        # fetches the blocks after a sequential read in the background
+        with self.mutex_:
+            blocks = [block for block in range(first, first + self.read_ahead_)
+                      if (path, block) not in self.blocks_ and (path, block) not in self.loading_]
+            if not blocks:
+                return
+            self.read_ahead_blocks_ += len(blocks)
+
+            def load():
+                try:
+                    self.load(path, blocks[0], blocks[-1] - blocks[0] + 1)
+                finally:
+                    with self.mutex_:
+                        for block in blocks:
+                            self.loading_.pop((path, block), None)
+            future = self.pool_.submit(load)
+            for block in blocks:
+                self.loading_[(path, block)] = future
+
+    def read(self, path, size, offset):
+        """Up to size bytes of path from offset, None if it failed"""
+        if size <= 0:
+            return b""
+        first = offset // self.block_size_
+        last = (offset + size - 1) // self.block_size_
+        with self.mutex_:
+            sequential = self.next_read_.get(path) == offset
+            self.next_read_[path] = offset + size
+            blocks = dict((block, self.get(path, block)) for block in range(first, last + 1))
+            # those being read ahead are coming
+            pending = set(self.loading_[(path, block)] for block in blocks
+                          if blocks[block] is None and (path, block) in self.loading_)
+        if pending:
+            wait(pending)
+        with self.mutex_:
+            for block in blocks:
+                if blocks[block] is None:
+                    blocks[block] = self.get(path, block)
+            missing = [block for block in sorted(blocks) if blocks[block] is None]
+            self.hits_ += len(blocks) - len(missing)
+            self.misses_ += len(missing)
+        if missing:
+            # all of them in one go, the DFS asks their owners in parallel
+            loaded = self.load(path, missing[0], missing[-1] - missing[0] + 1)
+            if loaded is None:
+                return None
+            for block in missing:
+                blocks[block] = loaded.get(block)
+        if sequential and self.read_ahead_:
+            self.read_ahead(path, last + 1)
+
+        # in order, up to the end of the file. The DFS fills holes up to
+        # the size it has, we fill those before what we wrote past it
+        result = bytearray()
+        for block in range(first, last + 1):
+            data = blocks[block] or b""
+            start = max(offset - block * self.block_size_, 0)
+            end = min(offset + size - block * self.block_size_, self.block_size_)
+            piece = data[start:end]
+            result += piece
+            if len(piece) < end - start:
+                fill = min(end, self.size(path) - block * self.block_size_) - start - len(piece)
+                if fill > 0:
+                    result += bytes(fill)
+                if len(piece) + max(fill, 0) < end - start:
+                    break
+        return bytes(result)
+
+    def write(self, path, buf, offset):
+        """Writes buf at offset of path (here), returns the bytes written
+        or -errno"""
+        if not buf:
+            return 0
+        first = offset // self.block_size_
+        last = (offset + len(buf) - 1) // self.block_size_
+        # we change part of the first and last blocks, we need the rest
+        # of them
+        with self.mutex_:
+            partial = [block for block in sorted(set([first, last])) if (path, block) not in self.blocks_ and
+                       (block * self.block_size_ < offset or (block + 1) * self.block_size_ > offset + len(buf))]
+        fetched = {}
+        for block in partial:
+            loaded = self.load(path, block, 1)
+            if loaded is None:
+                return -errno.EIO
+            fetched.update(loaded)
+
+        with self.mutex_:
+            written = 0
+            buf = memoryview(buf)
+            while written < len(buf):
+                block, start, end = self.dfs_.get_offsets(offset + written, len(buf) - written)
+                data = self.get(path, block)
+                if data is None:
+                    # nothing there (past the end), or evicted meanwhile
+                    data = fetched.get(block) or bytearray()
+                else:
+                    # put counts it again once it's changed
+                    self.drop(path, block)
+                # fill up with 0x00's before
+                if len(data) < start:
+                    data.extend(bytes(start - len(data)))
+                data[start:end] = buf[written:written + end - start]
+                self.changed(path, block, start, end)
+                self.dirty_.setdefault(path, set()).add(block)
+                self.put(path, block, data)
+                written += end - start
+            self.sizes_[path] = max(self.sizes_.get(path, 0), offset + written)
+        # what we wrote is here, but the cache is full of blocks the DFS
+        # doesn't take
+        return written if self.evict() else -errno.EIO
+
+    def write_back(self, path, blocks = None):
+        """Sends the dirty blocks of path (all of them, or those in blocks)
+        to the DFS, False if some didn't make it"""
+        with self.mutex_:
+            dirty = self.dirty_.get(path, set())
+            blocks = sorted(dirty if blocks is None else set(blocks) & dirty)
+            # writes from now on make them dirty again
+            dirty.difference_update(blocks)
+            self.writing_.update((path, block) for block in blocks)
+            whole, parts = [], []
+            for block in blocks:
+                data = self.blocks_[(path, block)]
+                ranges = self.ranges_.pop((path, block), [[0, len(data)]])
+                if ranges == [[0, len(data)]]:
+                    whole.append(block)
+                else:
+                    parts.append((block, bytes(data), ranges))
+            runs = []
+            while whole:
+                # a run of blocks goes in one store, only the last one may
+                # be short (a short block before another is a hole)
+                run = [whole.pop(0)]
+                while whole and whole[0] == run[-1] + 1 and \
+                      len(self.blocks_[(path, run[-1])]) == self.block_size_:
+                    run.append(whole.pop(0))
+                runs.append((run, b"".join(self.blocks_[(path, block)] for block in run)))
+
+        def store(run, data):
+            return self.dfs_.store(path, data, run[0] * self.block_size_) == len(data)
+
+        def merge(block, data, ranges):
+            def apply(current):
+                current = bytearray(current)
+                for start, end in ranges:
+                    if len(current) < start:
+                        current.extend(bytes(start - len(current)))
+                    current[start:end] = data[start:end]
+                return bytes(current)
+            return self.dfs_.update(path, block * self.block_size_, apply) is not None
+
+        tasks = [(store, run) for run in runs] + [(merge, part) for part in parts]
+        if len(tasks) == 1:
+            stored = [tasks[0][0](*tasks[0][1])]
+        else:
+            stored = [future.result() for future in [self.pool_.submit(call, *args) for call, args in tasks]]
+
+        with self.mutex_:
+            self.writing_.difference_update((path, block) for block in blocks)
+            for (call, args), ok in zip(tasks, stored):
+                blocks = args[0] if call is store else [args[0]]
+                if ok:
+                    self.written_back_ += len(blocks)
+                    continue
+                for block in blocks:
+                    if (path, block) in self.blocks_:
+                        self.dirty_.setdefault(path, set()).add(block)
+                        for start, end in args[2] if call is merge else [[0, len(self.blocks_[(path, block)])]]:
+                            self.changed(path, block, start, end)
+        return all(stored)
+
+    def flush(self, path):
+        """Writes back what we changed of path, 0 or -errno"""
+        if not self.write_back(path):
+            return -errno.EIO
+        with self.mutex_:
+            if not self.dirty_.get(path):
+                self.dirty_.pop(path, None)
+                self.sizes_.pop(path, None)
+        return 0
+
+    def invalidate(self, path):
+        # forget what we didn't change of path, it may be old
+        with self.mutex_:
+            dirty = self.dirty_.get(path, set())
+            for block in list(self.files_.get(path, ())):
+                if block not in dirty and (path, block) not in self.writing_:
+                    self.drop(path, block)
+            self.next_read_.pop(path, None)
+            self.generation_[path] = self.generation_.get(path, 0) + 1
+
+    def truncate(self, path, size):
+        result = self.flush(path)
+        if result < 0:
+            return result
+        self.invalidate(path)
+        return self.dfs_.truncate(path, size)
+
+    def size(self, path):
+        """Size of path counting what we haven't written back, 0 if we
+        didn't change it"""
+        return self.sizes_.get(path, 0)
+
+    def stats(self):
+        with self.mutex_:
+            return {'blocks': len(self.blocks_), 'bytes': self.bytes_,
+                    'dirty': sum(len(blocks) for blocks in self.dirty_.values()),
+                    'hits': self.hits_, 'misses': self.misses_,
+                    'read_ahead': self.read_ahead_blocks_, 'written_back': self.written_back_}
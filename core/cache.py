@@ -0,0 +1,99 @@
+import time
+import bisect
+import threading
+import collections
+
+from address import inrange
+from settings import SIZE, LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL
+
+# Remembers which node owns which range of the ring so lookups for hot keys
+# don't walk the ring again. A range (start, end] belongs to the node whose
+# id is end. Entries go away when they get old, when we learn the ring
+# changed inside them, or when their owner fails or redirects us.
+class LookupCache(object):
+    def __init__(self, size = LOOKUP_CACHE_SIZE, ttl = LOOKUP_CACHE_TTL):
+        self.size_ = size
+        self.ttl_ = ttl
+        self.mutex_ = threading.Lock()
+        # end -> (start, owner, when we stored it), least recently used first
+        self.entries_ = collections.OrderedDict()
+        # sorted ends, to find the range an id falls in
+        self.ends_ = []
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def find(self, id):
+        # end of the range id may fall in, None if it doesn't fall in any
+        if not self.ends_:
+            return None
+        end = self.ends_[bisect.bisect_left(self.ends_, id) % len(self.ends_)]
+        start, _, _ = self.entries_[end]
+        if inrange(id, start + 1, end + 1):
+            return end
+        return None
+
+    def get(self, id):
+        """Owner of id, None if we don't know"""
+        with self.mutex_:
+            end = self.find(id)
+            if end is not None:
+                _, owner, stored = self.entries_[end]
+                if time.time() - stored < self.ttl_:
+                    self.entries_.move_to_end(end)
+                    self.hits_ += 1
+                    return owner
+                self.remove(end)
+            self.misses_ += 1
+            return None
+
+    def put(self, start, owner):
+        """Nobody sits in (start, owner]"""
+        end = owner.id()
+        start = start % SIZE
+        with self.mutex_:
+            if end in self.entries_:
+                old_start, old_owner, stored = self.entries_[end]
+                # keep the widest range we know about
+                if old_owner.address_ == owner.address_ and \
+                   time.time() - stored < self.ttl_ and \
+                   (end - old_start) % SIZE > (end - start) % SIZE:
+                    start = old_start
+            else:
+                bisect.insort(self.ends_, end)
+            self.entries_[end] = (start, owner, time.time())
+            self.entries_.move_to_end(end)
+            while len(self.entries_) > self.size_:
+                self.remove(next(iter(self.entries_)))
+
+    def remove(self, end):
+        del self.entries_[end]
+        del self.ends_[bisect.bisect_left(self.ends_, end)]
+
+    def invalidate(self, id):
+        """Forgets the range id falls in, say its owner redirected us"""
+        with self.mutex_:
+            end = self.find(id)
+            if end is not None:
+                self.remove(end)
+
+    def invalidate_node(self, id):
+        """A node with this id exists, ranges that go across it are wrong"""
+        with self.mutex_:
+            for end, (start, _, _) in list(self.entries_.items()):
+                if end != id and inrange(id, start + 1, end):
+                    self.remove(end)
+
+    def invalidate_owner(self, address):
+        with self.mutex_:
+            for end, (_, owner, _) in list(self.entries_.items()):
+                if owner.address_ == address:
+                    self.remove(end)
+
+    def clear(self):
+        with self.mutex_:
+            self.entries_.clear()
+            self.ends_ = []
+
+    def stats(self):
+        with self.mutex_:
+            return {'size': len(self.entries_), 'hits': self.hits_, 'misses': self.misses_}
@@ -1,6 +1,5 @@
 #!/bin/python
 import sys
-import json
 import socket
 import threading
 import random
@@ -8,9 +7,13 @@ import time
 import threading
 
 from address import Address, inrange
-from remote import Remote
+from remote import to_remote
+from server import Server
 from settings import *
 from network import *
+from logger import Logger
+from cache import LookupCache
+from liveness import detector
 
 def repeat_and_sleep(sleep_time):
 	def decorator(func):
@@ -65,9 +68,15 @@ class Daemon(threading.Thread):
 
 # class representing a local peer
 class Local(object):
-	def __init__(self, local_address, remote_address = None):
+	def __init__(self, local_address, remote_address = None, server = None):
 		self.address_ = local_address
+		# virtual nodes of a Host share its server, other nodes run their own
+		self.server_ = server
 		print("self id = %s" % self.id())
+		self.logger_ = Logger(str(self.id()), LOG_FILE.format(
+			ip = local_address.ip, port = local_address.port, vnode = local_address.vnode, id = self.id()))
+		# owners of the keys we looked up lately
+		self.lookup_cache_ = LookupCache()
 		self.shutdown_ = False
 		# list of successors
 		self.successors_ = []
@@ -85,18 +94,15 @@ class Local(object):
 		return inrange(id, self.predecessor_.id(1), self.id(1))
 
 	def shutdown(self):
-		self.shutdown_ = Trues
-		self.socket_.shutdown(socket.SHUT_RDWR)
-		self.socket_.close()
-
-	# logging function
-	def log(self, info):
-	    f = open("/tmp/chord.log", "a+")
-	    f.write(str(self.id()) + " : " +  info + "\n")
-	    f.close()
-	    #print str(self.id()) + " : " +  info
+		self.shutdown_ = True
+		# the server goes away with the last node using it
+		self.server_.unregister(self.address_.vnode)
 
 	def start(self):
+		# on a shared server we answer as soon as we exist, other vnodes of
+		# the host may be joining through us
+		if self.server_ is not None:
+			self.server_.register(self.address_.vnode, self.handle_request)
 		# start the daemons
 		self.daemons_['run'] = Daemon(self, 'run')
 		self.daemons_['fix_fingers'] = Daemon(self, 'fix_fingers')
@@ -105,11 +111,14 @@ class Local(object):
 		for key in self.daemons_:
 			self.daemons_[key].start()
 
-		self.log("started")
+		self.logger_.info("started")
 
 	def ping(self):
 		return True
 
+	def alive(self):
+		return True
+
 	def join(self, remote_address = None):
 		# initially just set successor
 		self.finger_ = [None for x in range(LOGSIZE)]
@@ -117,17 +126,17 @@ class Local(object):
 		self.predecessor_ = None
 
 		if remote_address:
-			remote = Remote(remote_address)
+			remote = to_remote(remote_address.as_tuple())
 			self.finger_[0] = remote.find_successor(self.id())
 		else:
 			self.finger_[0] = self
 
-		self.log("joined")
+		self.logger_.info("joined")
 
 	@repeat_and_sleep(STABILIZE_INT)
 	@retry_on_socket_error(STABILIZE_RET)
 	def stabilize(self):
-		self.log("stabilize")
+		self.logger_.debug("stabilize")
 		suc = self.successor()
 		# We may have found that x is our new successor iff
 		# - x = pred(suc(n))
@@ -141,8 +150,9 @@ class Local(object):
 		if x != None and \
 		   inrange(x.id(), self.id(1), suc.id()) and \
 		   self.id(1) != suc.id() and \
-		   x.ping():
+		   x.alive():
 			self.finger_[0] = x
+			self.lookup_cache_.invalidate_node(x.id())
 		# We notify our new successor about us
 		self.successor().notify(self)
 		# Keep calling us
@@ -155,25 +165,42 @@ class Local(object):
 		# - the new node r is in the range (pred(n), n)
 		# OR
 		# - our previous predecessor is dead
-		self.log("notify")
+		self.logger_.debug("notify")
 		if self.predecessor() == None or \
 		   inrange(remote.id(), self.predecessor().id(1), self.id()) or \
-		   not self.predecessor().ping():
+		   not self.predecessor().alive():
 			self.predecessor_ = remote
+			# keys in (old predecessor, remote] moved to remote
+			self.lookup_cache_.invalidate_node(remote.id())
 
 	@repeat_and_sleep(FIX_FINGERS_INT)
 	def fix_fingers(self):
 		# Randomly select an entry in finger_ table and update its value
-		self.log("fix_fingers")
-		i = random.randrange(LOGSIZE - 1) + 1
-		self.finger_[i] = self.find_successor(self.id(1<<i))
+		self.logger_.debug("fix_fingers")
+		# with N nodes on the ring all but the last ~log(N) fingers start
+		# before our successor, so they are our successor. We set those
+		# right away and only look up the others
+		suc = self.successor()
+		first = 1
+		while first < LOGSIZE and inrange(self.id(1<<first), self.id(1), suc.id(1)):
+			self.finger_[first] = suc
+			first += 1
+		if first == LOGSIZE:
+			return True
+		i = random.randrange(first, LOGSIZE)
+		# the cache is no good here, we want to know what the ring looks like now
+		try:
+			self.finger_[i] = self.route(self.id(1<<i))[0]
+		except socket.error:
+			# a node on the way just left, we will fix it next time
+			pass
 		# Keep calling us
 		return True
 
 	@repeat_and_sleep(UPDATE_SUCCESSORS_INT)
 	@retry_on_socket_error(UPDATE_SUCCESSORS_RET)
 	def update_successors(self):
-		self.log("update successor")
+		self.logger_.debug("update successor")
 		suc = self.successor()
 		# if we are not alone in the ring, calculate
 		if suc.id() != self.id():
@@ -186,18 +213,20 @@ class Local(object):
 		return True
 
 	def get_successors(self):
-		self.log("get_successors")
-		return [(node.address_.ip, node.address_.port) for node in self.successors_[:N_SUCCESSORS-1]]
+		self.logger_.debug("get_successors")
+		return [node.address_.as_tuple() for node in self.successors_[:N_SUCCESSORS-1]]
 
 	def id(self, offset = 0):
-		return (self.address_.__hash__() + offset) % SIZE
+		if not offset:
+			return self.address_.id_
+		return (self.address_.id_ + offset) % SIZE
 
 	def successor(self):
 		# We make sure to return an existing successor, there `might`
 		# be redundance between finger_[0] and successors_[0], but
 		# it doesn't harm
 		for remote in [self.finger_[0]] + self.successors_:
-			if remote.ping():
+			if remote.alive():
 				self.finger_[0] = remote
 				return remote
 		print("No successor available, aborting")
@@ -208,94 +237,176 @@ class Local(object):
 		return self.predecessor_
 
 	#@retry_on_socket_error(FIND_SUCCESSOR_RET)
-	def find_successor(self, id):
+	def find_successor(self, id, recursive = None):
+		# hot keys are answered from the cache without any routing
+		owner = self.lookup_cache_.get(id)
+		if owner is not None:
+			if owner.alive():
+				return owner
+			self.lookup_cache_.invalidate_owner(owner.address_)
+		owner, hops, start = self.route(id, recursive)
+		if owner is not self:
+			# the whole (start, owner] is its, not just id
+			self.lookup_cache_.put(start, owner)
+		return owner
+
+	def invalidate_lookup(self, id):
+		# the owner we got for id says it isn't (a redirect)
+		self.lookup_cache_.invalidate(id)
+
+	def route(self, id, recursive = None):
+		# returns the successor of id, the number of hops it took and the
+		# id of the node before it (id - 1 if we don't know)
 		# The successor of a key can be us iff
 		# - we have a pred(n)
 		# - id is in (pred(n), n]
-		self.log("find_successor")
+		self.logger_.debug("find_successor")
 		if self.predecessor() and \
 		   inrange(id, self.predecessor().id(1), self.id(1)):
-			return self
-		node = self.find_predecessor(id)
-		return node.successor()
+			return self, 0, self.predecessor().id()
+		if RECURSIVE_LOOKUP if recursive is None else recursive:
+			return self.find_successor_recursive(id, 0)
+		node, hops = self.trace_predecessor(id)
+		return node.successor(), hops, node.id()
+
+	def find_successors_batch(self, ids):
+		# successors of many ids at once, returns {id: node}. Ids we can't
+		# answer (nor the lookup cache) are grouped by the finger they would
+		# be sent to and each finger gets a single request with its whole
+		# group. The DFS finds the owners of the blocks it reads and writes
+		# this way
+		self.logger_.debug("find_successors_batch")
+		result = {}
+		groups = {}
+		suc = self.successor()
+		for id in dict.fromkeys(ids):
+			if self.predecessor() and \
+			   inrange(id, self.predecessor().id(1), self.id(1)):
+				result[id] = self
+			elif suc.id() == self.id() or inrange(id, self.id(1), suc.id(1)):
+				result[id] = suc
+			else:
+				owner = self.lookup_cache_.get(id)
+				if owner is not None and owner.alive():
+					result[id] = owner
+					continue
+				node = self.closest_preceding_finger(id)
+				if node is self:
+					result[id] = suc
+					continue
+				key = node.address_.as_tuple()
+				groups.setdefault(key, (node, []))[1].append(id)
+		for node, group in groups.values():
+			result.update(node.find_successors_batch(group))
+		return result
 
 	#@retry_on_socket_error(FIND_PREDECESSOR_RET)
 	def find_predecessor(self, id):
-		self.log("find_predecessor")
+		return self.trace_predecessor(id)[0]
+
+	def trace_predecessor(self, id):
+		# iterative lookup, we ask every node on the way for the next one
+		self.logger_.debug("find_predecessor")
 		node = self
+		hops = 0
 		# If we are alone in the ring, we are the pred(id)
 		if node.successor().id() == node.id():
-			return node
+			return node, hops
 		while not inrange(id, node.id(1), node.successor().id(1)):
 			node = node.closest_preceding_finger(id)
-		return node
+			hops += 1
+		return node, hops
+
+	def find_successor_recursive(self, id, hops):
+		# recursive lookup, the query is forwarded from node to node and
+		# only the answer comes back
+		self.logger_.debug("find_successor_recursive")
+		if self.predecessor() and \
+		   inrange(id, self.predecessor().id(1), self.id(1)):
+			return self, hops, self.predecessor().id()
+		suc = self.successor()
+		# we are pred(id) (or alone in the ring)
+		if suc.id() == self.id() or inrange(id, self.id(1), suc.id(1)):
+			return suc, hops, self.id()
+		node = self.closest_preceding_finger(id)
+		if node is self:
+			# somebody we don't know of may sit between us and suc
+			return suc, hops, (id - 1) % SIZE
+		return node.find_successor_recursive(id, hops + 1)
 
 	def closest_preceding_finger(self, id):
 		# first fingers in decreasing distance, then successors in
 		# increasing distance.
-		self.log("closest_preceding_finger")
+		self.logger_.debug("closest_preceding_finger")
 		for remote in reversed(self.successors_ + self.finger_):
-			if remote != None and inrange(remote.id(), self.id(1), id) and remote.ping():
+			if remote != None and inrange(remote.id(), self.id(1), id) and remote.alive():
 				return remote
 		return self
 
 	def run(self):
-		# should have a threadpool here :/
-		# listen to incomming connections
-		self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket_.bind((self.address_.ip, int(self.address_.port)))
-		self.socket_.listen(10)
-
-		while 1:
-			self.log("run loop")
-			try:
-				conn, addr = self.socket_.accept()
-			except socket.error:
-				self.shutdown_ = True
-				break
-
-			request = read_from_socket(conn)
-			command = request.split(' ')[0]
-
-			# we take the command out
-			request = request[len(command) + 1:]
-
-			# defaul : "" = not respond anything
-			result = json.dumps("")
-			if command == 'get_successor':
-				successor = self.successor()
-				result = json.dumps((successor.address_.ip, successor.address_.port))
-			if command == 'get_predecessor':
-				# we can only reply if we have a predecessor
-				if self.predecessor_ != None:
-					predecessor = self.predecessor_
-					result = json.dumps((predecessor.address_.ip, predecessor.address_.port))
-			if command == 'find_successor':
-				successor = self.find_successor(int(request))
-				result = json.dumps((successor.address_.ip, successor.address_.port))
-			if command == 'closest_preceding_finger':
-				closest = self.closest_preceding_finger(int(request))
-				result = json.dumps((closest.address_.ip, closest.address_.port))
-			if command == 'notify':
-				npredecessor = Address(request.split(' ')[0], int(request.split(' ')[1]))
-				self.notify(Remote(npredecessor))
-			if command == 'get_successors':
-				result = json.dumps(self.get_successors())
-
-			# or it could be a user specified operation
-			for t in self.command_:
-				if command == t[0]:
-					result = t[1](request)
-
-			send_to_socket(conn, result)
-			conn.close()
-
-			if command == 'shutdown':
-				self.socket_.close()
-				self.shutdown_ = True
-				self.log("shutdown started")
-				break
-		self.log("execution terminated")
+		# listen to incomming connections, requests are answered by a bounded
+		# pool of workers (take a look at server.py)
+		if self.server_ is None:
+			self.server_ = Server(self.address_)
+			self.server_.register(self.address_.vnode, self.handle_request)
+			self.logger_.info("run loop")
+			self.server_.serve_forever()
+		else:
+			# someone else runs the server, we only answer for our node
+			self.logger_.info("run loop")
+			while not self.shutdown_ and not self.server_.shutdown_:
+				time.sleep(1)
+		self.shutdown_ = True
+		self.logger_.info("execution terminated")
+
+	def stats(self):
+		stats = self.server_.stats()
+		stats['liveness'] = detector.stats()
+		stats['lookup_cache'] = self.lookup_cache_.stats()
+		return stats
+
+	def handle_request(self, command, request):
+		# arguments and replies are plain values, the server takes care of
+		# the wire format (see network.py)
+		result = None
+		if command == 'get_successor':
+			successor = self.successor()
+			result = successor.address_.as_tuple()
+		if command == 'get_predecessor':
+			# we can only reply if we have a predecessor
+			if self.predecessor_ != None:
+				predecessor = self.predecessor_
+				result = predecessor.address_.as_tuple()
+		if command == 'find_successor':
+			successor = self.find_successor(request)
+			result = successor.address_.as_tuple()
+		if command == 'find_successors_batch':
+			successors = self.find_successors_batch(request)
+			result = [successors[id].address_.as_tuple() for id in request]
+		if command == 'find_successor_recursive':
+			successor, hops, start = self.find_successor_recursive(*request)
+			result = (successor.address_.as_tuple(), hops, start)
+		if command == 'closest_preceding_finger':
+			closest = self.closest_preceding_finger(request)
+			result = closest.address_.as_tuple()
+		if command == 'notify':
+			npredecessor = to_remote(request)
+			# it just talked to us
+			detector.alive(npredecessor.address_)
+			self.notify(npredecessor)
+		if command == 'get_successors':
+			result = self.get_successors()
+		if command == 'stats':
+			result = self.stats()
+		if command == 'shutdown':
+			self.shutdown_ = True
+			self.logger_.info("shutdown started")
+
+		# or it could be a user specified operation
+		for t in self.command_:
+			if command == t[0]:
+				result = t[1](request)
+		return result
 
 	def register_command(self, cmd, callback):
 		self.command_.append((cmd, callback))
@@ -0,0 +1,54 @@
+import zlib
+import lzma
+import hashlib
+
+from settings import COMPRESSION, COMPRESS_MIN, COMPRESS_LZMA_MIN, COMPRESS_RATIO
+
+# Compression of DFS blocks, for storage (see ChunkStore in storage.py) and
+# for the wire (see BLOCK in network.py). A compressed chunk is a tag (the
+# codec) and the payload. Small blocks aren't worth it, big ones get lzma,
+# the rest zlib. A strided sample tells us first whether the block is worth
+# trying (random or already compressed data isn't), it looks at the whole
+# block so mostly zero blocks are, even if they start with data.
+RAW, ZLIB, LZMA = b"r", b"z", b"x"
+# bytes of the sample
+PROBE = 1024
+
+def digest(data):
+    """Name of a chunk with this content"""
+    return hashlib.sha256(data).hexdigest()
+
+def compressible(data):
+    # random (or compressed) data has about every byte value and few zeros
+    probe = memoryview(data)[::max(1, len(data) // PROBE)].tobytes()
+    return len(set(probe)) < 200 or probe.count(0) > (1 - COMPRESS_RATIO) * len(probe)
+
+def compress(data, fast = False):
+    """data -> (tag, payload), payload is data itself if it stays raw. fast
+    is for what we send, zlib at its fastest"""
+    if not COMPRESSION or len(data) < COMPRESS_MIN or not compressible(data):
+        return RAW, data
+    if fast:
+        tag, payload = ZLIB, zlib.compress(data, 1)
+    elif len(data) >= COMPRESS_LZMA_MIN:
+        tag, payload = LZMA, lzma.compress(data, preset = 1)
+    else:
+        tag, payload = ZLIB, zlib.compress(data, 6)
+    if len(payload) < COMPRESS_RATIO * len(data):
+        return tag, payload
+    return RAW, data
+
+def decompress(tag, payload):
+    if tag == ZLIB:
+        return zlib.decompress(payload)
+    if tag == LZMA:
+        return lzma.decompress(payload)
+    return bytes(payload)
+
+def pack(data):
+    # a chunk as we store it
+    tag, payload = compress(data)
+    return tag + payload
+
+def unpack(chunk):
+    return decompress(chunk[:1], memoryview(chunk)[1:])
@@ -1,127 +1,1122 @@
-# read : file, offset, size -> status b64_data
-# write : file, offset, size, buf
-# truncate_size : file new_size
-# attr : file -> dict
-import settings
+# read : file, offset, size (or extents) -> status, data
+# write : file, offset (or extents), data[, truncate] -> status, bytes written
+# attr : file[, changes] -> dict
+# load : -> requests per second, bytes we store and how our storage does
+# put_blocks : blocks and attributes handed over by another node (or copies
+#   of them, from the node we are a replica of)
+# replicas : -> nodes keeping copies of our keys
+# get_blocks : block ids, files -> our copies and their versions
+# get_range : (start, end], where we stopped -> next chunk of the blocks and
+#   attributes in the range, for a node that just joined in front of us
+# cas : file, offset, version we read, new block -> new version, or the
+#   block there is now and its version if somebody changed it meanwhile
+# delete : file, offsets -> status, blocks deleted (the whole blocks the
+#   offsets fall in, at the owner and its replicas)
+# All but load and replicas take and return (header, data): a small JSON
+# header and the raw bytes of the blocks (see BLOCK in network.py)
+import json
+import time
+import bisect
+import random
+import errno
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_all, TimeoutError as FutureTimeout
 
-BLOCK_SIZE = 4096
+from chord import Local
+from remote import to_remote
+from address import Address, inrange, ring_hash
+from load import LoadTracker
+from storage import open_store, open_chunk_store
+from network import user_command, BLOCK
+from settings import SIZE, DHT_REDIRECT_RET, LOOKUP_CACHE_TTL, RPC_TIMEOUT, \
+	REPLICATION_FACTOR, REPLICA_READS, READ_CONSISTENCY, WRITE_CONSISTENCY, \
+	STABILIZE_INT, TRANSFER_CHUNK, TRANSFER_RATE, TRANSFER_TTL, STORAGE_ENGINE, STORAGE_PATH, \
+	BLOCK_SIZE, PARALLEL_REQUESTS, CAS_RET, STORAGE_DEDUP, COMPRESSION
+
+# consistency levels, how many of the owner and its replicas must answer
+# a request before it is done
+ONE, QUORUM, ALL = 'ONE', 'QUORUM', 'ALL'
+
+def needed(consistency, copies):
+	if consistency == ONE:
+		return 1
+	if consistency == QUORUM:
+		return copies // 2 + 1
+	if consistency == ALL:
+		return copies
+	raise ValueError("unknown consistency %s" % consistency)
+
+# versions are [counter, id of the node that wrote it], the owner bumps
+# the counter on every change so the newest copy wins
+NO_VERSION = [0, 0]
+
+for command in ("read", "write", "attr", "get_range", "cas", "delete"):
+	user_command(command, BLOCK, BLOCK, forwards = True)
+# copies from the owner, answered right away
+for command in ("put_blocks", "get_blocks"):
+	user_command(command, BLOCK, BLOCK)
+
+# what the attr command may change
+CHANGES = set(['size', 'extend', 'mode', 'create', 'insert', 'remove', 'delete'])
+
+FAILED = ({'status':'failed'}, b"")
+REDIRECT = ({'status':'redirect'}, b"")
+# the client splits files in blocks of another size than we (or the file) do
+WRONG_BLOCK_SIZE = ({'status':'failed','code':-errno.EINVAL}, b"")
+# commands whose offsets mean blocks, clients tell the size of theirs
+BLOCK_SIZED = set(['read', 'write', 'attr', 'cas', 'delete'])
+
+# keeps bulk transfers to about rate bytes per second, so moving keys
+# around doesn't take all the bandwidth from the requests
+class Throttle(object):
+	def __init__(self, rate = TRANSFER_RATE):
+		self.rate_ = rate
+		# when we may send again
+		self.next_ = time.time()
+
+	def wait(self, size):
+		# call before sending size bytes
+		if not self.rate_:
+			return
+		now = time.time()
+		if self.next_ > now:
+			time.sleep(self.next_ - now)
+		self.next_ = max(self.next_, now) + size / self.rate_
 
 # data structure that represents a distributed file system
 class DFS(object):
-	def __init__(self, local_address, remote_address = None):
-		self.local_ = Local(local_address, remote_address)
+	def __init__(self, local, engine = STORAGE_ENGINE, block_size = BLOCK_SIZE):
+		# the Chord node we keep blocks for, the caller starts it
+		self.local_ = local
+		# every node of the file system must split files the same way
+		self.block_size_ = block_size
 		def read_wrap(msg):
 			return self._read(msg)
 		def write_wrap(msg):
 			return self._write(msg)
 		def attr_wrap(msg):
 			return self._attr(msg)
+		def load_wrap(msg):
+			return self._load(msg)
+		def put_blocks_wrap(msg):
+			return self._put_blocks(msg)
+		def replicas_wrap(msg):
+			return self._replicas(msg)
+		def get_blocks_wrap(msg):
+			return self._get_blocks(msg)
+		def get_range_wrap(msg):
+			return self._get_range(msg)
+		def cas_wrap(msg):
+			return self._cas(msg)
+		def delete_wrap(msg):
+			return self._delete(msg)
 
-		self.data_  = {}
-		self.attr_  = {}
+		# what we had before a restart is still there unless we keep it
+		# in memory (see storage.py)
+		address = local.address_
+		path = STORAGE_PATH.format(ip = address.ip, port = address.port, vnode = address.vnode, id = local.id())
+		# block id ("file:block") -> bytes, kept by content and compressed
+		# (see ChunkStore) unless we don't want either
+		if STORAGE_DEDUP or COMPRESSION:
+			self.data_ = open_chunk_store(engine, path + "-data", STORAGE_DEDUP)
+		else:
+			self.data_ = open_store(engine, path + "-data")
+		# block id -> version of the block we have
+		self.versions_ = open_store(engine, path + "-versions", 'json')
+		# file -> {'size':..., 'mode':..., 'version':...}, kept by the owner
+		# of block 0
+		self.attr_  = open_store(engine, path + "-attr", 'json')
+		# requests and bytes per key, to find out which ranges are hot
+		self.load_ = LoadTracker()
+		for block_id in self.data_:
+			self.load_.stored(ring_hash(block_id), self.data_.size(block_id))
+		self.mutex_ = threading.Lock()
+		# sends copies of what is written to the replicas
+		self.replicator_ = ThreadPoolExecutor(max_workers = 4 * REPLICATION_FACTOR)
+		# sends the requests of reads and writes of many blocks
+		self.requests_ = ThreadPoolExecutor(max_workers = PARALLEL_REQUESTS)
+		# owner (ip, port, vnode) -> (owner and its replicas, when we asked)
+		self.replica_cache_ = {}
+		# stale copies we brought up to date when reading
+		self.repairs_ = 0
+		# id of a range transfer from us -> [its keys, how many of them we
+		# dropped, when it asked last], see _get_range
+		self.transfers_ = {}
+		self.transfers_mutex_ = threading.Lock()
 
 		self.shutdown_ = False
 
-		self.local_.register_command("read", read_wrap)
-		self.local_.register_command("write", write_wrap)
-		self.local_.register_command("attr", attr_wrap)
+		self.commands_ = {"read": read_wrap, "write": write_wrap, "attr": attr_wrap,
+						  "load": load_wrap, "put_blocks": put_blocks_wrap,
+						  "replicas": replicas_wrap, "get_blocks": get_blocks_wrap,
+						  "get_range": get_range_wrap, "cas": cas_wrap,
+						  "delete": delete_wrap}
+		for command, callback in self.commands_.items():
+			self.local_.register_command(command, callback)
 
-		self.local_.start()
+		# a node joining a ring takes its keys from its successor, until it
+		# has them all it asks for each block it is missing
+		self.joined_ = threading.Event()
+		self.joining_ = self.local_.successor() is not self.local_
+		self.pulled_ = 0
+		if self.joining_:
+			self.joiner_ = threading.Thread(target = self.join)
+			self.joiner_.daemon = True
+			self.joiner_.start()
+		else:
+			self.joined_.set()
 
-    # helper function to eliminate duplicated code
-    def get_offsets(self, offset, size):
-        block_offset = offset / BLOCK_SIZE
-        start = offset % BLOCK_SIZE
-        end = min(start + size, BLOCK_SIZE)
-        return (block_offset, start, end)
+	# helper function to eliminate duplicated code
+	def get_offsets(self, offset, size):
+		block_offset = offset // self.block_size_
+		start = offset % self.block_size_
+		end = min(start + size, self.block_size_)
+		return (block_offset, start, end)
 
-    def get_id(self, file_name, offset):
+	def get_id(self, file_name, offset):
 		block_offset, start, end = self.get_offsets(offset, 0)
-    	return "%s:%s" % (file_name, block_offset)
+		return "%s:%s" % (file_name, block_offset)
 
 	def get_hash(self, file_name, offset):
-		return hash(self.get_id(file_name, offset)) % settings.SIZE
+		return ring_hash(self.get_id(file_name, offset))
 
 	def get_remote(self, file_name, offset):
 		hs = self.get_hash(file_name, offset)
 		suc = self.local_.find_successor(hs)
 		return suc
 
+	def same_block_size(self, request):
+		# offsets mean other blocks to a client splitting files otherwise
+		return request.get('block_size', self.block_size_) == self.block_size_
+
+	def is_ours(self, id):
+		# until we have a predecessor we don't know where our range starts
+		return self.local_.predecessor() is not None and self.local_.is_ours(id)
+
 	def _read(self, request):
-		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#>, 'size': <#NUMBER#>}
+		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#>, 'size': <#NUMBER#>
+		#			  [,'replica':true][,'consistency':'ONE'|'QUORUM'|'ALL']} |
+		#			 {'file_name':'my_file.txt', 'extents':[[<#OFFSET#>, <#SIZE#>], ...], ...}
 		# response = {'status':'failed'} |
 		#			 {'status':'failed','code':<#CODE ERROR#>} |
 		#			 {'status':'redirect'}
-		# 			 {'status':'ok','data':<#DATA READ AS B64#>}
+		# 			 {'status':'ok','sizes':[<#BYTES READ OF EACH EXTENT#>, ...],
+		#			  'versions':[<#VERSION OF EACH BLOCK#>|null, ...]}, <#DATA READ#>
 		try:
-			data = json.loads(request)
-			if not self.local_.is_ours(self.get_hash(data['file_name'], data['offset'])):
-				return json.dumps({'status':'redirect'})
+			data = request[0]
+			if not self.same_block_size(data):
+				return WRONG_BLOCK_SIZE
+			# pieces of a few blocks at once (all of them ours), or of one
+			extents = data.get('extents') or [(data['offset'], data['size'])]
+			block_ids = [self.get_id(data['file_name'], offset) for offset, size in extents]
+			for block_id in block_ids:
+				# replicas answer for the blocks they have copies of
+				if not self.is_ours(ring_hash(block_id)) and not (data.get('replica') and block_id in self.data_):
+					return REDIRECT
 			# otherwise continue
-			result = self.read(data['file_name'], data['offset'], data['size'])
-			if type result == type -1:
-				return json.dumps({'status':'failed', 'code': result})
-			result = base64.b64encode(result)
-			return json.dumpds({'status':'ok','data':total_read})
+			for block_id in block_ids:
+				self.load_.hit(ring_hash(block_id))
+			if self.joining_:
+				self.catch_up([block_id for block_id in block_ids if self.is_ours(ring_hash(block_id))], [])
+			consistency = data.get('consistency', READ_CONSISTENCY)
+			if consistency != ONE and not self.quorum_read(block_ids, [], consistency):
+				return {'status':'failed', 'code': -errno.EIO}, b""
+			with self.mutex_:
+				pieces = [self.read(data['file_name'], size, offset) for offset, size in extents]
+				versions = [self.versions_.get(block_id) for block_id in block_ids]
+			return {'status':'ok','sizes':[len(piece) for piece in pieces],'versions':versions}, \
+				   pieces[0] if len(pieces) == 1 else b"".join(pieces)
 
 		except Exception:
-			return json.dumps({'status':'failed'})
+			return FAILED
 
 	def _write(self, request):
-		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#>, 'data':<#B64 ENCODED DATA#>}
+		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#>[,'truncate':true]
+		#			  [,'consistency':'ONE'|'QUORUM'|'ALL']}, <#DATA#> |
+		#			 {'file_name':'my_file.txt', 'extents':[[<#OFFSET#>, <#SIZE#>], ...], ...},
+		#			 <#DATA OF THE EXTENTS, ONE AFTER THE OTHER#>
 		# response = {'status':'failed'} |
 		#			 {'status':'failed','code':<#CODE ERROR#>} |
 		#			 {'status':'redirect'}
 		# 			 {'status':'ok','bytes':<#BYTES WROTE#>}
 		try:
-			data = json.loads(request)
-			if not self.local_.is_ours(self.get_hash(data['file_name'], data['offset'])):
-				return json.dumps({'status':'redirect'})
-			result = self.write(data['file_name'], base64.b64decode(data['data']), offset)
+			data, buf = request
+			if not self.same_block_size(data):
+				return WRONG_BLOCK_SIZE
+			extents = data.get('extents') or [(data['offset'], len(buf))]
+			block_ids = [self.get_id(data['file_name'], offset) for offset, size in extents]
+			if not all(self.is_ours(ring_hash(block_id)) for block_id in block_ids):
+				return REDIRECT
+			for block_id in block_ids:
+				self.load_.hit(ring_hash(block_id))
+			if self.joining_:
+				self.catch_up(block_ids, [])
+			buf = memoryview(buf)
+			result = 0
+			for offset, size in extents:
+				result += self.write(data['file_name'], buf[result:result + size], offset, data.get('truncate', False))
+			if result >= 0:
+				with self.mutex_:
+					copy = dict((block_id, (self.data_[block_id], self.versions_[block_id]))
+								for block_id in block_ids if block_id in self.data_)
+				# the write stays here even if not enough replicas take it
+				if not self.replicate(copy, {}, data.get('consistency', WRITE_CONSISTENCY)):
+					result = -errno.EIO
 			if result < 0:
-				return json.dumps({'status':'failed','code':result})
+				return {'status':'failed','code':result}, b""
 			else:
-				return json.dumps({'status':'ok','bytes':result})
+				return {'status':'ok','bytes':result}, b""
 		except Exception:
-			return json.dumps({'status':'failed'})
+			return FAILED
 
 	def _attr(self, request):
-		# request  = {'file_name':'my_file.txt'[,'size':<#NEW VALUE#>|,'mode':<#NEW MODE#>]}
+		# request  = {'file_name':'my_file.txt'[,'size':<#NEW VALUE#>|,'mode':<#NEW MODE#>]
+		#			  [,'extend':<#AT LEAST THIS SIZE#>][,'create':true][,'delete':true]
+		#			  [,'insert':<#NAME#>|,'remove':<#NAME#>][,'expect':<#VERSION#>]
+		#			  [,'consistency':'ONE'|'QUORUM'|'ALL']}
 		# response = {'status':'failed'} |
 		#			 {'status':'failed','code':<#CODE ERROR#>} |
 		#			 {'status':'redirect'}
+		#			 {'status':'ok','attr':{'size':<#NUMBER#>,'mode':<#NUMBER#>,'mtime':<#SECONDS#>,
+		#			  'blocks':<#NUMBER#>,'block_size':<#NUMBER#>,'version':<#VERSION#>
+		#			  [,'entries':[<#NAME#>, ...]]}}
+		# insert and remove change the (sorted) names in 'entries', they fail
+		# with EEXIST and ENOENT if the name is already there or isn't. With
+		# expect nothing changes (EAGAIN) unless the version is still that one.
+		# Requests for blocks (this and the others) may tell the size of the
+		# blocks the client splits files in ('block_size'), they fail with
+		# EINVAL if it isn't the one of the file (of the node for the others)
 		try:
-			data = json.loads(request)
-			if not self.local_.is_ours(self.get_hash(data['file_name'], 0)):
-				return json.dumps({'status':'redirect'})
+			data = request[0]
+			hs = self.get_hash(data['file_name'], 0)
+			if not self.is_ours(hs):
+				return REDIRECT
+			self.load_.hit(hs)
+			if self.joining_:
+				self.catch_up([], [data['file_name']])
+			with self.mutex_:
+				block_size = self.attr_.get(data['file_name'], {}).get('block_size')
+			if block_size not in (None, data.get('block_size', block_size)):
+				return WRONG_BLOCK_SIZE
+			changes = set(data) & CHANGES
+			consistency = data.get('consistency', WRITE_CONSISTENCY if changes else READ_CONSISTENCY)
+			if not changes and consistency != ONE and \
+			   not self.quorum_read([], [data['file_name']], consistency):
+				return {'status':'failed','code':-errno.EIO}, b""
+			result = self.attr(data['file_name'], data)
+			if result is None:
+				return {'status':'failed','code':-errno.ENOENT}, b""
+			if result is False:
+				code = -errno.EAGAIN if 'expect' in data else -errno.EEXIST if 'insert' in data else -errno.ENOENT
+				return {'status':'failed','code':code}, b""
+			if changes and not self.replicate({}, {data['file_name']: result}, consistency):
+				return {'status':'failed','code':-errno.EIO}, b""
+			return {'status':'ok','attr':result}, b""
 
 		except Exception:
-			return json.dumps({'status':'failed'})
+			return FAILED
 
-	def trunc_(self, request):
+	def _cas(self, request):
+		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#>, 'version':<#VERSION WE READ#>|null
+		#			  [,'consistency':'ONE'|'QUORUM'|'ALL']}, <#NEW BLOCK#>
+		# response = {'status':'failed'} |
+		#			 {'status':'failed','code':<#CODE ERROR#>} |
+		#			 {'status':'redirect'}
+		#			 {'status':'ok','version':<#NEW VERSION#>} |
+		#			 {'status':'conflict','version':<#VERSION#>|null}, <#THE BLOCK WE HAVE#>
+		# The whole block the offset falls in is replaced, only if its version
+		# is still the one given (null: there is no such block)
+		try:
+			data, buf = request
+			if not self.same_block_size(data):
+				return WRONG_BLOCK_SIZE
+			block_id = self.get_id(data['file_name'], data['offset'])
+			hs = ring_hash(block_id)
+			if not self.is_ours(hs):
+				return REDIRECT
+			self.load_.hit(hs)
+			if self.joining_:
+				self.catch_up([block_id], [])
+			consistency = data.get('consistency', WRITE_CONSISTENCY)
+			if consistency != ONE and not self.quorum_read([block_id], [], consistency):
+				return {'status':'failed','code':-errno.EIO}, b""
+			if len(buf) > self.block_size_:
+				return {'status':'failed','code':-errno.EFBIG}, b""
+			with self.mutex_:
+				version = self.versions_.get(block_id)
+				if version != data['version']:
+					return {'status':'conflict','version':version}, self.data_.get(block_id, b"")
+				block = bytes(buf)
+				version = self.next_version(version)
+				self.data_[block_id] = block
+				self.versions_[block_id] = version
+			self.load_.stored(hs, len(block))
+			if not self.replicate({block_id: (block, version)}, {}, consistency):
+				return {'status':'failed','code':-errno.EIO}, b""
+			return {'status':'ok','version':version}, b""
+		except Exception:
+			return FAILED
 
-	def read(self, path, size, offset):
-		attr = self.attr(file_name)
+	def _delete(self, request):
+		# request  = {'file_name':'my_file.txt', 'offset':<#NUMBER#> |
+		#			  'extents':[[<#OFFSET#>, <#SIZE#>], ...][,'replica':true]
+		#			  [,'consistency':'ONE'|'QUORUM'|'ALL']}
+		# response = {'status':'failed'} |
+		#			 {'status':'failed','code':<#CODE ERROR#>} |
+		#			 {'status':'redirect'}
+		#			 {'status':'ok','blocks':<#BLOCKS DELETED#>}
+		# The whole blocks the offsets fall in go. With replica it comes
+		# from the owner, we drop our copies whoever owns them
+		try:
+			data = request[0]
+			if not self.same_block_size(data):
+				return WRONG_BLOCK_SIZE
+			extents = data.get('extents') or [(data['offset'], 0)]
+			block_ids = [self.get_id(data['file_name'], offset) for offset, size in extents]
+			if data.get('replica'):
+				return {'status':'ok','blocks':self.delete(block_ids)}, b""
+			if not all(self.is_ours(ring_hash(block_id)) for block_id in block_ids):
+				return REDIRECT
+			for block_id in block_ids:
+				self.load_.hit(ring_hash(block_id))
+			deleted = self.delete(block_ids)
+			# the copies go too (while we join our successor, that still has
+			# the blocks, is one of them). We wait for all of them, unlike a
+			# write there is no version to tell a later read that a copy left
+			# behind is stale, it would bring the block back
+			replicas = self.replicas()
+			request = (dict(data, replica = True), b"")
+			futures = [self.replicator_.submit(self.push_delete, node, request) for node in replicas]
+			done = wait_all(futures, RPC_TIMEOUT)[0]
+			if sum(1 for future in done if future.exception() is None) < \
+			   needed(data.get('consistency', WRITE_CONSISTENCY), len(replicas) + 1) - 1:
+				return {'status':'failed','code':-errno.EIO}, b""
+			return {'status':'ok','blocks':deleted}, b""
+		except Exception:
+			return FAILED
+
+	def _load(self, request):
+		# response = {'status':'ok','rate':<#REQUESTS PER SECOND#>,'bytes':<#NUMBER#>,'keys':<#NUMBER#>}
+		predecessor = self.local_.predecessor()
+		stats = self.load_.stats()
+		if predecessor is not None:
+			stats['rate'] = round(self.load_.rate(predecessor.id(), self.local_.id()), 3)
+		stats['storage'] = self.storage_stats()
+		stats['status'] = 'ok'
+		return json.dumps(stats)
+
+	def _put_blocks(self, request):
+		# request  = {'data':{<#BLOCK ID#>:[<#START#>, <#END#>, <#VERSION#>], ...},
+		#			  'attr':{<#FILE#>:<#ATTR#>, ...}}, <#THE BLOCKS, ONE AFTER THE OTHER#>
+		# response = {'status':'failed'} |
+		#			 {'status':'ok','blocks':<#BLOCKS STORED#>}
+		try:
+			return {'status':'ok','blocks':self.merge(request)}, b""
+		except Exception:
+			return FAILED
+
+	def _get_blocks(self, request):
+		# request  = {'data':[<#BLOCK ID#>, ...], 'attr':[<#FILE#>, ...]}
+		# response = blocks and attributes as put_blocks takes them, what we
+		#			 don't have is left out
+		data = request[0]
+		if self.joining_:
+			self.catch_up(data['data'], data['attr'])
+		with self.mutex_:
+			blocks = dict((block_id, (self.data_[block_id], self.versions_[block_id]))
+						  for block_id in data['data'] if block_id in self.data_)
+			attr = dict((path, self.attr_[path]) for path in data['attr'] if path in self.attr_)
+		return self.encode_blocks(blocks, attr)
+
+	def _get_range(self, request):
+		# request  = {'start':<#ID#>, 'end':<#ID#>, 'after':<#LAST KEY WE GOT#>|null, 'drop':<#BOOL#>
+		#			  [,'transfer':<#ID OF THE TRANSFER#>]}
+		# response = blocks and attributes as put_blocks takes them, the header
+		#			 also has 'last':<#KEY#>|null, 'bytes':<#NUMBER#>. Keys are
+		#			 ['attr', <#FILE#>] or ['data', <#BLOCK ID#>], null when there
+		#			 is nothing left. With drop we forget what was sent before after
+		data = request[0]
+		first, last = (data['start'] + 1) % SIZE, (data['end'] + 1) % SIZE
+		after = tuple(data['after']) if data['after'] else None
+		if self.joining_ and after is None:
+			# somebody joined in front of us before we got our own keys,
+			# some of them are still at our successor
+			try:
+				successor = self.local_.successor()
+				if successor is not self.local_:
+					self.pull(successor, data['start'], data['end'], self.dropped_by(successor))
+			except socket.error:
+				pass
+		# the keys of the range are sorted once, every chunk starts where
+		# the last one ended. A transfer we forgot (it was idle for too
+		# long) starts over from after
+		key = data.get('transfer') or (data['start'], data['end'])
+		now = time.time()
+		with self.transfers_mutex_:
+			for idle in [k for k, t in self.transfers_.items() if now - t[2] > TRANSFER_TTL]:
+				del self.transfers_[idle]
+			transfer = None if after is None else self.transfers_.get(key)
+		if transfer is None:
+			transfer = [self.range_keys(first, last), 0, now]
+			with self.transfers_mutex_:
+				self.transfers_[key] = transfer
+		transfer[2] = now
+		keys = transfer[0]
+		start = bisect.bisect_right(keys, after) if after else 0
+		if after and data['drop']:
+			self.forget(keys[transfer[1]:start])
+			transfer[1] = max(transfer[1], start)
+		blocks, attr, size, end = self.chunk(keys, start)
+		if end > start:
+			return self.encode_blocks(blocks, attr, last = keys[end - 1], bytes = size)
+		with self.transfers_mutex_:
+			self.transfers_.pop(key, None)
+		if data['drop']:
+			self.load_.forget(data['start'], data['end'])
+		return self.encode_blocks({}, {}, last = None, bytes = 0)
 
-		if offset > attr.size:
-			return ""
+	def _replicas(self, request):
+		# response = [[<#IP#>, <#PORT#>, <#VIRTUAL NODE#>], ...]
+		return json.dumps([node.address_.as_tuple() for node in self.replicas()])
 
+	def read(self, path, size, offset):
 		block_offset, start, end = self.get_offsets(offset, size)
-		block_id = self.get_id(file_name, offset)
+		block_id = self.get_id(path, offset)
+
+		# a block nobody wrote (past the end of the file, or a hole) reads
+		# as nothing. A view, so the part we send isn't copied
+		block = self.data_.get(block_id, b"")
+		return memoryview(block)[start:end]
+
+	def write(self, path, buf, offset, truncate = False):
+		# with truncate the block ends where buf does
+		block_offset, start, end = self.get_offsets(offset, len(buf))
+		block_id = self.get_id(path, offset)
+
+		with self.mutex_:
+			if truncate and not buf and block_id not in self.data_:
+				# cutting a hole leaves it one
+				return 0
+			block = bytearray(self.data_.get(block_id, b""))
+			# fill up with 0x00's before
+			if len(block) < start:
+				block.extend(bytes(start - len(block)))
+			block[start:end] = buf[:end - start]
+			if truncate:
+				del block[end:]
+			block = bytes(block)
+			# data first, a crash in between leaves a newer block under an
+			# older version, never the other way round
+			self.data_[block_id] = block
+			self.versions_[block_id] = self.next_version(self.versions_.get(block_id))
+		self.load_.stored(ring_hash(block_id), len(block))
+		return end - start
+
+	def delete(self, block_ids):
+		# drops blocks, returns how many of them we had
+		deleted = []
+		with self.mutex_:
+			for block_id in block_ids:
+				if block_id in self.data_:
+					del self.data_[block_id]
+					del self.versions_[block_id]
+					deleted.append(block_id)
+		for block_id in deleted:
+			self.load_.stored(ring_hash(block_id), 0)
+		return len(deleted)
+
+	def attr(self, path, changes = None):
+		# attributes of path after applying changes, None if it doesn't exist,
+		# False if the name to insert (remove) is (isn't) there. They live
+		# with block 0, so a stat is a single request and changes happen all
+		# at once here
+		changes = changes or {}
+		with self.mutex_:
+			attr = self.attr_.get(path)
+			if attr is None or attr.get('deleted'):
+				if not changes.get('create'):
+					return None
+				# a deleted file keeps counting versions
+				attr = {'size': 0, 'mode': 0o666, 'version': attr and attr['version'],
+						'block_size': changes.get('block_size', self.block_size_)}
+			attr = dict(attr)
+			if not set(changes) & CHANGES:
+				return attr
+			entries = attr.get('entries', [])
+			if 'insert' in changes and changes['insert'] in entries or \
+			   'remove' in changes and changes['remove'] not in entries or \
+			   'expect' in changes and changes['expect'] != attr.get('version'):
+				return False
+			attr['version'] = self.next_version(attr.get('version'))
+			if 'size' in changes:
+				attr['size'] = changes['size']
+			if 'extend' in changes:
+				attr['size'] = max(attr['size'], changes['extend'])
+			if 'mode' in changes:
+				attr['mode'] = changes['mode']
+			if 'insert' in changes:
+				attr['entries'] = list(entries)
+				bisect.insort(attr['entries'], changes['insert'])
+			if 'remove' in changes:
+				attr['entries'] = [name for name in entries if name != changes['remove']]
+			attr['mtime'] = time.time()
+			attr['blocks'] = -(-attr['size'] // attr.get('block_size', self.block_size_))
+			if changes.get('delete'):
+				# a tombstone, so older copies don't bring it back
+				attr = {'deleted': True, 'version': attr['version']}
+			self.attr_[path] = attr
+			return attr
+
+	def handoff(self, start, end, remote, drop = True):
+		"""Hands the blocks (and attributes) in (start, end] over to remote,
+		a chunk at a time, we keep a copy unless drop. Returns how many
+		blocks we sent"""
+		keys = self.range_keys((start + 1) % SIZE, (end + 1) % SIZE)
+		throttle = Throttle()
+		first = sent = 0
+		while first < len(keys):
+			blocks, attrs, size, first = self.chunk(keys, first)
+			throttle.wait(size)
+			self.push(remote, self.encode_blocks(blocks, attrs))
+			sent += len(blocks)
+			if drop:
+				with self.mutex_:
+					for block_id, (block, version) in blocks.items():
+						# unless it was written again meanwhile
+						if self.versions_.get(block_id) == version:
+							del self.data_[block_id]
+							del self.versions_[block_id]
+					for path, attr in attrs.items():
+						if self.attr_.get(path) == attr:
+							del self.attr_[path]
+		if drop:
+			self.load_.forget(start, end)
+		return sent
+
+	def range_keys(self, first, last):
+		# keys of our attributes and blocks in [first, last), sorted:
+		# ('attr', file) and ('data', block id)
+		with self.mutex_:
+			keys = [('attr', path) for path in self.attr_ if inrange(ring_hash("%s:0" % path), first, last)]
+			keys += [('data', block_id) for block_id in self.data_ if inrange(ring_hash(block_id), first, last)]
+		keys.sort()
+		return keys
+
+	def chunk(self, keys, first):
+		"""Attributes and blocks (block id -> (block, version)) of keys from
+		first on, up to about TRANSFER_CHUNK bytes. Those we don't have any
+		more are skipped. Returns (blocks, attributes, bytes, index of the
+		next key)"""
+		blocks, attrs, size = {}, {}, 0
+		end = first
+		with self.mutex_:
+			while end < len(keys) and size < TRANSFER_CHUNK:
+				kind, name = keys[end]
+				end += 1
+				if kind == 'attr' and name in self.attr_:
+					attrs[name] = self.attr_[name]
+					size += len(name) + len(json.dumps(attrs[name]))
+				elif kind == 'data' and name in self.data_:
+					blocks[name] = (self.data_[name], self.versions_[name])
+					size += len(name) + len(blocks[name][0])
+		return blocks, attrs, size, end
+
+	def forget(self, keys):
+		# drops the attributes and blocks of keys, they are somebody
+		# else's now
+		with self.mutex_:
+			for kind, name in keys:
+				if kind == 'attr' and name in self.attr_:
+					del self.attr_[name]
+				elif kind == 'data' and name in self.data_:
+					del self.data_[name]
+					del self.versions_[name]
+
+	def encode_blocks(self, data, attr, **fields):
+		# put_blocks request, data is block id -> (block, version)
+		index, blocks, offset = {}, [], 0
+		for block_id, (block, version) in data.items():
+			index[block_id] = (offset, offset + len(block), version)
+			blocks.append(block)
+			offset += len(block)
+		fields['data'] = index
+		fields['attr'] = attr
+		return fields, b"".join(blocks)
+
+	def next_version(self, version):
+		return [(version or NO_VERSION)[0] + 1, self.local_.id()]
+
+	def merge(self, copies):
+		"""Takes the blocks and attributes (as sent by put_blocks) newer than
+		ours, returns how many blocks we took"""
+		taken = 0
+		copies, blocks = copies[0], memoryview(copies[1])
+		with self.mutex_:
+			for block_id, (start, end, version) in copies['data'].items():
+				if version > self.versions_.get(block_id, NO_VERSION):
+					block = bytes(blocks[start:end])
+					self.data_[block_id] = block
+					self.versions_[block_id] = version
+					self.load_.stored(ring_hash(block_id), len(block))
+					taken += 1
+			for path, attr in copies['attr'].items():
+				if attr.get('version', NO_VERSION) > self.attr_.get(path, {}).get('version', NO_VERSION):
+					self.attr_[path] = attr
+		return taken
+
+	def push(self, remote, request):
+		reply = remote.call("put_blocks", request)[0]
+		if reply['status'] != 'ok':
+			raise socket.error("%s didn't take the blocks" % remote)
+
+	def push_delete(self, remote, request):
+		reply = remote.call("delete", request)[0]
+		if reply['status'] != 'ok':
+			raise socket.error("%s didn't delete the blocks" % remote)
+
+	def replicas(self):
+		# the first nodes after us keep copies of our keys. Virtual nodes of
+		# a host fail together, one copy per host is enough
+		hosts = set([(self.local_.address_.ip, self.local_.address_.port)])
+		replicas = []
+		for node in list(self.local_.successors_):
+			if len(replicas) == REPLICATION_FACTOR - 1:
+				break
+			host = (node.address_.ip, node.address_.port)
+			if host not in hosts:
+				hosts.add(host)
+				replicas.append(node)
+		return replicas
+
+	def wait(self, futures, count):
+		"""Waits until count of futures succeed, False if they can't"""
+		if count <= 0:
+			return True
+		try:
+			for future in as_completed(futures, RPC_TIMEOUT):
+				if future.exception() is None:
+					count -= 1
+					if not count:
+						return True
+		except FutureTimeout:
+			pass
+		return False
+
+	def replicate(self, data, attr, consistency = WRITE_CONSISTENCY):
+		"""Copies blocks and attributes to our replicas, returns whether
+		enough of them (we count) took them. The rest get them in the
+		background"""
+		replicas = self.replicas()
+		request = self.encode_blocks(data, attr)
+		# all of them at once
+		futures = [self.replicator_.submit(self.push, node, request) for node in replicas]
+		return self.wait(futures, needed(consistency, len(replicas) + 1) - 1)
+
+	def quorum_read(self, block_ids, paths, consistency):
+		"""Brings our copies up to date with the newest among enough of the
+		replicas, False if not enough of them answered"""
+		replicas = self.replicas()
+		request = ({'data': block_ids, 'attr': paths}, b"")
+		futures = [self.replicator_.submit(self.read_repair, node, request, block_ids, paths)
+				   for node in replicas]
+		return self.wait(futures, needed(consistency, len(replicas) + 1) - 1)
+
+	def read_repair(self, node, request, block_ids, paths):
+		# takes what node has that is newer, and gives it what we have
+		# that is newer
+		copies = node.call("get_blocks", request)
+		self.merge(copies)
+		theirs = copies[0]
+		with self.mutex_:
+			data = dict((block_id, (self.data_[block_id], self.versions_[block_id])) for block_id in block_ids
+						if block_id in self.data_ and
+						   self.versions_[block_id] > theirs['data'].get(block_id, (0, 0, NO_VERSION))[2])
+			attr = dict((path, self.attr_[path]) for path in paths
+						if path in self.attr_ and self.attr_[path].get('version', NO_VERSION) >
+						   theirs['attr'].get(path, {}).get('version', NO_VERSION))
+		if data or attr:
+			self.repairs_ += 1
+			# the reader doesn't need to wait for this
+			self.replicator_.submit(self.push, node, self.encode_blocks(data, attr))
+
+	def join(self):
+		# we own (predecessor, us] as soon as our successor knows about us,
+		# what it has there comes to us. Our predecessor may be somebody who
+		# joined after us, what our successor had before us is what we take
+		start = None
+		while not self.shutdown_ and not self.local_.shutdown_:
+			try:
+				successor = self.local_.successor()
+				theirs = successor.predecessor() if successor is not self.local_ else None
+				if start is None and theirs is not None and theirs.id() != self.local_.id():
+					start = theirs.id()
+				predecessor = self.local_.predecessor()
+				if predecessor is not None and theirs is not None and theirs.id() == self.local_.id():
+					if start is None:
+						start = predecessor.id()
+					self.pulled_ = self.pull(successor, start, self.local_.id(), self.dropped_by(successor))
+					break
+			except socket.error:
+				# somebody left meanwhile, we try again
+				pass
+			time.sleep(STABILIZE_INT / 4)
+		self.joining_ = False
+		self.joined_.set()
+
+	def pull(self, remote, start, end, drop = False):
+		"""Takes the blocks and attributes in (start, end] remote has,
+		a chunk at a time, returns how many blocks we took"""
+		throttle = Throttle()
+		request = {'start': start, 'end': end, 'after': None, 'drop': drop,
+				   'transfer': "%s:%x" % (self.local_.id(), random.getrandbits(64))}
+		taken = 0
+		while True:
+			reply = remote.call("get_range", (request, b""))
+			taken += self.merge(reply)
+			if reply[0]['last'] is None:
+				return taken
+			request['after'] = reply[0]['last']
+			throttle.wait(reply[0]['bytes'])
+
+	def dropped_by(self, successor):
+		# our successor keeps a copy of what it gives us if it is one of
+		# our replicas
+		ours = (self.local_.address_.ip, self.local_.address_.port)
+		return REPLICATION_FACTOR < 2 or (successor.address_.ip, successor.address_.port) == ours
+
+	def catch_up(self, block_ids, paths):
+		# while we join, what we are asked for and don't have yet may still
+		# be at our successor
+		with self.mutex_:
+			block_ids = [block_id for block_id in block_ids if block_id not in self.data_]
+			paths = [path for path in paths if path not in self.attr_]
+		if not block_ids and not paths:
+			return
+		try:
+			successor = self.local_.successor()
+			if successor is not self.local_:
+				self.merge(successor.call("get_blocks", ({'data': block_ids, 'attr': paths}, b"")))
+		except socket.error:
+			pass
+
+	def leave(self):
+		# everything we have goes to our successor, it owns it once we are gone
+		self.shutdown_ = True
+		successor = self.local_.successor()
+		if successor is not self.local_:
+			self.handoff(self.local_.id(), self.local_.id(), successor)
+		self.replicator_.shutdown(wait = False)
+		self.requests_.shutdown(wait = False)
+		self.close()
+
+	def shutdown(self):
+		# leaves the ring, our keys go first
+		try:
+			self.leave()
+		finally:
+			self.local_.shutdown()
+
+	def close(self):
+		# what we store stays on disk (unless it lives in memory), a DFS on
+		# the same address picks it up
+		with self.mutex_:
+			for store in (self.data_, self.versions_, self.attr_):
+				store.close()
+
+	def storage_stats(self):
+		return {'data': self.data_.stats(), 'versions': self.versions_.stats(), 'attr': self.attr_.stats()}
+
+	# client side, these work from any node
+	def ask(self, node, command, request):
+		if command in BLOCK_SIZED:
+			request = (dict(request[0], block_size = self.block_size_), request[1])
+		if node is self.local_:
+			return self.commands_[command](request)
+		return node.call(command, request)
+
+	def replicas_of(self, owner):
+		"""owner and the nodes keeping copies of its keys"""
+		if owner is self.local_:
+			return [owner] + self.replicas()
+		key = owner.address_.as_tuple()
+		nodes, since = self.replica_cache_.get(key, (None, 0))
+		if time.time() - since > LOOKUP_CACHE_TTL:
+			nodes = [owner] + [to_remote(address) for address in json.loads(owner.command("replicas"))]
+			self.replica_cache_[key] = (nodes, time.time())
+		return nodes
+
+	def send(self, command, file_name, offset, request, data = b"", any_replica = False):
+		"""Sends request (and data) to the owner of the block (or any of its
+		replicas), following redirects. Returns (reply, data)"""
+		hs = self.get_hash(file_name, offset)
+		request = (request, data)
+		for retry in range(DHT_REDIRECT_RET):
+			try:
+				owner = self.local_.find_successor(hs)
+				node = random.choice(self.replicas_of(owner)) if any_replica else owner
+				reply = self.ask(node, command, request)
+				if reply[0]['status'] == 'redirect' and node is not owner:
+					# that replica doesn't have it (yet)
+					reply = self.ask(owner, command, request)
+				if reply[0]['status'] != 'redirect':
+					return reply
+			except socket.error:
+				pass
+			# the ring is changing under us, ask again in a moment
+			self.local_.invalidate_lookup(hs)
+			time.sleep(0.05 * 2 ** retry)
+		return FAILED
+
+	def extents(self, offset, size):
+		# (offset, size) of the piece of every block in size bytes from offset
+		extents = []
+		while size > 0:
+			block_offset, start, end = self.get_offsets(offset, size)
+			extents.append((offset, end - start))
+			offset += end - start
+			size -= end - start
+		return extents
+
+	def batches(self, path, extents, any_replica = False):
+		"""Groups the extents of path by the node that has them, in requests
+		of about TRANSFER_CHUNK bytes. Returns [(node, extents), ...], node
+		is None if we couldn't find out"""
+		nodes = {}
+		try:
+			owners = self.owners([self.get_hash(path, offset) for offset, size in extents])
+			for owner, extent in zip(owners, extents):
+				nodes.setdefault(owner.address_.as_tuple(), (owner, []))[1].append(extent)
+			nodes = [(random.choice(self.replicas_of(owner)) if any_replica else owner, group)
+					 for owner, group in nodes.values()]
+		except socket.error:
+			# the ring is changing, send asks one block at a time
+			return [(None, [extent]) for extent in extents]
+		batches = []
+		for node, group in nodes:
+			batch, size = [], 0
+			for extent in group:
+				if batch and size + extent[1] > TRANSFER_CHUNK:
+					batches.append((node, batch))
+					batch, size = [], 0
+				batch.append(extent)
+				size += extent[1]
+			batches.append((node, batch))
+		return batches
+
+	def owners(self, hashes):
+		# the nodes owning hashes, looked up together (a request per
+		# finger they go through, not one per block)
+		if len(hashes) == 1:
+			return [self.local_.find_successor(hashes[0])]
+		owners = self.local_.find_successors_batch(hashes)
+		return [owners[hs] for hs in hashes]
+
+	def parallel(self, call, batches, *args):
+		# call(node, extents, *args) for every batch, at the same time if
+		# there are many
+		if len(batches) == 1:
+			return [call(batches[0][0], batches[0][1], *args)]
+		futures = [self.requests_.submit(call, node, extents, *args) for node, extents in batches]
+		return [future.result() for future in futures]
+
+	def read_extents(self, node, extents, path, any_replica, consistency):
+		# {offset: data} of the extents of path, in one request to node if
+		# it has them all, else a block at a time. None if it failed
+		request = {'file_name': path, 'replica': any_replica, 'consistency': consistency}
+		if node is not None and len(extents) > 1:
+			try:
+				reply, data = self.ask(node, "read", (dict(request, extents = extents), b""))
+				if reply['status'] == 'ok':
+					pieces, start, data = {}, 0, memoryview(data)
+					for (offset, size), length in zip(extents, reply['sizes']):
+						pieces[offset] = data[start:start + length]
+						start += length
+					return pieces
+			except socket.error:
+				pass
+		pieces = {}
+		for offset, size in extents:
+			reply, data = self.send("read", path, offset, dict(request, offset = offset, size = size),
+									any_replica = any_replica)
+			if reply['status'] != 'ok':
+				return None
+			pieces[offset] = data
+		return pieces
+
+	def write_extents(self, node, extents, path, buf, base, consistency):
+		# {offset: bytes written} of the extents of path (buf starts at
+		# offset base), in one request to node if it owns them all
+		request = {'file_name': path, 'consistency': consistency}
+		if node is not None and len(extents) > 1:
+			try:
+				data = b"".join(buf[offset - base:offset - base + size] for offset, size in extents)
+				reply, _ = self.ask(node, "write", (dict(request, extents = extents), data))
+				if reply['status'] == 'ok':
+					return dict(extents)
+			except socket.error:
+				pass
+		written = {}
+		for offset, size in extents:
+			reply, _ = self.send("write", path, offset, dict(request, offset = offset),
+								 buf[offset - base:offset - base + size])
+			if reply['status'] != 'ok':
+				break
+			written[offset] = reply['bytes']
+		return written
+
+	def delete_extents(self, node, extents, path, consistency):
+		# offsets of the extents of path whose blocks are gone, in one
+		# request to node if it owns them all, else a block at a time
+		request = {'file_name': path, 'consistency': consistency}
+		if node is not None and len(extents) > 1:
+			try:
+				reply, _ = self.ask(node, "delete", (dict(request, extents = extents), b""))
+				if reply['status'] == 'ok':
+					return [offset for offset, size in extents]
+			except socket.error:
+				pass
+		deleted = []
+		for offset, size in extents:
+			reply, _ = self.send("delete", path, offset, dict(request, offset = offset))
+			if reply['status'] != 'ok':
+				break
+			deleted.append(offset)
+		return deleted
+
+	def fetch(self, path, size, offset, consistency = READ_CONSISTENCY):
+		"""Up to size bytes of path from offset, None if it failed. The
+		blocks come from their owners in parallel"""
+		# any copy will do for ONE, the owner gathers the others otherwise
+		any_replica = REPLICA_READS and consistency == ONE
+		extents = self.extents(offset, size)
+		pieces = {}
+		for result in self.parallel(self.read_extents, self.batches(path, extents, any_replica),
+									path, any_replica, consistency):
+			if result is None:
+				return None
+			pieces.update(result)
+		# up to the size of the file, holes (blocks nobody wrote, and the
+		# rest of short ones) read as 0x00's. We only ask for the size if
+		# there is one
+		result = bytearray()
+		end = None
+		for offset, size in extents:
+			piece = pieces[offset]
+			result += piece
+			if len(piece) < size:
+				if end is None:
+					attr = self.stat(path, consistency)
+					end = attr['size'] if attr else 0
+				fill = min(size, end - offset) - len(piece)
+				if fill > 0:
+					result += bytes(fill)
+				if len(piece) + max(fill, 0) < size:
+					break
+		return bytes(result)
+
+	def store(self, path, buf, offset, consistency = WRITE_CONSISTENCY):
+		"""Writes buf at offset of path, returns the bytes written (up to
+		the first block that failed). The blocks go to their owners in
+		parallel"""
+		buf = memoryview(buf)
+		extents = self.extents(offset, len(buf))
+		done = {}
+		for result in self.parallel(self.write_extents, self.batches(path, extents),
+									path, buf, offset, consistency):
+			done.update(result)
+		written = 0
+		for start, size in extents:
+			if done.get(start) != size:
+				break
+			written += size
+		if written:
+			self.stat(path, consistency, extend = offset + written, create = True)
+		return written
+
+	def truncate(self, path, size, consistency = WRITE_CONSISTENCY):
+		"""Cuts (or extends) path to size, 0 or -errno. The block the lower
+		of the old and the new end falls in is cut there, so nothing that
+		was past the end before comes back, and the blocks wholly past the
+		new end are deleted. Reads fill the rest up with 0x00's"""
+		attr = self.stat(path, consistency)
+		if attr is None:
+			return -errno.ENOENT
+		end = min(size, attr['size'])
+		if end % self.block_size_:
+			reply, _ = self.send("write", path, end, {'file_name': path, 'offset': end,
+													   'truncate': True, 'consistency': consistency})
+			if reply['status'] != 'ok':
+				return reply.get('code', -errno.EIO)
+		# nothing when it grows, the blocks past the old end are holes
+		first = -(-size // self.block_size_) * self.block_size_
+		extents = [(offset, 0) for offset in range(first, attr['size'], self.block_size_)]
+		if extents:
+			deleted = []
+			# owners in parallel, one request each
+			for result in self.parallel(self.delete_extents, self.batches(path, extents), path, consistency):
+				deleted += result
+			if len(deleted) < len(extents):
+				return -errno.EIO
+		return 0 if self.stat(path, consistency, size = size) is not None else -errno.EIO
 
+	def fetch_block(self, path, offset, consistency = READ_CONSISTENCY):
+		"""The block of path offset falls in and its version (None if there
+		is no such block), from its owner. None if it failed"""
+		block_offset = offset - offset % self.block_size_
+		reply, data = self.send("read", path, block_offset, {'file_name': path, 'offset': block_offset,
+								'size': self.block_size_, 'consistency': consistency})
+		if reply['status'] != 'ok':
+			return None
+		return reply['versions'][0], bytes(data)
 
-		result = self.data_[block_id][start:end]
+	def cas(self, path, offset, version, block, consistency = WRITE_CONSISTENCY):
+		"""Replaces the block of path offset falls in with block if its
+		version is still version. Returns (True, new version, None), or
+		(False, version, block) of what is there now. None if it failed"""
+		reply, data = self.send("cas", path, offset, {'file_name': path, 'offset': offset,
+								'version': version, 'consistency': consistency}, block)
+		if reply['status'] == 'ok':
+			return True, reply['version'], None
+		if reply['status'] == 'conflict':
+			return False, reply['version'], bytes(data)
+		return None
 
-	def write(self, path, buf, offset):
-		pass
+	def update(self, path, offset, change, consistency = WRITE_CONSISTENCY, retries = CAS_RET):
+		"""Sets the block of path offset falls in to change(block) (b"" if
+		there is none), without locks: if somebody changed it meanwhile we
+		call change again with what is there now. Returns the new block,
+		None if it failed"""
+		current = self.fetch_block(path, offset, consistency)
+		if current is None:
+			return None
+		version, block = current
+		for retry in range(retries):
+			new = change(block)
+			result = self.cas(path, offset, version, new, consistency)
+			if result is None:
+				return None
+			done, version, block = result
+			if done:
+				self.stat(path, consistency, extend = offset - offset % self.block_size_ + len(new), create = True)
+				return new
+			# back off a bit, a busy block has many writers
+			time.sleep(random.uniform(0, 0.01 * 2 ** retry))
+		return None
 
-	def attr(self, path):
-		pass
+	def stat(self, path, consistency = None, **changes):
+		"""Attributes of path (changed as asked), None if it doesn't exist"""
+		changes['file_name'] = path
+		if consistency is not None:
+			changes['consistency'] = consistency
+		reply, _ = self.send("attr", path, 0, changes)
+		return reply['attr'] if reply['status'] == 'ok' else None
 
 if __name__ == "__main__":
 	import sys
 	if len(sys.argv) == 2:
-		dfs = Local(Address("127.0.0.1", sys.argv[1]))
+		local = Local(Address("127.0.0.1", sys.argv[1]))
 	else:
-		dfs = Local(Address("127.0.0.1", sys.argv[1]), Address("127.0.0.1", sys.argv[2]))
-	
+		local = Local(Address("127.0.0.1", sys.argv[1]), Address("127.0.0.1", sys.argv[2]))
+	dfs = DFS(local)
+	local.start()
@@ -0,0 +1,77 @@
+import errno
+
+from address import ring_hash
+from settings import DIRECTORY_BUCKETS, DIRECTORY_PAGE, PARALLEL_REQUESTS
+
+# The names in a DFS directory, spread over DIRECTORY_BUCKETS buckets by
+# their hash so a big directory isn't one hot key rewritten on every
+# create. A bucket lives with the attributes of a file no one can make
+# ("<directory>/<bucket>/"), its owner adds and removes names atomically
+# (insert and remove of the attr command, see dht.py), so concurrent
+# creates don't lose each other. Listing goes through the buckets in
+# order, a page at a time.
+class Directory(object):
+    def __init__(self, dfs, path, buckets = DIRECTORY_BUCKETS):
+        self.dfs_ = dfs
+        self.path_ = path.rstrip('/')
+        self.buckets_ = buckets
+
+    def bucket(self, index):
+        return "%s/%d/" % (self.path_, index)
+
+    def bucket_of(self, name):
+        return self.bucket(ring_hash(name) % self.buckets_)
+
+    def change(self, name, change):
+        bucket = self.bucket_of(name)
+        reply, _ = self.dfs_.send("attr", bucket, 0, {'file_name': bucket, 'create': True, change: name})
+        if reply['status'] == 'ok':
+            return 0
+        return reply.get('code', -errno.EIO)
+
+    def insert(self, name):
+        """Adds name, 0 or -errno (EEXIST if it is there already)"""
+        return self.change(name, 'insert')
+
+    def remove(self, name):
+        """Takes name out, 0 or -errno (ENOENT if it isn't there)"""
+        return self.change(name, 'remove')
+
+    def entries_of(self, index):
+        attr = self.dfs_.stat(self.bucket(index))
+        return attr.get('entries', []) if attr else []
+
+    def __contains__(self, name):
+        return name in self.entries_of(ring_hash(name) % self.buckets_)
+
+    def page(self, after = None, size = DIRECTORY_PAGE):
+        """Up to size names past the cursor after, and the cursor of the
+        next page (None once there is nothing left). A cursor is
+        [bucket, last name we gave]"""
+        bucket, last = after or (0, None)
+        names = []
+        while bucket < self.buckets_:
+            # the next few buckets at the same time
+            indexes = range(bucket, min(bucket + PARALLEL_REQUESTS, self.buckets_))
+            for index, entries in zip(indexes, self.dfs_.requests_.map(self.entries_of, indexes)):
+                if last is not None:
+                    entries = [name for name in entries if name > last]
+                    last = None
+                taken = entries[:size - len(names)]
+                names.extend(taken)
+                if len(taken) < len(entries):
+                    return names, [index, taken[-1]] if taken else [index, None]
+                bucket = index + 1
+                if len(names) == size:
+                    return names, [bucket, None] if bucket < self.buckets_ else None
+        return names, None
+
+    def __iter__(self):
+        # every name, a page at a time
+        cursor = None
+        while True:
+            names, cursor = self.page(cursor)
+            for name in names:
+                yield name
+            if cursor is None:
+                return
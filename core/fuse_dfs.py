@@ -3,9 +3,8 @@
 #
 # usage: 
 #  ./python create_chord.py $N_CHORDS
-#  - take one of the pids (one of the list from the first line) and replace
-#  - assign that number to PORT
-#  ./python fuse_dfs.py <mountpoint>
+#  - take one of the ports (one of the list from the first line)
+#  ./python fuse_dfs.py <port> <that port> <mountpoint>
 # unmount with fusermount -u <mountpoint>
 #
 
@@ -17,35 +16,35 @@
 # I have not ran the POSIX test yet, but I did verify that the MD5 sum of the copy
 # of a 30 MB file was the same.
 #
-# The structure is pretty simple, every item stored has the following fields:
-# {'type':('directory', 'file'),
-#  'data': ___
-# }
+# Files are stored by the DFS (see dht.py) in blocks of BLOCK_SIZE bytes
+# (settings.py), "<file>:<block>" is the key of each one. Blocks travel and
+# are stored as raw bytes.
 #
-# - In the case of directories, 'data' contains a dictionary with the keyword \
-# 'files' that returns a list of files in the FS.
-# - In the case of files, 'data' contains a 'base64_data' field with bytes encoded
-# in base64.
+# The names in a directory are spread over buckets kept by different nodes
+# (see directory.py), creating and removing a file changes one of them
+# atomically. Only '/' for now.
 #
+# The size, mode and mtime of a file are kept with its block 0, so getattr
+# is a single request. Blocks we read and write go through a cache (see
+# blockcache.py), what we write is sent when the file is flushed.
 #
 
+import sys
 import stat
 import errno
 import fuse
-import socket
-import dfs
 from time import time
-from subprocess import *
 
-import chord
-import json 
-import base64
+from address import Address
+from chord import Local
+from dht import DFS
+from blockcache import BlockCache
+from directory import Directory
+from logger import Logger
 
 fuse.fuse_python_api = (0, 2)
 
-# port from an chord node listening on <127.0.0.1:PORT>
-PORT = 19308
-BLOCK_SIZE = 4096
+LOG_FILE = "/tmp/dfs.log"
 
 
 # default stat, not very useful
@@ -63,201 +62,120 @@ class MyStat(fuse.Stat):
         self.st_ctime = 0
 
 
-# logging function
-def log(info):
-    f = open("/tmp/dfs.log", "a+")
-    f.write(info + "\n")
-    f.close()
+# buffered, written by a background thread (see logger.py)
+log = Logger("dfs", LOG_FILE)
 
-# decorator to log every system call on our fs (strace equiv)
+# decorator to log every system call on our fs (strace equiv), only at
+# debug level
 def logtofile(func):
     def inner(self, *args, **kwargs):
-        f = open("/tmp/dfs.log", "a+")
-        f.write("Function %s called with parameters %s %s\n" % (func.__name__,
-                args, kwargs))
-        f.close()
+        log.debug("Function %s called with parameters %s %s", func.__name__, args, kwargs)
         return func(self, *args, **kwargs)
     return inner
 
 
 class FUSEDFS(fuse.Fuse):
-    def __init__(self, local, *args, **kw):
+    def __init__(self, dfs, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
-        self.local_ = local
+        # the DFS of our Chord node, it finds the blocks for us
+        self.dfs_ = dfs
+        self.cache_ = BlockCache(dfs)
 
     # helper function to eliminate duplicated code
     def get_offsets(self, offset, size):
-        block_offset = offset / BLOCK_SIZE
-        start = offset % BLOCK_SIZE
-        end = min(start + size, BLOCK_SIZE)
-        return (block_offset, start, end)
+        return self.dfs_.get_offsets(offset, size)
 
     # This is the guy responsible of making our FS visible to linux
     @logtofile
     def getattr(self, path):
         st = MyStat()
 
-        # TODO: I need to add this metadata to the :0 block :/
-        st.st_atime = int(time())
-        st.st_mtime = st.st_atime
-        st.st_ctime = st.st_atime
-
-        # if we are asking for root, just get /, else, remove / and ask for block :0
+        # root is always there, the default stat is for it
         if path == '/':
-            obj = get('/')
+            attr = None
         else:
-            obj = get("%s:0" % path[1:])
-
-        # if nothing was returned, it can be 2 things, the file doesn't exist or
-        # we need to bootstrap
-        if obj == None:
-            if path == '/':
-                log("Creating empty root folder")
-                obj = {'type':'directory', 'data':{'files':[]}}
-                put(path, obj)
-            else:
-                log("File ' %s' doesn't exist" % path)
+            # otherwise, remove / and get its attributes
+            attr = self.dfs_.stat(path[1:])
+            if attr is None:
+                log.info("File ' %s' doesn't exist", path)
                 return -errno.ENOENT
-
-        if obj['type'] == 'file':
-            # if it's a file, set the file flag and get size
-            st.st_mode = stat.S_IFREG | 0o666
-            # we assume there's nothing bigger than 4G here. we do a binary search
-            # to find the las block. This could be improved a lot with different
-            # algorithms or ideas.
-            left = 0
-            right = (1<<32)/BLOCK_SIZE
-            while left + 1 < right:
-                mid = (left + right) / 2
-                offsets = self.get_offsets(mid * BLOCK_SIZE, 1)
-                key = "%s:%s" %(path[1:], offsets[0])
-                block = get(key)
-                if block != None:
-                    left = mid
-                else:
-                    right = mid
-            # the total size is the sum of previous blocks plus the data stored
-            # at block 'left'
-            key = "%s:%s" %(path[1:], left)
-            block = get(key)
-            size = left * BLOCK_SIZE + len(base64.b64decode(block['data']['b64_data']))
-
-            st.st_size = size
+            # it's a file, set the file flag and size, what we haven't
+            # written back counts too
+            st.st_mode = stat.S_IFREG | attr['mode']
+            st.st_size = max(attr['size'], self.cache_.size(path[1:]))
+            st.st_blocks = (st.st_size + 511) // 512
+            st.st_blksize = attr.get('block_size', self.dfs_.block_size_)
+
+        st.st_mtime = int(attr.get('mtime', time())) if attr else int(time())
+        st.st_atime = st.st_mtime
+        st.st_ctime = st.st_mtime
         return st
 
     @logtofile
     def readdir(self, path, offset):
-        files = [ "..", "." ]
+        for r in [ "..", "." ]:
+            yield fuse.Direntry(r)
         # right now we only support for '/', but this is general enough to support
-        # folders in case we decide to implement mkdir
-        directory = get(path)
-        if directory != None and directory['type'] == 'directory':
-            files.extend(directory['data']['files'])
-
-        for r in files:
+        # folders in case we decide to implement mkdir. The names come a page
+        # at a time
+        for r in Directory(self.dfs_, path):
             yield fuse.Direntry(str(r))
 
     @logtofile
     def mknod(self, path, mode, dev):
-        root = get('/')
         key = path[1:]
-        # check if it exist, we shouldn't create an already existing file
-        if key in root['data']['files']:
-            return - 42
-        # we are going to add it then!
-        root['data']['files'].extend([key])
-        put('/', root)
-
-        # we only set the initial block
-        key = "%s:0" % key
-        obj = {'type': 'file',
-               'data': { 'b64_data': base64.b64encode("") }
-              }
-        put(key, obj)
+        # we add it unless it exists, at once, two of us can't both create it
+        result = Directory(self.dfs_, '/').insert(key)
+        if result < 0:
+            return result
+
+        # an empty file, no blocks yet
+        self.dfs_.stat(key, create = True)
 
         # logging
-        log("New node created '%s'" % key)
+        log.info("New node created '%s'", key)
 
         return 0
 
     @logtofile
     def unlink(self, path):
-        # not possible to remove files yet
-        return -42
+        key = path[1:]
+        result = Directory(self.dfs_, '/').remove(key)
+        if result < 0:
+            return result
+        # its blocks go empty, its attributes become a tombstone
+        result = self.cache_.truncate(key, 0)
+        if result < 0:
+            return result
+        if self.dfs_.stat(key, delete = True) is None:
+            return -errno.EIO
+        log.info("File '%s' removed", key)
+        return 0
 
     @logtofile
     def read(self, path, size, offset):
-        # we get rid of '/'
-        path = path[1:]
-
-        # first we make sure it exsist
-        key = "%s:0" % path
-        obj = get(key)
-        if obj == None:
-            return - errno.ENOENT
-
-        # otherwise it exist, and we need to calculate the key for the current block
-        block_offset, start, end = self.get_offsets(offset, size)
-        key = "%s:%s" % (path, block_offset)
-
-        # get the file block
-        obj = get(key)
-        # if it doesn't exist, just return 0, because it means we are at the end of
-        # the file
-        if obj == None:
-            return 0
-
-        # we read
-        data = base64.b64decode(obj['data']['b64_data'])[start:end]
-
+        # open made sure it exists, past the end of the file we get
+        # nothing back
+        data = self.cache_.read(path[1:], size, offset)
+        if data is None:
+            return -errno.EIO
         return data
 
     @logtofile
     def write(self, path, buf, offset):
-        # we get rid of '/'
-        path = path[1:]
-
-        # first we make sure it exsist
-        key = "%s:0" % path
-        obj = get(key)
-        if obj == None:
-            return - errno.ENOENT
-
-        # otherwise it exist, and we need to calculate the key for the current block
-        block_offset, start, end = self.get_offsets(offset, len(buf))
-
-        key = "%s:%s" % (path, block_offset)
-
-        # get the file block
-        obj = get(key)
-
-        # if it doesn't exist, just return create it
-        if obj == None:
-            obj = {'type':'file',
-                   'data':{'b64_data': None}
-            }
-
-            # fill up with 0x00's before
-            data = ("\00" * start) + buf[:end-start]
-            obj['data']['b64_data'] = base64.b64encode(data)
-
-        else:
-            data = base64.b64decode(obj['data']['b64_data'])
-            # this is the new data
-            data = data[:start] + buf[:end-start] + data[end:]
-            obj['data']['b64_data'] = base64.b64encode(data)
-
-
-        # save into the DHT
-        put(key, obj)
-        return int(end-start)
+        # it goes to the DFS when the file is flushed
+        return self.cache_.write(path[1:], buf, offset)
 
     @logtofile
     def release(self, path, flags):
-        return 0
+        return self.cache_.flush(path[1:])
 
     @logtofile
     def open(self, path, flags):
+        # somebody else may have changed it since we last had it open
+        if self.dfs_.stat(path[1:]) is None:
+            return -errno.ENOENT
+        self.cache_.invalidate(path[1:])
         return 0
 
     @logtofile
@@ -266,30 +184,12 @@ class FUSEDFS(fuse.Fuse):
         path = path[1:]
 
         # first we make sure it exsist
-        key = "%s:0" % path
-        obj = get(key)
-        if obj == None:
+        if self.dfs_.stat(path) is None:
             return - errno.ENOENT
 
-        # otherwise it exist, and we need to calculate the key for the current block
-        block_offset, start, end = self.get_offsets(size, 0)
-        key = "%s:%s" % (path, block_offset)
-
-        # get the file block
-        obj = get(key)
-
-        # if it doesn't exist, just return 0
-        if obj == None:
-            return 0
-
-        # if it does exist, truncate it
-        data = base64.b64decode(obj['data']['b64_data'])
-        obj['data']['b64_data'] = base64.b64encode(data[:end])
-
-
-        put(key, obj)
-        log("File %s truncated to %s" % (key, end))
-        return 0
+        result = self.cache_.truncate(path, size)
+        log.info("File %s truncated to %s", path, size)
+        return result
 
     @logtofile
     def utime(self, path, times):
@@ -309,21 +209,26 @@ class FUSEDFS(fuse.Fuse):
 
     @logtofile
     def fsync(self, path, isfsyncfile):
-        return 0
+        return self.cache_.flush(path[1:])
 
 def main():
     usage="""
         FUSEDFS: A filesystem implemented on top of a DHT.
     """ + fuse.Fuse.fusage
 
+    # our port and the port of a node of the ring, fuse takes the rest
+    port = sys.argv.pop(1)
     if len(sys.argv) == 2:
-        local = Local(Address("127.0.0.1", sys.argv[1]))
+        local = Local(Address("127.0.0.1", port))
     else:
-        local = Local(Address("127.0.0.1", sys.argv[1]), Address("127.0.0.1", sys.argv[2]))
+        local = Local(Address("127.0.0.1", port), Address("127.0.0.1", sys.argv.pop(1)))
 
+    dfs = DFS(local)
     local.start()
-    server = FUSEDFS(local, version="%prog " + fuse.__version__,
+    server = FUSEDFS(dfs, version="%prog " + fuse.__version__,
                      usage=usage, dash_s_do='setsingle')
+    # requests of different files (or blocks) don't wait for each other
+    server.multithreaded = True
     server.parse(errex=1)
     server.main()
 
@@ -0,0 +1,65 @@
+import time
+import threading
+
+from settings import LIVENESS_TTL, SUSPECT_TIMEOUT
+
+# what we believe about a peer
+ALIVE, SUSPECTED, UNKNOWN = range(3)
+
+# Failure detector shared by every Remote in the process. Every RPC tells it
+# whether the peer answered (stabilize and friends talk to our neighbours
+# all the time), so routing can tell live peers from dead ones without
+# pinging them on every hop. Only peers we know nothing recent about need
+# a real ping.
+class FailureDetector(object):
+    def __init__(self, ttl = LIVENESS_TTL, suspect_timeout = SUSPECT_TIMEOUT):
+        # a peer that answered is trusted for ttl seconds, one that failed
+        # is taken for dead during suspect_timeout seconds
+        self.ttl_ = ttl
+        self.suspect_timeout_ = suspect_timeout
+        self.mutex_ = threading.Lock()
+        # (ip, port, virtual node) -> (state, when we learned it)
+        self.peers_ = {}
+        # answers given from what we knew, and peers we had to ping
+        self.hits_ = 0
+        self.probes_ = 0
+
+    def alive(self, address):
+        with self.mutex_:
+            self.peers_[address.as_tuple()] = (ALIVE, time.time())
+
+    def failed(self, address):
+        with self.mutex_:
+            self.peers_[address.as_tuple()] = (SUSPECTED, time.time())
+
+    def forget(self, address):
+        with self.mutex_:
+            self.peers_.pop(address.as_tuple(), None)
+
+    def state(self, address):
+        key = address.as_tuple()
+        with self.mutex_:
+            state, since = self.peers_.get(key, (UNKNOWN, 0))
+            age = time.time() - since
+            if (state == ALIVE and age < self.ttl_) or \
+               (state == SUSPECTED and age < self.suspect_timeout_):
+                self.hits_ += 1
+                return state
+            # what we knew is too old to be trusted
+            if state != UNKNOWN:
+                del self.peers_[key]
+            self.probes_ += 1
+            return UNKNOWN
+
+    def stats(self):
+        with self.mutex_:
+            now = time.time()
+            alive = sum(1 for state, since in self.peers_.values()
+                        if state == ALIVE and now - since < self.ttl_)
+            suspected = sum(1 for state, since in self.peers_.values()
+                            if state == SUSPECTED and now - since < self.suspect_timeout_)
+            return {'alive': alive, 'suspected': suspected,
+                    'hits': self.hits_, 'probes': self.probes_}
+
+# shared by every Remote (and AsyncRemote) in the process
+detector = FailureDetector()
@@ -0,0 +1,78 @@
+import math
+import time
+import threading
+
+from address import inrange
+from settings import SIZE, LOAD_HALF_LIFE
+
+# Requests and stored bytes per key (ring id) of a node. Request counts
+# decay with a half life, so what we get is the recent request rate and a
+# range that stopped being hot cools down by itself.
+class LoadTracker(object):
+    def __init__(self, half_life = LOAD_HALF_LIFE):
+        self.half_life_ = half_life
+        self.mutex_ = threading.Lock()
+        # id -> (decayed number of requests, when it was last updated)
+        self.hits_ = {}
+        # id -> bytes stored under it
+        self.bytes_ = {}
+
+    def decayed(self, count, since, now):
+        return count * 0.5 ** ((now - since) / self.half_life_)
+
+    def hit(self, id, n = 1):
+        now = time.time()
+        with self.mutex_:
+            count, since = self.hits_.get(id, (0.0, now))
+            self.hits_[id] = (self.decayed(count, since, now) + n, now)
+
+    def stored(self, id, size):
+        with self.mutex_:
+            if size:
+                self.bytes_[id] = size
+            else:
+                self.bytes_.pop(id, None)
+
+    def forget(self, start, end):
+        """Keys in (start, end] are not ours anymore"""
+        with self.mutex_:
+            for table in (self.hits_, self.bytes_):
+                for id in [id for id in table if inrange(id, (start + 1) % SIZE, (end + 1) % SIZE)]:
+                    del table[id]
+
+    def rates(self, start = None, end = None):
+        """id -> requests per second, for the keys in (start, end]"""
+        now = time.time()
+        # a steady rate r keeps the decayed count at r * half life / ln 2
+        scale = math.log(2) / self.half_life_
+        with self.mutex_:
+            items = list(self.hits_.items())
+        rates = {}
+        for id, (count, since) in items:
+            if start is None or inrange(id, (start + 1) % SIZE, (end + 1) % SIZE):
+                rates[id] = self.decayed(count, since, now) * scale
+        return rates
+
+    def rate(self, start = None, end = None):
+        return sum(self.rates(start, end).values())
+
+    def bytes(self, start = None, end = None):
+        with self.mutex_:
+            return sum(size for id, size in self.bytes_.items()
+                       if start is None or inrange(id, (start + 1) % SIZE, (end + 1) % SIZE))
+
+    def split(self, start, end, amount):
+        """Point x of (start, end] such that the keys in (x, end] take about
+        amount requests per second"""
+        rates = self.rates(start, end)
+        # walk down from end
+        total = 0.0
+        for id in sorted(rates, key = lambda id: (end - id) % SIZE):
+            if total + rates[id] > amount:
+                # id stays, everything after it goes
+                return id
+            total += rates[id]
+        return start
+
+    def stats(self):
+        return {'rate': round(self.rate(), 3), 'bytes': self.bytes(), 'keys': len(self.bytes_)}
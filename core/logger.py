@@ -0,0 +1,104 @@
+import sys
+import time
+import queue
+import atexit
+import threading
+import collections
+
+from settings import LOG_LEVEL, LOG_FLUSH_INT, LOG_QUEUE_SIZE
+
+# a logger writes the lines at or above its level
+DEBUG, INFO, WARNING, ERROR, OFF = range(5)
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+NAMES = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+# Lines are handed to a single background thread that appends them to their
+# files in batches, so logging never waits on the disk. If it can't keep up
+# lines are dropped (and counted) rather than blocking whoever is logging.
+class Writer(object):
+    def __init__(self, flush_interval = LOG_FLUSH_INT, max_queued = LOG_QUEUE_SIZE):
+        self.flush_interval_ = flush_interval
+        # (path, time, level, name, message, arguments)
+        self.queue_ = queue.Queue(max_queued)
+        self.dropped_ = 0
+        self.mutex_ = threading.Lock()
+        self.thread_ = None
+
+    def put(self, record):
+        if self.thread_ is None:
+            self.start()
+        try:
+            self.queue_.put_nowait(record)
+        except queue.Full:
+            self.dropped_ += 1
+
+    def start(self):
+        with self.mutex_:
+            if self.thread_ is not None:
+                return
+            self.thread_ = threading.Thread(target = self.run)
+            self.thread_.daemon = True
+            self.thread_.start()
+        # don't lose the last lines when the process exits
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval_)
+            self.flush()
+
+    def flush(self):
+        with self.mutex_:
+            # path -> lines
+            batch = collections.defaultdict(list)
+            while True:
+                try:
+                    path, created, level, name, msg, args = self.queue_.get_nowait()
+                except queue.Empty:
+                    break
+                # formatting is done here, not by whoever logged the line
+                if args:
+                    msg = msg % args
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
+                batch[path].append("%s.%03d %s %s : %s\n" % (stamp, created % 1 * 1000,
+                                   NAMES[level], name, msg))
+            for path, lines in batch.items():
+                try:
+                    with open(path, "a") as f:
+                        f.write("".join(lines))
+                except (IOError, OSError) as e:
+                    sys.stderr.write("can't write log %s: %s\n" % (path, e))
+            if self.dropped_:
+                sys.stderr.write("%d log lines dropped\n" % self.dropped_)
+                self.dropped_ = 0
+
+# shared by every Logger in the process
+writer = Writer()
+
+# Logs to a file through the writer, below its level a call costs a
+# comparison. Messages are only formatted (msg % args) if they are written.
+class Logger(object):
+    def __init__(self, name, path, level = LOG_LEVEL):
+        self.name_ = name
+        self.path_ = path
+        self.set_level(level)
+
+    def set_level(self, level):
+        # a name ('debug', ...) or one of the constants
+        self.level_ = LEVELS[level] if isinstance(level, str) else level
+
+    def debug(self, msg, *args):
+        if self.level_ <= DEBUG:
+            writer.put((self.path_, time.time(), DEBUG, self.name_, msg, args))
+
+    def info(self, msg, *args):
+        if self.level_ <= INFO:
+            writer.put((self.path_, time.time(), INFO, self.name_, msg, args))
+
+    def warning(self, msg, *args):
+        if self.level_ <= WARNING:
+            writer.put((self.path_, time.time(), WARNING, self.name_, msg, args))
+
+    def error(self, msg, *args):
+        if self.level_ <= ERROR:
+            writer.put((self.path_, time.time(), ERROR, self.name_, msg, args))
@@ -1,21 +1,24 @@
+import json
+import base64
 import socket
+import struct
+
+import chunks
+from settings import LOGSIZE, BUFFER_SIZE
 
 # ===== READ FROM SOCKET =====
 def read_from_socket(s):
     """Reads from socket until CRLF is received."""
-    result = ""
-    while True:
+    result = bytearray()
+    while not result.endswith(b"\r\n"):
         data = s.recv(256)
         if not data:
-            break
-        # Convert bytes → string
-        if isinstance(data, bytes):
-            data = data.decode("utf-8")
+            # connections are kept alive, so an EOF before the CRLF means the
+            # peer went away rather than the end of the message
+            raise socket.error("connection closed by peer")
         result += data
-        if result.endswith("\r\n"):
-            result = result[:-2]  # remove CRLF
-            break
-    return result
+    # decode once, a multibyte character may be split between two chunks
+    return result[:-2].decode("utf-8")
 
 
 # ===== SEND TO SOCKET =====
@@ -28,3 +31,355 @@ def send_to_socket(s, msg):
     else:
         msg = str(msg).encode("utf-8")
     s.sendall(msg + b"\r\n")
+
+
+# ===== BINARY PROTOCOL =====
+# A client switches a connection to binary framing by sending MAGIC as its
+# very first bytes, the server confirms by answering MAGIC. No text request
+# starts with a NUL, so both kinds of clients can talk to the same server.
+# After that every request and reply is a frame:
+#   length of the body (4 bytes), request id (4 bytes), opcode (1 byte),
+#   virtual node (1 byte), body
+# A reply carries the id of its request, so many requests can be in flight
+# on one connection and their replies can come back in any order. The
+# virtual node says which of the nodes sharing the socket a request is for
+# (see vnodes.py), it is 0 in replies.
+MAGIC = b"\x00CHB6"
+HEADER = struct.Struct("!IIBB")
+
+# kind of the arguments / replies of each command
+NONE, ID, ADDRESS, ADDRESSES, JSON, TEXT, LOOKUP, ROUTE, IDS, BLOCK = range(10)
+# LOOKUP is (id, hops so far), ROUTE is (address, hops it took, id of the
+# node before it), IDS a list of ids, BLOCK is (meta, data): a small JSON header and raw bytes after it
+# (the DFS blocks, see dht.py). The data goes compressed (a codec tag, then
+# the payload) when that makes it smaller, see chunks.py
+
+# command -> (opcode, argument, reply)
+COMMANDS = {
+    '': (0, NONE, NONE), # ping
+    'get_successor': (1, NONE, ADDRESS),
+    'get_predecessor': (2, NONE, ADDRESS),
+    'find_successor': (3, ID, ADDRESS),
+    'closest_preceding_finger': (4, ID, ADDRESS),
+    'notify': (5, ADDRESS, NONE),
+    'get_successors': (6, NONE, ADDRESSES),
+    'stats': (7, NONE, JSON),
+    'shutdown': (8, NONE, NONE),
+    'find_successor_recursive': (9, LOOKUP, ROUTE),
+    # the successors of many ids, in the same order
+    'find_successors_batch': (10, IDS, ADDRESSES),
+}
+# commands registered by the upper layers (see Local.register_command) are
+# sent with this opcode and their name in front of the body, text unless
+# they were declared with user_command
+OP_USER = 255
+USER_COMMAND = (OP_USER, TEXT, TEXT)
+USER_COMMANDS = {}
+# reply telling the request failed on the other end, the body says why
+OP_ERROR = 254
+OPCODES = dict((opcode, command) for command, (opcode, _, _) in COMMANDS.items())
+
+ID_BYTES = (LOGSIZE + 7) // 8
+# addresses are (host, port, virtual node): the host as it was given (an
+# IPv4 or IPv6 address, or a name) after its length, then the port and the
+# virtual node
+HOST = struct.Struct("!B")
+PORT = struct.Struct("!HB")
+HOPS = struct.Struct("!B")
+# length of the header of a BLOCK, the top bit says the data is compressed
+META = struct.Struct("!I")
+COMPRESSED = 1<<31
+
+# the request failed on the other end (say it went to a virtual node that
+# is gone), the connection itself is fine
+class RemoteError(socket.error):
+    pass
+
+# commands that may wait on other nodes while they are handled (a lookup
+# going on, a write waiting for the replicas), the server runs them on
+# workers of their own (see Server)
+FORWARDING = set(['find_successor', 'find_successor_recursive', 'find_successors_batch'])
+
+def user_command(command, argument, reply, forwards = False):
+    """Upper layer command whose argument and reply aren't text. With
+    forwards handling it may call other nodes"""
+    USER_COMMANDS[command] = (OP_USER, argument, reply)
+    if forwards:
+        FORWARDING.add(command)
+
+def command_kinds(command):
+    return COMMANDS.get(command) or USER_COMMANDS.get(command, USER_COMMAND)
+
+def endpoint(value):
+    """(ip, port[, virtual node]) -> (ip, port, virtual node)"""
+    return (value[0], value[1], value[2] if len(value) > 2 else 0)
+
+def pack_address(value):
+    host = value[0].encode("utf-8")
+    return HOST.pack(len(host)) + host + PORT.pack(value[1], value[2])
+
+def unpack_address(body, offset = 0):
+    """-> ((host, port, virtual node), offset of what follows)"""
+    start = offset + HOST.size
+    end = start + HOST.unpack_from(body, offset)[0]
+    port, vnode = PORT.unpack_from(body, end)
+    return (str(body[start:end], "utf-8"), port, vnode), end + PORT.size
+
+def encode(kind, value):
+    """Python value -> frame body"""
+    if kind == NONE or value is None:
+        return b""
+    if kind == ID:
+        return value.to_bytes(ID_BYTES, "big")
+    if kind == ADDRESS:
+        return pack_address(value)
+    if kind == ADDRESSES:
+        return b"".join(pack_address(address) for address in value)
+    if kind == JSON:
+        return json.dumps(value).encode("utf-8")
+    if kind == LOOKUP:
+        return value[0].to_bytes(ID_BYTES, "big") + HOPS.pack(value[1])
+    if kind == IDS:
+        return b"".join(id.to_bytes(ID_BYTES, "big") for id in value)
+    if kind == ROUTE:
+        address, hops, start = value
+        return pack_address(address) + HOPS.pack(hops) + start.to_bytes(ID_BYTES, "big")
+    if kind == BLOCK:
+        # data may be a memoryview on a bigger block, it is copied once
+        meta, data = value
+        meta = json.dumps(meta).encode("utf-8")
+        tag, payload = chunks.compress(data, fast = True)
+        if tag == chunks.RAW:
+            return b"".join((META.pack(len(meta)), meta, data))
+        return b"".join((META.pack(len(meta) | COMPRESSED), meta, tag, payload))
+    return value.encode("utf-8")
+
+def decode(kind, body):
+    """Frame body (bytes or memoryview) -> Python value"""
+    if kind == NONE:
+        return None
+    if kind == ID:
+        return int.from_bytes(body, "big")
+    if kind == ADDRESS:
+        if not len(body):
+            return None
+        return unpack_address(body)[0]
+    if kind == ADDRESSES:
+        addresses, offset = [], 0
+        while offset < len(body):
+            address, offset = unpack_address(body, offset)
+            addresses.append(address)
+        return addresses
+    if kind == JSON:
+        return json.loads(str(body, "utf-8"))
+    if kind == LOOKUP:
+        return int.from_bytes(body[:ID_BYTES], "big"), body[ID_BYTES]
+    if kind == IDS:
+        return [int.from_bytes(body[i:i + ID_BYTES], "big") for i in range(0, len(body), ID_BYTES)]
+    if kind == ROUTE:
+        address, offset = unpack_address(body)
+        return address, body[offset], int.from_bytes(body[offset + 1:offset + 1 + ID_BYTES], "big")
+    if kind == BLOCK:
+        length = META.unpack_from(body)[0]
+        end = META.size + (length & ~COMPRESSED)
+        meta = json.loads(str(body[META.size:end], "utf-8"))
+        if length & COMPRESSED:
+            return meta, chunks.decompress(bytes(body[end:end + 1]), body[end + 1:])
+        # the body is a view on the read buffer, the data must outlive it
+        return meta, bytes(body[end:])
+    return str(body, "utf-8")
+
+def encode_request(command, value):
+    opcode, kind, _ = command_kinds(command)
+    body = encode(kind, value)
+    if opcode == OP_USER:
+        name = command.encode("utf-8")
+        body = bytes([len(name)]) + name + body
+    return opcode, body
+
+def decode_request(opcode, body):
+    """-> (command, argument)"""
+    if opcode == OP_USER:
+        end = 1 + body[0]
+        command = str(body[1:end], "utf-8")
+        return command, decode(command_kinds(command)[1], body[end:])
+    command = OPCODES[opcode]
+    return command, decode(COMMANDS[command][1], body)
+
+def send_frame(s, request_id, opcode, body, vnode = 0):
+    header = HEADER.pack(len(body), request_id, opcode, vnode)
+    # don't copy big bodies just to glue the header in front of them
+    if len(body) < BUFFER_SIZE:
+        s.sendall(header + body)
+    else:
+        s.sendall(header)
+        s.sendall(body)
+
+# The text protocol carries the same values: arguments as plain strings
+# ("notify 127.0.0.1 4000 0") and replies as JSON. Requests for a virtual
+# node other than 0 start with "@<virtual node> ". A BLOCK is its header
+# with the data in base64 under 'raw'.
+def text_block(value):
+    meta, data = value
+    return json.dumps(dict(meta, raw = base64.b64encode(data).decode("ascii")))
+
+def block_text(text):
+    meta = json.loads(text)
+    return meta, base64.b64decode(meta.pop('raw', ""))
+
+def encode_text_request(command, value, vnode = 0):
+    _, kind, _ = command_kinds(command)
+    if kind == BLOCK:
+        value = text_block(value)
+    if kind == ADDRESS and value is not None:
+        value = "%s %s %s" % value
+    if kind == LOOKUP:
+        value = "%s %s" % value
+    if kind == IDS:
+        value = " ".join(str(id) for id in value)
+    request = command if kind == NONE or value is None else "%s %s" % (command, value)
+    if vnode:
+        request = "@%s %s" % (vnode, request)
+    return request
+
+def decode_text_request(request):
+    """-> (virtual node, command, argument)"""
+    vnode = 0
+    if request.startswith('@'):
+        target = request.split(' ')[0]
+        vnode = int(target[1:])
+        request = request[len(target) + 1:]
+    return (vnode,) + decode_text_command(request)
+
+def decode_text_command(request):
+    command = request.split(' ')[0]
+    # we take the command out
+    request = request[len(command) + 1:]
+    _, kind, _ = command_kinds(command)
+    if kind == NONE:
+        return command, None
+    if kind == ID:
+        return command, int(request)
+    if kind == ADDRESS:
+        ip, numbers = request.split(' ')[0], request.split(' ')[1:3]
+        return command, endpoint([ip] + [int(n) for n in numbers])
+    if kind == LOOKUP:
+        id, hops = request.split(' ')[:2]
+        return command, (int(id), int(hops))
+    if kind == IDS:
+        return command, [int(id) for id in request.split(' ') if id]
+    if kind == BLOCK:
+        return command, block_text(request)
+    return command, request
+
+def encode_text_reply(command, value):
+    _, _, kind = command_kinds(command)
+    if kind == TEXT:
+        return value
+    if kind == BLOCK:
+        return text_block(value)
+    if kind == ROUTE and value is not None:
+        # [ip, port, virtual node, hops, id of the node before it]
+        value = list(value[0]) + list(value[1:])
+    # defaul : "" = not respond anything
+    if value is None:
+        return json.dumps("")
+    return json.dumps(value)
+
+def decode_text_reply(command, reply):
+    _, _, kind = command_kinds(command)
+    if kind == TEXT:
+        return reply
+    if kind == BLOCK:
+        return block_text(reply)
+    value = json.loads(reply)
+    if value == "":
+        return [] if kind == ADDRESSES else None
+    if kind == ADDRESS:
+        return endpoint(value)
+    if kind == ADDRESSES:
+        return [endpoint(address) for address in value]
+    if kind == ROUTE:
+        return endpoint(value[:-2]), value[-2], value[-1]
+    return value
+
+# Reads lines or frames into a preallocated buffer instead of building
+# them chunk by chunk. What it returns is a view on that buffer and is only
+# valid until the next read.
+class BufferedReader(object):
+    def __init__(self, sock, size = BUFFER_SIZE):
+        self.socket_ = sock
+        self.buffer_ = bytearray(size)
+        self.view_ = memoryview(self.buffer_)
+        # unread data lives in buffer_[start_:end_]
+        self.start_ = 0
+        self.end_ = 0
+
+    def fill(self, needed = 1):
+        """One recv into the free space, making room for `needed` bytes"""
+        if self.start_ == self.end_:
+            self.start_ = self.end_ = 0
+        unread = self.end_ - self.start_
+        if len(self.buffer_) < needed or unread == len(self.buffer_):
+            # a message bigger than the buffer, grow it
+            buffer = bytearray(max(needed, 2 * len(self.buffer_)))
+            buffer[:unread] = self.view_[self.start_:self.end_]
+            self.buffer_ = buffer
+            self.view_ = memoryview(buffer)
+            self.start_, self.end_ = 0, unread
+        elif len(self.buffer_) - self.start_ < needed or self.end_ == len(self.buffer_):
+            # move what is left to the front
+            self.buffer_[:unread] = self.buffer_[self.start_:self.end_]
+            self.start_, self.end_ = 0, unread
+        n = self.socket_.recv_into(self.view_[self.end_:])
+        if not n:
+            raise socket.error("connection closed by peer")
+        self.end_ += n
+        return n
+
+    def peek(self, n):
+        """Up to n of the bytes buffered, without consuming them"""
+        return bytes(self.view_[self.start_:min(self.end_, self.start_ + n)])
+
+    def next_line(self):
+        """Returns a complete line (without CRLF) if we have one buffered"""
+        end = self.buffer_.find(b"\r\n", self.start_, self.end_)
+        if end < 0:
+            return None
+        line = str(self.view_[self.start_:end], "utf-8")
+        self.start_ = end + 2
+        return line
+
+    def next_frame(self):
+        """Returns (request id, opcode, virtual node, body) if we have a
+        complete frame buffered, otherwise (None, None, None, bytes needed)"""
+        available = self.end_ - self.start_
+        if available < HEADER.size:
+            return None, None, None, HEADER.size
+        length, request_id, opcode, vnode = HEADER.unpack_from(self.buffer_, self.start_)
+        if available < HEADER.size + length:
+            return None, None, None, HEADER.size + length
+        start = self.start_ + HEADER.size
+        self.start_ = start + length
+        return request_id, opcode, vnode, self.view_[start:self.start_]
+
+    def read_line(self):
+        line = self.next_line()
+        while line is None:
+            self.fill()
+            line = self.next_line()
+        return line
+
+    def read_frame(self):
+        request_id, opcode, vnode, body = self.next_frame()
+        while opcode is None:
+            self.fill(body)
+            request_id, opcode, vnode, body = self.next_frame()
+        return request_id, opcode, vnode, body
+
+    def read_exactly(self, n):
+        while self.end_ - self.start_ < n:
+            self.fill(n)
+        data = bytes(self.view_[self.start_:self.start_ + n])
+        self.start_ += n
+        return data
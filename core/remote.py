@@ -1,110 +1,390 @@
-import json
+import time
 import socket
+import struct
 import threading
+import weakref
+import collections
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 
 from address import Address
-from settings import SIZE
+from settings import SIZE, POOL_MAX_PEERS, POOL_MAX_IDLE, POOL_IDLE_TIMEOUT, RPC_TIMEOUT, WIRE_PROTOCOL
 from network import *
+from liveness import detector, ALIVE, UNKNOWN
 
-# decorator to make Remote's socket thread-safe
-def requires_connection(func):
-    """Initiates and cleans up connections with remote server"""
-    def inner(self, *args, **kwargs):
-        self.mutex_.acquire()
+# a keep-alive connection to a peer speaking the text protocol, replies
+# come back in order so it is used by one RPC at a time
+class Connection(object):
+    def __init__(self, address):
+        # peers answer with a bounded number of workers, a timeout makes
+        # sure we don't wait forever on a busy (or wedged) one
+        self.socket_ = socket.create_connection((address.ip, address.port), timeout = RPC_TIMEOUT)
+        self.socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader_ = BufferedReader(self.socket_)
+
+    def request(self, command, value = None, vnode = 0):
+        self.socket_.sendall(encode_text_request(command, value, vnode).encode("utf-8") + b"\r\n")
+        return decode_text_reply(command, self.reader_.read_line())
+
+    def close(self):
+        self.socket_.close()
+
+# a keep-alive connection to a peer speaking the binary protocol, shared by
+# every thread talking to that peer. Requests carry an id, a reader thread
+# hands each reply to whoever is waiting for that id, so a slow request
+# doesn't hold back the ones sent after it.
+class Channel(object):
+    def __init__(self, address):
+        self.address_ = address
+        self.socket_ = socket.create_connection((address.ip, address.port), timeout = RPC_TIMEOUT)
+        self.socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader_ = BufferedReader(self.socket_)
+        try:
+            self.socket_.sendall(MAGIC)
+            if self.reader_.read_exactly(len(MAGIC)) != MAGIC:
+                raise socket.error("%s doesn't speak the binary protocol" % address)
+        except socket.error:
+            self.socket_.close()
+            raise
+        # protects waiting_, next_id_ and closed_
+        self.mutex_ = threading.Lock()
+        # frames of concurrent requests must not be mixed on the wire
+        self.send_mutex_ = threading.Lock()
+        # request id -> (future, reply kind)
+        self.waiting_ = {}
+        self.next_id_ = 0
+        self.closed_ = False
+        self.last_used_ = time.time()
+        self.thread_ = threading.Thread(target = self.read_replies)
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def request(self, command, value = None, vnode = 0):
+        opcode, body = encode_request(command, value)
+        future = Future()
+        with self.mutex_:
+            if self.closed_:
+                raise socket.error("connection to %s is closed" % self.address_)
+            request_id = self.next_id_
+            self.next_id_ = (self.next_id_ + 1) & 0xffffffff
+            self.waiting_[request_id] = (future, command_kinds(command)[2])
+            self.last_used_ = time.time()
+        try:
+            with self.send_mutex_:
+                send_frame(self.socket_, request_id, opcode, body, vnode)
+        except socket.error as e:
+            # we don't know how much of the frame went out, nothing after
+            # it can be trusted
+            self.fail(e)
+            raise
         try:
-            self.open_connection()
-            ret = func(self, *args, **kwargs)
-        finally:
-            self.close_connection()
-            self.mutex_.release()
-        return ret
-    return inner
+            return future.result(RPC_TIMEOUT)
+        except FutureTimeout:
+            with self.mutex_:
+                self.waiting_.pop(request_id, None)
+            # the reply may still come, it will just be thrown away
+            raise socket.timeout("no reply to '%s' from %s" % (command, self.address_))
 
+    def read_replies(self):
+        while True:
+            try:
+                request_id, opcode, _, body = self.reader_.read_frame()
+            except socket.timeout:
+                # nothing to read for a while, that's fine
+                if self.closed_:
+                    return
+                continue
+            except (socket.error, ValueError) as e:
+                self.fail(e)
+                return
+            with self.mutex_:
+                future, kind = self.waiting_.pop(request_id, (None, None))
+            if future is None:
+                continue
+            if opcode == OP_ERROR:
+                future.set_exception(RemoteError(str(body, "utf-8")))
+                continue
+            try:
+                future.set_result(decode(kind, body))
+            except (ValueError, KeyError, IndexError, struct.error) as e:
+                future.set_exception(socket.error("bad reply: %s" % e))
 
-# class representing a remote peer
-class Remote(object):
-    def __init__(self, remote_address):
-        self.address_ = remote_address
+    def in_flight(self):
+        return len(self.waiting_)
+
+    def fail(self, error):
+        """Closes the channel, every request waiting on it gets error"""
+        with self.mutex_:
+            self.closed_ = True
+            waiting = list(self.waiting_.values())
+            self.waiting_.clear()
+        for future, _ in waiting:
+            if not isinstance(error, socket.error):
+                error = socket.error(str(error))
+            future.set_exception(error)
+        try:
+            # wakes up the reader thread
+            self.socket_.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket_.close()
+
+    def close(self):
+        self.fail(socket.error("connection to %s closed" % self.address_))
+
+# keeps idle keep-alive connections to remote peers so that RPCs don't pay
+# for a new TCP connection (and a TIME_WAIT entry) every time
+class ConnectionPool(object):
+    def __init__(self, max_peers = POOL_MAX_PEERS, max_idle = POOL_MAX_IDLE,
+                 idle_timeout = POOL_IDLE_TIMEOUT):
+        self.max_peers_ = max_peers
+        self.max_idle_ = max_idle
+        self.idle_timeout_ = idle_timeout
         self.mutex_ = threading.Lock()
-        self.socket_ = None
+        # (ip, port) -> [(connection, last time used)], least recently used peer first
+        self.idle_ = collections.OrderedDict()
 
-    def open_connection(self):
-        self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket_.connect((self.address_.ip, self.address_.port))
+    def acquire(self, address):
+        """Returns (connection, reused), reused connections might have been
+        closed by the other end in the meantime"""
+        key = (address.ip, address.port)
+        stale = []
+        found = None
+        now = time.time()
+        with self.mutex_:
+            conns = self.idle_.get(key, [])
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout_:
+                    found = conn
+                    break
+                stale.append(conn)
+        close_all(stale)
+        if found:
+            return found, True
+        return Connection(address), False
 
-    def close_connection(self):
-        if self.socket_:
-            self.socket_.close()
-            self.socket_ = None
+    def release(self, address, conn):
+        key = (address.ip, address.port)
+        dropped = []
+        with self.mutex_:
+            conns = self.idle_.setdefault(key, [])
+            self.idle_.move_to_end(key)
+            if len(conns) < self.max_idle_:
+                conns.append((conn, time.time()))
+            else:
+                dropped.append(conn)
+            # bound the number of peers we keep connections to
+            while len(self.idle_) > self.max_peers_:
+                _, conns = self.idle_.popitem(last = False)
+                dropped += [idle for idle, _ in conns]
+        close_all(dropped)
+
+    def failed(self, address, conn, error):
+        # a late reply would be taken for the answer to the next request, so
+        # the connection goes even on a timeout
+        close_all([conn])
+        self.evict(address)
+
+    def evict(self, address):
+        """Drops every idle connection to a peer, used when it looks dead"""
+        with self.mutex_:
+            conns = self.idle_.pop((address.ip, address.port), [])
+        close_all([conn for conn, _ in conns])
+
+    def clear(self):
+        with self.mutex_:
+            conns = [conn for peer in self.idle_.values() for conn, _ in peer]
+            self.idle_.clear()
+        close_all(conns)
+
+# one shared Channel per peer
+class ChannelPool(object):
+    def __init__(self, max_peers = POOL_MAX_PEERS, idle_timeout = POOL_IDLE_TIMEOUT):
+        self.max_peers_ = max_peers
+        self.idle_timeout_ = idle_timeout
+        self.mutex_ = threading.Lock()
+        # (ip, port) -> channel, least recently used peer first
+        self.channels_ = collections.OrderedDict()
+
+    def acquire(self, address):
+        """Returns (channel, reused)"""
+        key = (address.ip, address.port)
+        dropped = []
+        with self.mutex_:
+            channel = self.channels_.get(key)
+            if channel and not channel.closed_ and \
+               (channel.in_flight() or time.time() - channel.last_used_ < self.idle_timeout_):
+                self.channels_.move_to_end(key)
+                return channel, True
+            if channel:
+                dropped.append(self.channels_.pop(key))
+        close_all(dropped)
+        channel = Channel(address)
+        with self.mutex_:
+            other = self.channels_.get(key)
+            if other and not other.closed_:
+                # somebody else connected in the meantime, use theirs
+                dropped = [channel]
+                channel = other
+            else:
+                self.channels_[key] = channel
+                dropped = self.bound()
+        close_all(dropped)
+        return channel, False
+
+    def bound(self):
+        # bound the number of peers we keep connections to, channels with
+        # requests in flight are left alone
+        dropped = []
+        for key, channel in list(self.channels_.items()):
+            if len(self.channels_) <= self.max_peers_:
+                break
+            if not channel.in_flight():
+                dropped.append(self.channels_.pop(key))
+        return dropped
+
+    def release(self, address, channel):
+        pass
+
+    def failed(self, address, channel, error):
+        # a late reply is matched by id and thrown away, so a timeout
+        # doesn't make the channel useless, neither does an error reply
+        if isinstance(error, (socket.timeout, RemoteError)):
+            return
+        close_all([channel])
+        with self.mutex_:
+            key = (address.ip, address.port)
+            if self.channels_.get(key) is channel:
+                del self.channels_[key]
+
+    def evict(self, address):
+        with self.mutex_:
+            channel = self.channels_.pop((address.ip, address.port), None)
+        if channel:
+            close_all([channel])
+
+    def clear(self):
+        with self.mutex_:
+            channels = list(self.channels_.values())
+            self.channels_.clear()
+        close_all(channels)
+
+def close_all(connections):
+    for conn in connections:
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+# shared by every Remote in the process
+pool = ChannelPool() if WIRE_PROTOCOL == 'binary' else ConnectionPool()
+
+
+# (ip, port, virtual node) -> Remote, every peer is a single object shared by all the
+# finger tables, successor lists and replies that point to it. It goes away
+# when nothing points to it anymore.
+registry = weakref.WeakValueDictionary()
+
+def to_remote(address):
+    # address is (ip, port[, virtual node]), as found in replies
+    if address is None:
+        return None
+    address = endpoint(address)
+    remote = registry.get(address)
+    if remote is None:
+        # two threads may race here, whichever wins is just as good
+        remote = registry.setdefault(address, Remote(Address(*address)))
+    return remote
+
+# class representing a remote peer, it holds no connection of its own so
+# any number of threads can call it at the same time
+class Remote(object):
+    __slots__ = ('address_', 'id_', '__weakref__')
+
+    def __init__(self, remote_address):
+        self.address_ = remote_address
+        self.id_ = remote_address.id_
 
     def __str__(self):
         return f"Remote {self.address_}"
 
     def id(self, offset=0):
-        return (self.address_.__hash__() + offset) % SIZE
-
-    def send(self, msg):
-        if isinstance(msg, str):
-            msg = msg.encode("utf-8")
-        self.socket_.sendall(msg + b"\r\n")
+        if not offset:
+            return self.id_
+        return (self.id_ + offset) % SIZE
 
-    def recv(self):
-        # we used to have more complicated logic here
-        # and we might have again, so I'm not getting rid of this yet
-        return read_from_socket(self.socket_)
+    def call(self, command, value = None):
+        # arguments and replies are plain values, network.py knows how to
+        # put them on the wire
+        while True:
+            try:
+                conn, reused = pool.acquire(self.address_)
+            except socket.error:
+                detector.failed(self.address_)
+                raise
+            try:
+                response = conn.request(command, value, self.address_.vnode)
+            except socket.error as e:
+                pool.failed(self.address_, conn, e)
+                # a pooled connection may have been closed on the other end
+                # while idle, in that case try again with a fresh one
+                if reused and not isinstance(e, (socket.timeout, RemoteError)):
+                    continue
+                detector.failed(self.address_)
+                raise
+            pool.release(self.address_, conn)
+            # every answer tells us the peer is alive
+            detector.alive(self.address_)
+            return response
 
     def ping(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.address_.ip, self.address_.port))
-            s.sendall(b"\r\n")
-            s.close()
+            self.call("")
             return True
         except socket.error:
             return False
 
-    @requires_connection
+    def alive(self):
+        # what the failure detector knows, only peers it knows nothing
+        # recent about are pinged
+        state = detector.state(self.address_)
+        if state == UNKNOWN:
+            return self.ping()
+        return state == ALIVE
+
     def command(self, msg):
-        self.send(msg)
-        response = self.recv()
-        return response
+        # commands registered by the upper layers, "name request"
+        command = msg.split(' ')[0]
+        return self.call(command, msg[len(command) + 1:])
 
-    @requires_connection
     def get_successors(self):
-        self.send("get_successors")
-        response = self.recv()
-        if response == "":
-            return []
-        response = json.loads(response)
-        return [Remote(Address(address[0], address[1])) for address in response]
-
-    @requires_connection
+        return [to_remote(address) for address in self.call("get_successors")]
+
     def successor(self):
-        self.send("get_successor")
-        response = json.loads(self.recv())
-        return Remote(Address(response[0], response[1]))
+        return to_remote(self.call("get_successor"))
 
-    @requires_connection
     def predecessor(self):
-        self.send("get_predecessor")
-        response = self.recv()
-        if response == "":
-            return None
-        response = json.loads(response)
-        return Remote(Address(response[0], response[1]))
-
-    @requires_connection
+        return to_remote(self.call("get_predecessor"))
+
     def find_successor(self, id):
-        self.send(f"find_successor {id}")
-        response = json.loads(self.recv())
-        return Remote(Address(response[0], response[1]))
+        return to_remote(self.call("find_successor", id))
+
+    def find_successors_batch(self, ids):
+        # {id: successor}, with a single request
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return {}
+        return dict(zip(ids, [to_remote(address) for address in self.call("find_successors_batch", ids)]))
+
+    def find_successor_recursive(self, id, hops = 0):
+        address, hops, start = self.call("find_successor_recursive", (id, hops))
+        return to_remote(address), hops, start
 
-    @requires_connection
     def closest_preceding_finger(self, id):
-        self.send(f"closest_preceding_finger {id}")
-        response = json.loads(self.recv())
-        return Remote(Address(response[0], response[1]))
+        return to_remote(self.call("closest_preceding_finger", id))
 
-    @requires_connection
     def notify(self, node):
-        self.send(f"notify {node.address_.ip} {node.address_.port}")
+        self.call("notify", node.address_.as_tuple())
+
+    def stats(self):
+        return self.call("stats")
@@ -0,0 +1,290 @@
+import socket
+import selectors
+import threading
+import traceback
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import SERVER_WORKERS, SERVER_FORWARDING_WORKERS, LISTEN_BACKLOG, CONN_IDLE_TIMEOUT
+from network import *
+
+# one accepted (keep-alive) connection
+class Connection(object):
+    def __init__(self, sock):
+        self.socket_ = sock
+        self.reader_ = BufferedReader(sock)
+        # text or binary framing, we don't know until the first bytes arrive
+        self.binary_ = None
+        # bytes the next frame needs to be complete
+        self.needed_ = 1
+        # binary requests carry an id and are all handled at once, replies go
+        # out as they are ready. Text replies go out in order, so only the
+        # first text request is being handled and the rest wait here
+        self.pending_ = collections.deque()
+        self.in_flight_ = 0
+        # workers replying at the same time must not mix their frames
+        self.send_mutex_ = threading.Lock()
+        self.closed_ = False
+        self.last_active_ = time.time()
+
+# Serves requests for one or more Locals (virtual nodes sharing the socket,
+# see vnodes.py). A single thread waits on the listening
+# socket and on every idle connection with a selector, complete requests
+# are handed to a bounded pool of workers so that a slow request (say a
+# find_successor going through a bunch of peers) doesn't block the rest.
+# Requests that call other nodes (FORWARDING) get a pool of their own: if
+# they shared one, a few nodes busy with them could take every worker and
+# wait on each other for the replies nobody is left to send.
+class Server(object):
+    def __init__(self, address, handler = None, workers = SERVER_WORKERS,
+                 forwarding_workers = SERVER_FORWARDING_WORKERS,
+                 backlog = LISTEN_BACKLOG, idle_timeout = CONN_IDLE_TIMEOUT):
+        # virtual node -> handler(command, argument) -> reply, as values
+        # (see network.py)
+        self.handlers_ = {}
+        if handler is not None:
+            self.handlers_[0] = handler
+        self.idle_timeout_ = idle_timeout
+        self.shutdown_ = False
+
+        self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # don't wait for old connections in TIME_WAIT when restarting a node
+        self.socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket_.bind((address.ip, int(address.port)))
+        self.socket_.listen(backlog)
+        self.socket_.setblocking(False)
+
+        # used to wake up the selector from other threads
+        self.wakeup_, self.waker_ = socket.socketpair()
+        self.wakeup_.setblocking(False)
+
+        self.selector_ = selectors.DefaultSelector()
+        self.selector_.register(self.socket_, selectors.EVENT_READ)
+        self.selector_.register(self.wakeup_, selectors.EVENT_READ)
+
+        self.workers_ = workers
+        self.executor_ = ThreadPoolExecutor(max_workers = workers)
+        self.forwarding_workers_ = forwarding_workers
+        self.forwarder_ = ThreadPoolExecutor(max_workers = forwarding_workers)
+        self.connections_ = set()
+
+        self.mutex_ = threading.Lock()
+        # per command: requests waiting for a worker, being handled, highest
+        # number ever waiting and total served
+        self.queued_ = collections.Counter()
+        self.active_ = collections.Counter()
+        self.max_queued_ = collections.Counter()
+        self.served_ = collections.Counter()
+
+    def serve_forever(self):
+        while not self.shutdown_:
+            for key, _ in self.selector_.select(timeout = 1):
+                if key.fileobj is self.socket_:
+                    self.accept()
+                elif key.fileobj is self.wakeup_:
+                    self.drain_wakeup()
+                else:
+                    self.read(key.data)
+            self.close_idle()
+        self.close()
+
+    def shutdown(self):
+        self.shutdown_ = True
+        self.wake()
+
+    def register(self, vnode, handler):
+        self.handlers_[vnode] = handler
+
+    def unregister(self, vnode):
+        self.handlers_.pop(vnode, None)
+        # the socket lives as long as some node uses it
+        if not self.handlers_:
+            self.shutdown()
+
+    def wake(self):
+        try:
+            self.waker_.send(b"\0")
+        except socket.error:
+            pass
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_.recv(256):
+                pass
+        except socket.error:
+            pass
+
+    def accept(self):
+        try:
+            sock, _ = self.socket_.accept()
+        except socket.error:
+            return
+        # a timeout keeps sockets non-blocking for the selector while
+        # letting workers use sendall
+        sock.settimeout(self.idle_timeout_)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock)
+        self.connections_.add(conn)
+        self.selector_.register(sock, selectors.EVENT_READ, conn)
+
+    def read(self, conn):
+        try:
+            conn.reader_.fill(conn.needed_)
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.drop(conn)
+            return
+        conn.last_active_ = time.time()
+        try:
+            if conn.binary_ is None and not self.negotiate(conn):
+                return
+            while True:
+                if conn.binary_:
+                    request_id, opcode, vnode, body = conn.reader_.next_frame()
+                    if opcode is None:
+                        conn.needed_ = body
+                        break
+                    command, argument = decode_request(opcode, body)
+                else:
+                    line = conn.reader_.next_line()
+                    if line is None:
+                        break
+                    request_id = None
+                    vnode, command, argument = decode_text_request(line)
+                self.enqueue(conn, request_id, vnode, command, argument)
+        except (ValueError, KeyError, IndexError, UnicodeDecodeError, socket.error):
+            # garbage on the wire, we can't make any sense of what follows
+            self.drop(conn)
+
+    def negotiate(self, conn):
+        # binary clients start with MAGIC, anything else speaks text
+        start = conn.reader_.peek(len(MAGIC))
+        if start[:1] != MAGIC[:1]:
+            conn.binary_ = False
+            return True
+        if len(start) < len(MAGIC):
+            return False
+        if start != MAGIC:
+            raise ValueError("unknown protocol")
+        conn.reader_.read_exactly(len(MAGIC))
+        conn.socket_.sendall(MAGIC)
+        conn.binary_ = True
+        return True
+
+    def enqueue(self, conn, request_id, vnode, command, argument):
+        with self.mutex_:
+            self.queued_[command] += 1
+            self.max_queued_[command] = max(self.max_queued_[command], self.queued_[command])
+            if not conn.binary_ and conn.in_flight_:
+                conn.pending_.append((request_id, vnode, command, argument))
+                return
+            conn.in_flight_ += 1
+        try:
+            self.executor(command).submit(self.work, conn, request_id, vnode, command, argument)
+        except RuntimeError:
+            # the executor is gone (interpreter exiting)
+            self.drop(conn)
+
+    def executor(self, command):
+        return self.forwarder_ if command in FORWARDING else self.executor_
+
+    def work(self, conn, request_id, vnode, command, argument):
+        with self.mutex_:
+            self.queued_[command] -= 1
+            self.active_[command] += 1
+        try:
+            handler = self.handlers_.get(vnode)
+            if handler is None:
+                # the node left (or never was), tell the client without
+                # dropping the requests it has for the other nodes
+                if not conn.binary_:
+                    raise socket.error("no virtual node %s" % vnode)
+                with conn.send_mutex_:
+                    send_frame(conn.socket_, request_id, OP_ERROR,
+                               ("no virtual node %s" % vnode).encode("utf-8"))
+                return
+            result = handler(command, argument)
+            if conn.binary_:
+                opcode, _, kind = command_kinds(command)
+                body = encode(kind, result)
+                with conn.send_mutex_:
+                    send_frame(conn.socket_, request_id, opcode, body)
+            else:
+                conn.socket_.sendall(encode_text_reply(command, result).encode("utf-8") + b"\r\n")
+            conn.last_active_ = time.time()
+        except socket.error:
+            self.abort(conn)
+        except Exception:
+            traceback.print_exc()
+            self.abort(conn)
+        finally:
+            if command == 'shutdown':
+                self.unregister(vnode)
+            self.done(conn, command)
+
+    def done(self, conn, command):
+        with self.mutex_:
+            self.active_[command] -= 1
+            self.served_[command] += 1
+            if not conn.pending_ or conn.closed_:
+                conn.in_flight_ -= 1
+                return
+            request_id, vnode, command, argument = conn.pending_.popleft()
+        try:
+            self.executor(command).submit(self.work, conn, request_id, vnode, command, argument)
+        except RuntimeError:
+            # the executor is gone, we are shutting down
+            pass
+
+    def abort(self, conn):
+        # only the selector thread touches the selector, so we just make
+        # the connection readable (EOF) and let it clean up
+        try:
+            conn.socket_.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def drop(self, conn):
+        if conn.closed_:
+            return
+        try:
+            self.selector_.unregister(conn.socket_)
+        except (KeyError, ValueError):
+            pass
+        with self.mutex_:
+            conn.closed_ = True
+            for _, _, command, _ in conn.pending_:
+                self.queued_[command] -= 1
+            conn.pending_.clear()
+        self.connections_.discard(conn)
+        conn.socket_.close()
+
+    def close_idle(self):
+        now = time.time()
+        for conn in list(self.connections_):
+            if not conn.in_flight_ and now - conn.last_active_ > self.idle_timeout_:
+                self.drop(conn)
+
+    def close(self):
+        # peers holding keep-alive connections to us must notice we are gone
+        for conn in list(self.connections_):
+            self.abort(conn)
+            self.drop(conn)
+        self.selector_.close()
+        self.socket_.close()
+        self.wakeup_.close()
+        self.waker_.close()
+        self.executor_.shutdown(wait = False)
+        self.forwarder_.shutdown(wait = False)
+
+    def stats(self):
+        with self.mutex_:
+            return {'workers': self.workers_,
+                    'forwarding_workers': self.forwarding_workers_,
+                    'connections': len(self.connections_),
+                    'queued': dict(+self.queued_),
+                    'active': dict(+self.active_),
+                    'max_queued': dict(self.max_queued_),
+                    'served': dict(self.served_)}
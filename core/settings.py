@@ -1,9 +1,14 @@
 # CONFIGURATION FILE
 
-# log size of the ring
-LOGSIZE = 8
+# log size of the ring (bits of an id), up to the size of the hash
+LOGSIZE = 32
 SIZE = 1<<LOGSIZE
 
+# hash giving ids to nodes and keys: 'sha1' (160 bits), 'md5' (128 bits)
+# or 'xxhash' (128 bits, needs the xxhash package). It must be the same on
+# every node of a ring.
+HASH_FUNCTION = 'sha1'
+
 # successors list size (to continue operating on node failures)
 N_SUCCESSORS = 4
 
@@ -24,3 +29,139 @@ UPDATE_SUCCESSORS_RET = 6
 # Find Successors
 FIND_SUCCESSOR_RET = 3
 FIND_PREDECESSOR_RET = 3
+
+# times a DHT client asks again when the owner of a key redirects it (the
+# ring is changing)
+DHT_REDIRECT_RET = 5
+
+# times a DFS client retries a compare and swap that lost against
+# another writer (see DFS.update)
+CAS_RET = 8
+
+# Replication: copies of every DHT key (the owner's included) kept on the
+# first successors, at most N_SUCCESSORS + 1. Reads at consistency ONE go
+# to any replica if REPLICA_READS (they may see an older copy)
+REPLICATION_FACTOR = 3
+REPLICA_READS = True
+
+# Consistency of DHT requests that don't ask for one: 'ONE' (the owner
+# alone, replicas are updated in the background), 'QUORUM' (a majority of
+# the copies) or 'ALL'
+READ_CONSISTENCY = 'ONE'
+WRITE_CONSISTENCY = 'ALL'
+
+# Key transfers (a node joining or leaving, or moved by the balancer) go
+# in chunks of about TRANSFER_CHUNK bytes, at most TRANSFER_RATE bytes per
+# second (0 for no limit) so requests still get through
+TRANSFER_CHUNK = 1<<18
+TRANSFER_RATE = 1<<23
+# a node pulling keys from us that doesn't ask for the next chunk in
+# TRANSFER_TTL seconds is gone, we forget where it was
+TRANSFER_TTL = 60
+
+# Storage of DHT blocks: 'memory' (lost on restart), 'log' (append only
+# log, mmap'd, with an index in memory) or 'sqlite'. Files are named after
+# STORAGE_PATH ({ip}, {port}, {vnode} and {id} are filled in), a log is
+# compacted once STORAGE_COMPACT_RATIO of it (and at least
+# STORAGE_COMPACT_MIN bytes) is overwritten or deleted records
+STORAGE_ENGINE = 'memory'
+STORAGE_PATH = "/tmp/chord-{port}-{vnode}"
+STORAGE_COMPACT_RATIO = 0.5
+STORAGE_COMPACT_MIN = 1<<24
+
+# DFS files are split in blocks of BLOCK_SIZE bytes, each one a DHT key.
+# Every node of a file system must use the same. Reads and writes of many
+# blocks go to their owners in parallel, at most PARALLEL_REQUESTS at once
+# and TRANSFER_CHUNK bytes per request
+BLOCK_SIZE = 1<<16
+PARALLEL_REQUESTS = 16
+
+# The names in a DFS directory are spread over DIRECTORY_BUCKETS keys (see
+# directory.py), readdir gets them DIRECTORY_PAGE at a time
+DIRECTORY_BUCKETS = 128
+DIRECTORY_PAGE = 1024
+
+# DFS blocks may be stored by content (STORAGE_DEDUP: identical blocks
+# once per node) and compressed one by one (COMPRESSION, see chunks.py):
+# zlib, lzma from COMPRESS_LZMA_MIN bytes on, nothing under COMPRESS_MIN
+# bytes or when it saves less than 1 - COMPRESS_RATIO. With COMPRESSION
+# frames carrying blocks are compressed on the wire too (zlib, fast). Both
+# cost CPU on every write (and COMPRESSION on every read), they are off
+# unless asked for
+STORAGE_DEDUP = False
+COMPRESSION = False
+COMPRESS_MIN = 512
+COMPRESS_LZMA_MIN = 1<<18
+COMPRESS_RATIO = 0.9
+
+# Block cache of DFS clients (see blockcache.py): bytes of blocks kept,
+# and blocks read ahead of sequential reads
+BLOCK_CACHE_SIZE = 1<<26
+READ_AHEAD = 16
+
+# Connection pool (keep-alive connections to remote peers)
+POOL_MAX_PEERS = 64
+POOL_MAX_IDLE = 4
+POOL_IDLE_TIMEOUT = 30
+
+# Seconds a served connection may stay idle before we close it, must be
+# larger than POOL_IDLE_TIMEOUT so clients drop their end first
+CONN_IDLE_TIMEOUT = 60
+
+# Server: workers answering requests concurrently and listen() backlog.
+# Requests that call other nodes while they are handled (lookups going on,
+# reads and writes waiting for replicas) have SERVER_FORWARDING_WORKERS of
+# their own, so they never hold up the ones answered right away, which
+# those other nodes may be sending us meanwhile. Beyond that many of them
+# at once the rest wait their turn, if they wait on each other across
+# nodes (a lookup going round, a joining node pulling what its successor
+# still pulls) they are only freed by RPC_TIMEOUT
+SERVER_WORKERS = 32
+SERVER_FORWARDING_WORKERS = 32
+LISTEN_BACKLOG = 128
+
+# Seconds we wait for a reply before giving up on a peer
+RPC_TIMEOUT = 10
+
+# Wire protocol used by Remote, 'binary' (length prefixed frames) or
+# 'text' (CRLF terminated lines). Servers understand both.
+WIRE_PROTOCOL = 'binary'
+# initial size of the buffers connections read into
+BUFFER_SIZE = 1<<16
+
+# Failure detector: seconds a peer that answered an RPC is taken for alive,
+# and seconds one that failed is taken for dead, before we ping it again
+LIVENESS_TTL = 3
+SUSPECT_TIMEOUT = 2
+
+# Logging: lowest level written ('debug', 'info', 'warning', 'error' or
+# 'off'), file of each node ({ip}, {port}, {vnode} and {id} are filled in,
+# virtual nodes of a host share its port), seconds between flushes and
+# lines buffered before we start dropping them
+LOG_LEVEL = 'info'
+LOG_FILE = "/tmp/chord-{port}-{vnode}.log"
+LOG_FLUSH_INT = 1
+LOG_QUEUE_SIZE = 100000
+
+# Lookups: iterative (the originator asks every hop) or recursive (every
+# hop forwards the query to the next one), can also be chosen per call
+RECURSIVE_LOOKUP = False
+
+# Lookup cache: ranges of the ring whose owner each node remembers, and
+# seconds we trust them (failures, redirects and ring changes we hear
+# about drop them earlier)
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_TTL = 10
+
+# Virtual nodes each Host (see vnodes.py) puts on the ring, more of them
+# spread the keys more evenly between hosts
+VNODES = 1
+
+# Load balancing (see balance.py): half life in seconds of the request
+# counts, seconds between balancing rounds, how many times busier than its
+# successor a node must be to give it keys, and requests per second below
+# which a node is never considered busy
+LOAD_HALF_LIFE = 30
+LOAD_BALANCE_INT = 10
+LOAD_IMBALANCE = 2.0
+LOAD_MIN_RATE = 1.0
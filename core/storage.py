@@ -0,0 +1,451 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import struct
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+import chunks
+from settings import STORAGE_ENGINE, STORAGE_COMPACT_RATIO, STORAGE_COMPACT_MIN
+
+# Where a DFS keeps its blocks, versions and attributes. Every engine is a
+# mapping from str keys to values (bytes, or anything json takes when the
+# codec is 'json'), safe to use from many threads, that counts what it does
+# so nodes can report memory footprint and throughput.
+CODECS = {
+    'bytes': (bytes, bytes),
+    'json': (lambda value: json.dumps(value).encode("utf-8"), lambda raw: json.loads(raw.decode("utf-8"))),
+}
+
+class Store(MutableMapping):
+    engine = None
+
+    def __init__(self, codec = 'bytes'):
+        self.encode_, self.decode_ = CODECS[codec]
+        self.mutex_ = threading.RLock()
+        # operations, bytes and seconds spent on them
+        self.reads_ = self.writes_ = 0
+        self.read_bytes_ = self.write_bytes_ = 0
+        self.read_time_ = self.write_time_ = 0.0
+
+    def size(self, key):
+        # bytes of the value under key (without reading it if we can)
+        return len(self.encode_(self[key]))
+
+    def memory(self):
+        """Bytes of RAM we take, about"""
+        return 0
+
+    def disk(self):
+        return 0
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        with self.mutex_:
+            return {'engine': self.engine, 'keys': len(self), 'memory': self.memory(), 'disk': self.disk(),
+                    'reads': self.reads_, 'writes': self.writes_,
+                    'read_mb_s': round(self.read_bytes_ / self.read_time_ / 1e6, 3) if self.read_time_ else None,
+                    'write_mb_s': round(self.write_bytes_ / self.write_time_ / 1e6, 3) if self.write_time_ else None}
+
+    def counted_read(self, size, since):
+        self.reads_ += 1
+        self.read_bytes_ += size
+        self.read_time_ += time.time() - since
+
+    def counted_write(self, size, since):
+        self.writes_ += 1
+        self.write_bytes_ += size
+        self.write_time_ += time.time() - since
+
+# everything in a dict, lost on restart
+class MemoryStore(Store):
+    engine = 'memory'
+
+    def __init__(self, codec = 'bytes'):
+        Store.__init__(self, codec)
+        self.items_ = {}
+
+    def __getitem__(self, key):
+        since = time.time()
+        value = self.items_[key]
+        self.counted_read(len(value) if isinstance(value, bytes) else 0, since)
+        return value
+
+    def __setitem__(self, key, value):
+        since = time.time()
+        with self.mutex_:
+            self.items_[key] = value
+            self.counted_write(len(value) if isinstance(value, bytes) else 0, since)
+
+    def __delitem__(self, key):
+        with self.mutex_:
+            del self.items_[key]
+
+    def __contains__(self, key):
+        return key in self.items_
+
+    def __iter__(self):
+        return iter(list(self.items_))
+
+    def __len__(self):
+        return len(self.items_)
+
+    def size(self, key):
+        value = self.items_[key]
+        return len(value) if isinstance(value, bytes) else len(self.encode_(value))
+
+    def memory(self):
+        with self.mutex_:
+            items = list(self.items_.items())
+        return sys.getsizeof(self.items_) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in items)
+
+# An append only log of (key, value) records, with an index (key -> where
+# its last value is) in memory and reads through mmap. Deleting appends a
+# tombstone. Once more than STORAGE_COMPACT_RATIO of the log is dead we
+# write the live records to a new log. A restart reads the record headers
+# only, a torn record at the end (a crash while appending) is cut off.
+class LogStore(Store):
+    engine = 'log'
+    # crc of the rest, key length, value length (TOMBSTONE if deleted)
+    RECORD = struct.Struct("!III")
+    TOMBSTONE = 0xffffffff
+
+    def __init__(self, path, codec = 'bytes'):
+        Store.__init__(self, codec)
+        self.path_ = path
+        # key -> (offset of the value, length)
+        self.index_ = {}
+        self.dead_ = 0
+        self.map_ = None
+        self.fd_ = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.end_ = self.recover()
+
+    def recover(self):
+        offset = 0
+        end = os.fstat(self.fd_).st_size
+        with open(self.path_, "rb") as log:
+            while offset + self.RECORD.size <= end:
+                log.seek(offset)
+                crc, key_length, value_length = self.RECORD.unpack(log.read(self.RECORD.size))
+                length = 0 if value_length == self.TOMBSTONE else value_length
+                if offset + self.RECORD.size + key_length + length > end:
+                    break
+                body = log.read(key_length + length)
+                if zlib.crc32(self.RECORD.pack(0, key_length, value_length)[4:] + body) != crc:
+                    break
+                key = body[:key_length].decode("utf-8")
+                if key in self.index_:
+                    self.dead_ += self.RECORD.size + len(key) + self.index_[key][1]
+                if value_length == self.TOMBSTONE:
+                    self.index_.pop(key, None)
+                    self.dead_ += self.RECORD.size + key_length
+                else:
+                    self.index_[key] = (offset + self.RECORD.size + key_length, length)
+                offset += self.RECORD.size + key_length + length
+        if offset < end:
+            os.ftruncate(self.fd_, offset)
+        return offset
+
+    def append(self, key, value):
+        # returns the offset of value in the log
+        key = key.encode("utf-8")
+        value_length = self.TOMBSTONE if value is None else len(value)
+        body = key + (value or b"")
+        crc = zlib.crc32(self.RECORD.pack(0, len(key), value_length)[4:] + body)
+        os.write(self.fd_, self.RECORD.pack(crc, len(key), value_length) + body)
+        offset = self.end_ + self.RECORD.size + len(key)
+        self.end_ = offset + len(value or b"")
+        return offset
+
+    def __getitem__(self, key):
+        since = time.time()
+        with self.mutex_:
+            offset, length = self.index_[key]
+            if self.map_ is None or offset + length > len(self.map_):
+                # the log grew since we mapped it
+                if self.map_ is not None:
+                    self.map_.close()
+                self.map_ = mmap.mmap(self.fd_, self.end_, access = mmap.ACCESS_READ)
+            raw = self.map_[offset:offset + length]
+        self.counted_read(length, since)
+        return self.decode_(raw)
+
+    def __setitem__(self, key, value):
+        since = time.time()
+        raw = self.encode_(value)
+        with self.mutex_:
+            if key in self.index_:
+                self.dead_ += self.RECORD.size + len(key) + self.index_[key][1]
+            self.index_[key] = (self.append(key, raw), len(raw))
+            self.counted_write(len(raw), since)
+            self.compact()
+
+    def __delitem__(self, key):
+        with self.mutex_:
+            offset, length = self.index_.pop(key)
+            self.append(key, None)
+            self.dead_ += 2 * self.RECORD.size + 2 * len(key) + length
+            self.compact()
+
+    def __contains__(self, key):
+        return key in self.index_
+
+    def __iter__(self):
+        return iter(list(self.index_))
+
+    def __len__(self):
+        return len(self.index_)
+
+    def size(self, key):
+        return self.index_[key][1]
+
+    def compact(self):
+        if self.end_ < STORAGE_COMPACT_MIN or self.dead_ < STORAGE_COMPACT_RATIO * self.end_:
+            return
+        path = self.path_ + ".compact"
+        if self.map_ is None or len(self.map_) < self.end_:
+            if self.map_ is not None:
+                self.map_.close()
+            self.map_ = mmap.mmap(self.fd_, self.end_, access = mmap.ACCESS_READ)
+        old = (self.fd_, self.map_, self.index_)
+        self.fd_ = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self.end_ = self.dead_ = 0
+        self.index_ = {}
+        for key, (offset, length) in old[2].items():
+            self.index_[key] = (self.append(key, old[1][offset:offset + length]), length)
+        os.fsync(self.fd_)
+        os.rename(path, self.path_)
+        old[1].close()
+        os.close(old[0])
+        self.map_ = None
+
+    def memory(self):
+        with self.mutex_:
+            index = list(self.index_.items())
+        return sys.getsizeof(self.index_) + sum(sys.getsizeof(key) + sys.getsizeof(where) + 2 * sys.getsizeof(where[0])
+                                                for key, where in index)
+
+    def disk(self):
+        return self.end_
+
+    def sync(self):
+        os.fsync(self.fd_)
+
+    def close(self):
+        with self.mutex_:
+            if self.map_ is not None:
+                self.map_.close()
+                self.map_ = None
+            os.fsync(self.fd_)
+            os.close(self.fd_)
+
+# A table in a SQLite database (write ahead log, no fsync on every commit),
+# SQLite keeps its own page cache
+class SQLiteStore(Store):
+    engine = 'sqlite'
+
+    def __init__(self, path, codec = 'bytes'):
+        Store.__init__(self, codec)
+        self.path_ = path
+        self.db_ = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.db_.execute("PRAGMA journal_mode = WAL")
+        self.db_.execute("PRAGMA synchronous = NORMAL")
+        self.db_.execute("CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, value BLOB)")
+        self.length_ = self.db_.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def __getitem__(self, key):
+        since = time.time()
+        with self.mutex_:
+            row = self.db_.execute("SELECT value FROM items WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self.counted_read(len(row[0]), since)
+        return self.decode_(bytes(row[0]))
+
+    def __setitem__(self, key, value):
+        since = time.time()
+        raw = self.encode_(value)
+        with self.mutex_:
+            new = self.db_.execute("SELECT 1 FROM items WHERE key = ?", (key,)).fetchone() is None
+            self.db_.execute("INSERT OR REPLACE INTO items VALUES (?, ?)", (key, raw))
+            self.length_ += new
+            self.counted_write(len(raw), since)
+
+    def __delitem__(self, key):
+        with self.mutex_:
+            if not self.db_.execute("DELETE FROM items WHERE key = ?", (key,)).rowcount:
+                raise KeyError(key)
+            self.length_ -= 1
+
+    def __contains__(self, key):
+        with self.mutex_:
+            return self.db_.execute("SELECT 1 FROM items WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.mutex_:
+            return iter([row[0] for row in self.db_.execute("SELECT key FROM items")])
+
+    def __len__(self):
+        return self.length_
+
+    def size(self, key):
+        with self.mutex_:
+            row = self.db_.execute("SELECT LENGTH(value) FROM items WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def memory(self):
+        # the pages SQLite may cache, at most
+        with self.mutex_:
+            page_size = self.db_.execute("PRAGMA page_size").fetchone()[0]
+            pages = self.db_.execute("PRAGMA page_count").fetchone()[0]
+            cache = self.db_.execute("PRAGMA cache_size").fetchone()[0]
+        # a negative cache size is in KiB
+        limit = -cache * 1024 if cache < 0 else cache * page_size
+        return min(limit, pages * page_size)
+
+    def disk(self):
+        return sum(os.path.getsize(self.path_ + suffix) for suffix in ("", "-wal")
+                   if os.path.exists(self.path_ + suffix))
+
+    def close(self):
+        with self.mutex_:
+            self.db_.close()
+
+# Blocks kept by content: key -> [name of its chunk, size] in refs, chunk
+# name (a digest of the content) -> the block, compressed (see chunks.py),
+# in chunks. Identical blocks are kept once, we count the keys pointing to
+# each chunk and the last one to go takes the chunk with it. Without dedup
+# a chunk is named after its key. A chunk is written before the key points
+# to it, chunks nobody points to (a crash in between) go on restart.
+class ChunkStore(Store):
+    def __init__(self, chunk_store, refs, dedup = True):
+        Store.__init__(self)
+        self.engine = chunk_store.engine
+        self.chunks_ = chunk_store
+        self.refs_ = refs
+        self.dedup_ = dedup
+        # chunk -> keys pointing to it
+        self.counts_ = {}
+        # bytes of the blocks, and of their chunks
+        self.logical_ = self.stored_ = 0
+        # blocks that were already there
+        self.shared_ = 0
+        for key in self.refs_:
+            name, size = self.refs_[key]
+            self.counts_[name] = self.counts_.get(name, 0) + 1
+            self.logical_ += size
+        for name in self.chunks_:
+            if name in self.counts_:
+                self.stored_ += self.chunks_.size(name)
+            else:
+                del self.chunks_[name]
+
+    def __getitem__(self, key):
+        since = time.time()
+        with self.mutex_:
+            name, size = self.refs_[key]
+            chunk = self.chunks_[name]
+        value = chunks.unpack(chunk)
+        self.counted_read(size, since)
+        return value
+
+    def __setitem__(self, key, value):
+        since = time.time()
+        value = bytes(value)
+        name = chunks.digest(value) if self.dedup_ else key
+        with self.mutex_:
+            old = self.refs_.get(key)
+            if old is not None and old[0] == name and self.dedup_:
+                # same content
+                self.counted_write(len(value), since)
+                return
+            if old is not None and not self.dedup_:
+                # the chunk is rewritten below
+                self.unref(name)
+            if name in self.counts_:
+                self.shared_ += 1
+            else:
+                chunk = chunks.pack(value)
+                self.chunks_[name] = chunk
+                self.stored_ += len(chunk)
+            self.counts_[name] = self.counts_.get(name, 0) + 1
+            self.refs_[key] = [name, len(value)]
+            self.logical_ += len(value) - (old[1] if old is not None else 0)
+            if old is not None and self.dedup_:
+                self.unref(old[0])
+            self.counted_write(len(value), since)
+
+    def __delitem__(self, key):
+        with self.mutex_:
+            name, size = self.refs_[key]
+            del self.refs_[key]
+            self.logical_ -= size
+            self.unref(name)
+
+    def unref(self, name):
+        self.counts_[name] -= 1
+        if not self.counts_[name]:
+            del self.counts_[name]
+            self.stored_ -= self.chunks_.size(name)
+            del self.chunks_[name]
+
+    def __contains__(self, key):
+        return key in self.refs_
+
+    def __iter__(self):
+        return iter(self.refs_)
+
+    def __len__(self):
+        return len(self.refs_)
+
+    def size(self, key):
+        return self.refs_[key][1]
+
+    def memory(self):
+        return self.chunks_.memory() + self.refs_.memory() + sys.getsizeof(self.counts_)
+
+    def disk(self):
+        return self.chunks_.disk() + self.refs_.disk()
+
+    def sync(self):
+        self.chunks_.sync()
+        self.refs_.sync()
+
+    def close(self):
+        with self.mutex_:
+            self.chunks_.close()
+            self.refs_.close()
+
+    def stats(self):
+        stats = Store.stats(self)
+        with self.mutex_:
+            stats.update({'chunks': len(self.counts_), 'shared': self.shared_, 'logical': self.logical_,
+                          'stored': self.stored_,
+                          'ratio': round(self.stored_ / self.logical_, 3) if self.logical_ else None})
+        return stats
+
+ENGINES = {'memory': MemoryStore, 'log': LogStore, 'sqlite': SQLiteStore}
+
+def open_store(engine = STORAGE_ENGINE, path = None, codec = 'bytes'):
+    """A store of the given engine, kept at path (a file, with an extension
+    for the engine) unless it lives in memory"""
+    if engine not in ENGINES:
+        raise ValueError("unknown storage engine %s" % engine)
+    if engine == 'memory':
+        return MemoryStore(codec)
+    return ENGINES[engine]("%s.%s" % (path, engine), codec)
+
+def open_chunk_store(engine = STORAGE_ENGINE, path = None, dedup = True):
+    """A ChunkStore whose chunks and refs are kept by the given engine"""
+    return ChunkStore(open_store(engine, "%s-chunks" % path), open_store(engine, "%s-refs" % path, 'json'), dedup)
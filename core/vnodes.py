@@ -0,0 +1,119 @@
+#!/bin/python
+import sys
+import json
+import threading
+
+from address import Address
+from remote import to_remote
+from server import Server
+from chord import Local, Daemon
+from network import user_command, TEXT
+from settings import SIZE, VNODES
+
+# virtual nodes travel in a byte on the wire
+MAX_VNODES = 256
+
+# adding virtual nodes joins them to the ring
+user_command('vnodes', TEXT, TEXT, forwards = True)
+
+# A physical host taking several places on the ring. With a single id per
+# host the share of the ring each one owns varies a lot (the largest gap is
+# about log(n) times the average), k virtual nodes per host bring that down
+# to about 1/sqrt(k). Every virtual node is a full Local with its own id,
+# fingers and maintenance threads, but they all answer on the same socket:
+# the server, the connection pool and the failure detector are shared.
+# Upper layers (say a DFS) are put on every virtual node by attach, they
+# get to hand their keys over (leave) before the node goes away.
+class Host(object):
+    def __init__(self, ip, port, remote_address = None, vnodes = VNODES, attach = None):
+        self.ip_ = ip
+        self.port_ = int(port)
+        # where the first virtual node joins, the others join through it
+        self.remote_address_ = remote_address
+        self.vnodes_ = vnodes
+        self.server_ = Server(Address(ip, port))
+        # virtual node -> Local, and what attach put on it
+        self.nodes_ = {}
+        self.attach_ = attach
+        self.layers_ = {}
+        self.mutex_ = threading.Lock()
+
+    def start(self):
+        self.daemon_ = Daemon(self.server_, 'serve_forever')
+        self.daemon_.start()
+        self.set_vnodes(self.vnodes_)
+
+    def shutdown(self):
+        self.set_vnodes(0)
+
+    def set_vnodes(self, k):
+        """Adds or removes virtual nodes until we have k of them"""
+        with self.mutex_:
+            while len(self.nodes_) < k:
+                self.add()
+            while len(self.nodes_) > k:
+                self.remove(max(self.nodes_))
+            self.vnodes_ = k
+            return k
+
+    def add(self, vnode = None):
+        if vnode is None:
+            vnode = min(set(range(len(self.nodes_) + 1)) - set(self.nodes_))
+        if vnode in self.nodes_ or not 0 <= vnode < MAX_VNODES:
+            raise ValueError("can't add virtual node %s" % vnode)
+        remote_address = self.remote_address_
+        if remote_address is None and self.nodes_:
+            remote_address = next(iter(self.nodes_.values())).address_
+        local = Local(Address(self.ip_, self.port_, vnode), remote_address, self.server_)
+        local.register_command('vnodes', lambda k: str(self.set_vnodes(int(k))))
+        local.register_command('spread', lambda _: json.dumps(self.spread()))
+        if self.attach_ is not None:
+            self.layers_[vnode] = self.attach_(local)
+        self.nodes_[vnode] = local
+        local.start()
+        return local
+
+    def remove(self, vnode):
+        # the keys it owned go to its successor once the ring notices
+        layer = self.layers_.pop(vnode, None)
+        try:
+            if hasattr(layer, 'leave'):
+                layer.leave()
+        finally:
+            self.nodes_.pop(vnode).shutdown()
+
+    def spread(self):
+        """Share of the ring each of our virtual nodes owns"""
+        shares = {}
+        for vnode, local in list(self.nodes_.items()):
+            predecessor = local.predecessor()
+            if predecessor is None:
+                shares[vnode] = None
+            elif predecessor.id() == local.id():
+                shares[vnode] = 1.0
+            else:
+                shares[vnode] = ((local.id() - predecessor.id()) % SIZE) / SIZE
+        return shares
+
+def ring_spread(address, max_nodes = 1 << 16):
+    """Walks the ring from address, share of the ring each host (ip, port)
+    owns through all its virtual nodes"""
+    start = to_remote(address)
+    ids = {start.id(): start}
+    node = start.successor()
+    while node.id() not in ids and len(ids) < max_nodes:
+        ids[node.id()] = node
+        node = node.successor()
+    shares = {}
+    ring = sorted(ids)
+    for i, id in enumerate(ring):
+        host = "%s:%s" % (ids[id].address_.ip, ids[id].address_.port)
+        gap = (id - ring[i - 1]) % SIZE or SIZE
+        shares[host] = shares.get(host, 0) + gap / SIZE
+    return shares
+
+if __name__ == "__main__":
+    # usage: python vnodes.py <port> <k> [<remote port>]
+    remote_address = Address("127.0.0.1", sys.argv[3]) if len(sys.argv) > 3 else None
+    host = Host("127.0.0.1", sys.argv[1], remote_address, int(sys.argv[2]))
+    host.start()
@@ -7,6 +7,7 @@ import random
 import os
 import argparse
 import math
+import sys
 
 # === Experiment Parameters ===
 NUM_NODES = [5, 10, 15, 20, 25]
@@ -15,6 +16,17 @@ STABILIZATION_DELAY = 5
 NETWORK_DELAY_RANGE = (0.005, 0.03)   # artificial delay between messages
 FAILURE_PROBABILITY = 0.15            # default failure probability
 CHURN_LEVELS = [0.0, 0.10, 0.20, 0.30]  # for churn experiment
+LOOKUPS_PER_MODE = 200                  # for lookup mode comparison
+VNODE_COUNTS = [1, 2, 4, 8, 16, 32, 64]  # for virtual node spread
+ZIPF_KEYS = 2000                        # for load balancing
+ZIPF_EXPONENT = 0.99
+ZIPF_READS = 4000
+ZIPF_CLIENTS = 16
+BALANCE_ROUNDS = 5
+STORAGE_BLOCKS = 20000                  # for storage engines
+STORAGE_READS = 20000
+COMPRESSION_FILES = 200                 # for dedup and compression
+COMPRESSION_FILE_BLOCKS = 16
 
 
 # === Utility: Inject or remove artificial delay ===
@@ -170,13 +182,328 @@ def run_churn_sweep(n, delay=False):
     return results
 
 
+# === New: Iterative vs Recursive Lookups ===
+def run_lookup_modes(n):
+    """Compare hop counts and latency of iterative and recursive lookups on a
+    ring running in this process."""
+    sys.path.insert(0, "../core")
+    from create_chord import create_chord_ring, shutdown_chord_ring
+    from settings import SIZE
+
+    print(f"\n=== Comparing lookup modes with {n} nodes ===")
+    peers = create_chord_ring(n, stabilize_time=STABILIZATION_DELAY + 10)
+    keys = [random.randrange(SIZE) for _ in range(LOOKUPS_PER_MODE)]
+    origins = [random.choice(peers) for _ in range(LOOKUPS_PER_MODE)]
+
+    results = []
+    for mode, recursive in (("iterative", False), ("recursive", True)):
+        latencies = []
+        hops = []
+        failures = 0
+        for key, origin in zip(keys, origins):
+            t0 = time.time()
+            try:
+                h = origin.route(key, recursive)[1]
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.time() - t0)
+            hops.append(h)
+
+        result = {
+            "mode": mode,
+            "nodes": n,
+            "avg_hops": round(statistics.mean(hops), 3) if hops else None,
+            "max_hops": max(hops) if hops else None,
+            "avg_latency_sec": round(statistics.mean(latencies), 5) if latencies else None,
+            "p95_latency_sec": round(p95(latencies), 5) if latencies else None,
+            "failures": failures
+        }
+        print(f"{mode}: hops={result['avg_hops']} (max {result['max_hops']}), "
+              f"latency={result['avg_latency_sec']}s, p95={result['p95_latency_sec']}s")
+        results.append(result)
+
+    shutdown_chord_ring(peers)
+    return results
+
+
+# === New: Key-range spread with virtual nodes ===
+def run_vnode_spread(n):
+    """Share of the ring each of n hosts owns with k virtual nodes each,
+    computed from the node ids alone (no ring is started)."""
+    sys.path.insert(0, "../core")
+    from address import Address
+    from settings import SIZE
+
+    print(f"\n=== Key-range spread of {n} hosts ===")
+    results = []
+    for k in VNODE_COUNTS:
+        owner = {}
+        for port in range(40000, 40000 + n):
+            for vnode in range(k):
+                owner[Address("127.0.0.1", port, vnode).id_] = port
+        ring = sorted(owner)
+        shares = dict.fromkeys(range(40000, 40000 + n), 0.0)
+        for i, id in enumerate(ring):
+            shares[owner[id]] += ((id - ring[i - 1]) % SIZE or SIZE) / SIZE
+        values = list(shares.values())
+        result = {
+            "hosts": n,
+            "vnodes": k,
+            "max_over_mean": round(max(values) * n, 3),
+            "min_over_mean": round(min(values) * n, 3),
+            "stdev_over_mean": round(statistics.pstdev(values) * n, 3)
+        }
+        print(f"k={k}: max/mean={result['max_over_mean']}, min/mean={result['min_over_mean']}, "
+              f"stdev/mean={result['stdev_over_mean']}")
+        results.append(result)
+    return results
+
+
+# === New: Adaptive load balancing under a Zipfian workload ===
+def run_load_balance(n):
+    """Per-host request rates and read latency of a DFS under skewed reads,
+    before and after a few rounds of load balancing."""
+    sys.path.insert(0, "../core")
+    from concurrent.futures import ThreadPoolExecutor
+    from address import Address
+    from balance import Host, DFS, Balancer
+    from settings import VNODES
+
+    print(f"\n=== Load balancing with {n} hosts ===")
+    hosts = []
+    for port in range(41000, 41000 + n):
+        remote = Address("127.0.0.1", 41000) if hosts else None
+        host = Host("127.0.0.1", port, remote, max(VNODES, 4), attach=DFS)
+        host.start()
+        hosts.append(host)
+        time.sleep(0.5)
+    time.sleep(STABILIZATION_DELAY + 5)
+
+    client = hosts[0].layers_[0]
+    for key in range(ZIPF_KEYS):
+        client.store(f"key{key}", b"x" * 64, 0)
+    weights = [1.0 / (rank + 1) ** ZIPF_EXPONENT for rank in range(ZIPF_KEYS)]
+
+    def read(key):
+        t0 = time.time()
+        ok = client.fetch(f"key{key}", 64, 0) is not None
+        return time.time() - t0, ok
+
+    def measure(phase):
+        for host in hosts:
+            for dfs in host.layers_.values():
+                dfs.load_ = type(dfs.load_)()
+        keys = random.choices(range(ZIPF_KEYS), weights, k=ZIPF_READS)
+        with ThreadPoolExecutor(ZIPF_CLIENTS) as clients:
+            results = list(clients.map(read, keys))
+        latencies = [latency for latency, ok in results if ok]
+        rates = [sum(dfs.load_.rate() for dfs in host.layers_.values()) for host in hosts]
+        mean = statistics.mean(rates)
+        result = {
+            "phase": phase,
+            "hosts": n,
+            "max_over_mean_rate": round(max(rates) / mean, 3) if mean else None,
+            "stdev_over_mean_rate": round(statistics.pstdev(rates) / mean, 3) if mean else None,
+            "p50_latency_sec": round(statistics.median(latencies), 5) if latencies else None,
+            "p99_latency_sec": round(sorted(latencies)[int(0.99 * (len(latencies) - 1))], 5) if latencies else None,
+            "failures": len(results) - len(latencies)
+        }
+        print(f"{phase}: max/mean rate={result['max_over_mean_rate']}, "
+              f"stdev/mean={result['stdev_over_mean_rate']}, p50={result['p50_latency_sec']}s, "
+              f"p99={result['p99_latency_sec']}s, failures={result['failures']}")
+        return result
+
+    results = [measure("before")]
+    balancers = [Balancer(host) for host in hosts]
+    moves = 0
+    for _ in range(BALANCE_ROUNDS):
+        for balancer in balancers:
+            try:
+                moves += balancer.balance()
+            except Exception:
+                pass
+        time.sleep(STABILIZATION_DELAY)
+        # the load seen by the nodes after the last moves
+        measure("round")
+    result = measure("after")
+    result["moves"] = moves
+    results.append(result)
+
+    for host in hosts:
+        host.shutdown()
+    return results
+
+
+# === New: Storage engines ===
+def run_storage():
+    """Write and read throughput, memory footprint, size on disk and restart
+    time of each storage engine, with DFS sized blocks."""
+    sys.path.insert(0, "../core")
+    import tempfile
+    from storage import ENGINES, open_store
+    from dht import BLOCK_SIZE
+
+    print(f"\n=== Storage engines, {STORAGE_BLOCKS} blocks of {BLOCK_SIZE} bytes ===")
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for engine in ENGINES:
+            path = os.path.join(directory, "blocks")
+            store = open_store(engine, path)
+            block = os.urandom(BLOCK_SIZE)
+            t0 = time.time()
+            for key in range(STORAGE_BLOCKS):
+                store[f"file{key % 100}:{key}"] = block
+            write_time = time.time() - t0
+            keys = random.choices(list(store), k=STORAGE_READS)
+            t0 = time.time()
+            for key in keys:
+                store[key]
+            read_time = time.time() - t0
+            stats = store.stats()
+            store.close()
+            t0 = time.time()
+            store = open_store(engine, path)
+            recovered = len(store)
+            restart_time = time.time() - t0
+            store.close()
+            result = {
+                "engine": engine,
+                "blocks": STORAGE_BLOCKS,
+                "write_mb_s": round(STORAGE_BLOCKS * BLOCK_SIZE / write_time / 1e6, 2),
+                "read_mb_s": round(STORAGE_READS * BLOCK_SIZE / read_time / 1e6, 2),
+                "memory_mb": round(stats["memory"] / 1e6, 2),
+                "disk_mb": round(stats["disk"] / 1e6, 2),
+                "restart_sec": round(restart_time, 4),
+                "recovered": recovered
+            }
+            print(f"{engine}: write={result['write_mb_s']}MB/s, read={result['read_mb_s']}MB/s, "
+                  f"memory={result['memory_mb']}MB, disk={result['disk_mb']}MB, "
+                  f"restart={result['restart_sec']}s ({recovered} blocks)")
+            results.append(result)
+    return results
+
+
+# === New: Dedup and compression ===
+def compression_blocks(block_size):
+    """Blocks of COMPRESSION_FILES files: unique random data, blocks many
+    files share, text and mostly zero blocks (a short write, padded)."""
+    rng = random.Random(0)
+    shared = [rng.randbytes(block_size) for _ in range(COMPRESSION_FILE_BLOCKS)]
+    words = [rng.randbytes(rng.randint(2, 8)).hex().encode() for _ in range(500)]
+    blocks = []
+    for f in range(COMPRESSION_FILES):
+        for b in range(COMPRESSION_FILE_BLOCKS):
+            kind = (f + b) % 4
+            if kind == 0:
+                block = rng.randbytes(block_size)
+            elif kind == 1:
+                block = shared[b]
+            elif kind == 2:
+                block = b" ".join(rng.choice(words) for _ in range(block_size // 8))[:block_size]
+            else:
+                block = rng.randbytes(block_size // 8) + bytes(block_size - block_size // 8)
+            blocks.append((f"file{f}:{b}", block))
+    return blocks
+
+
+def run_compression():
+    """Bytes stored and sent, and throughput, with and without content
+    addressed storage and compression of DFS blocks."""
+    sys.path.insert(0, "../core")
+    import chunks
+    import network
+    from storage import open_store, open_chunk_store
+    from dht import BLOCK_SIZE
+
+    blocks = compression_blocks(BLOCK_SIZE)
+    logical = sum(len(block) for _, block in blocks)
+    print(f"\n=== Dedup and compression, {len(blocks)} blocks of {BLOCK_SIZE} bytes "
+          f"({logical / 1e6:.1f} MB) ===")
+    results = []
+    default = chunks.COMPRESSION
+    for name, dedup, compression in [("plain", None, False), ("compression", False, True),
+                                     ("dedup", True, False), ("dedup+compression", True, True)]:
+        chunks.COMPRESSION = compression
+        store = open_store("memory") if dedup is None else open_chunk_store("memory", None, dedup)
+        t0 = time.time()
+        for key, block in blocks:
+            store[key] = block
+        write_time = time.time() - t0
+        t0 = time.time()
+        for key, _ in blocks:
+            store[key]
+        read_time = time.time() - t0
+        stored = logical if dedup is None else store.stats()["stored"]
+        # what a put_blocks of each block would send
+        sent = sum(len(network.encode(network.BLOCK, ({}, block))) for _, block in blocks)
+        result = {
+            "mode": name,
+            "stored_mb": round(stored / 1e6, 2),
+            "stored_ratio": round(stored / logical, 3),
+            "wire_ratio": round(sent / logical, 3),
+            "write_mb_s": round(logical / write_time / 1e6, 2),
+            "read_mb_s": round(logical / read_time / 1e6, 2)
+        }
+        print(f"{name}: stored={result['stored_mb']}MB (ratio {result['stored_ratio']}), "
+              f"wire ratio {result['wire_ratio']}, write={result['write_mb_s']}MB/s, "
+              f"read={result['read_mb_s']}MB/s")
+        results.append(result)
+    chunks.COMPRESSION = default
+    return results
+
+
 # === Main ===
 def main():
     parser = argparse.ArgumentParser(description="Run Chord DHT experiments with optional network delay.")
     parser.add_argument("--delay", action="store_true", help="Enable artificial network delay.")
     parser.add_argument("--churn", action="store_true", help="Run churn sensitivity sweep instead of full scale test.")
+    parser.add_argument("--lookup-modes", action="store_true", help="Compare iterative and recursive lookups.")
+    parser.add_argument("--vnode-spread", action="store_true", help="Key-range spread for several virtual node counts.")
+    parser.add_argument("--load-balance", action="store_true", help="Zipfian reads before and after load balancing.")
+    parser.add_argument("--storage", action="store_true", help="Throughput and footprint of the storage engines.")
+    parser.add_argument("--compression", action="store_true", help="Bytes stored and sent with dedup and compression.")
     args = parser.parse_args()
 
+    if args.compression:
+        results = run_compression()
+        with open("results_compression.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nResults saved to results_compression.json")
+        return
+
+    if args.storage:
+        results = run_storage()
+        with open("results_storage.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nResults saved to results_storage.json")
+        return
+
+    if args.load_balance:
+        results = run_load_balance(8)
+        with open("results_load_balance.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nResults saved to results_load_balance.json")
+        return
+
+    if args.vnode_spread:
+        results = []
+        for n in NUM_NODES:
+            results += run_vnode_spread(n)
+        with open("results_vnode_spread.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nResults saved to results_vnode_spread.json")
+        return
+
+    if args.lookup_modes:
+        results = []
+        for n in NUM_NODES:
+            results += run_lookup_modes(n)
+        with open("results_lookup_modes.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nResults saved to results_lookup_modes.json")
+        return
+
     if args.churn:
         # Fixed node count for churn test
         n = 20
@@ -0,0 +1,368 @@
+import os
+import sys
+import time
+import socket
+import random
+import asyncio
+import gc
+import hashlib
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+
+from chord import *
+from address import ring_hash
+from remote import ConnectionPool, ChannelPool, Channel, registry
+from async_chord import AsyncLocal
+from vnodes import Host, ring_spread
+from network import *
+from logger import Logger, writer
+from cache import LookupCache
+from liveness import FailureDetector, detector, ALIVE, SUSPECTED, UNKNOWN
+
+
+# nodes of the ring, and seconds we give it to settle
+N_NODES = 6
+SETTLE = 10
+# keys we look up
+N_KEYS = 500
+
+def owner(ids, key):
+	# id of the node key belongs to, ids sorted
+	return min([id for id in ids if id >= key] or [ids[0]])
+
+def check_connection_pool(local):
+	print("Running connection pool test")
+	expected = local.successor().address_.as_tuple()
+	# text connections and binary channels alike
+	for pool in (ConnectionPool(), ChannelPool()):
+		fresh = 0
+		for i in range(100):
+			conn, reused = pool.acquire(local.address_)
+			fresh += not reused
+			assert conn.request('get_successor') == expected
+			pool.release(local.address_, conn)
+		# a single connection took them all
+		assert fresh == 1, fresh
+		pool.clear()
+	print("Finished connection pool test, all good")
+
+def check_server(local):
+	print("Running concurrent server test")
+	local.register_command('sleep', lambda seconds: time.sleep(float(seconds)) or "done")
+	remote = to_remote(local.address_.as_tuple())
+	served = local.server_.stats()['served'].get('sleep', 0)
+	start = time.time()
+	with ThreadPoolExecutor(8) as pool:
+		slow = [pool.submit(remote.command, "sleep 1") for i in range(8)]
+		time.sleep(0.2)
+		# the slow ones don't hold up the rest
+		assert remote.successor() is not None and time.time() - start < 1
+		assert [future.result() for future in slow] == ["done"] * 8
+	# they ran at the same time, not one after the other
+	assert time.time() - start < 3
+	# a request is counted once its reply went out
+	time.sleep(0.1)
+	stats = local.server_.stats()
+	assert stats['served']['sleep'] == served + 8
+	assert stats['max_queued']['sleep'] >= 1 and 'sleep' not in stats['active']
+	local.unregister_command('sleep')
+	print("Finished concurrent server test, all good")
+
+def check_framing(local):
+	print("Running framing test")
+	address = ('127.0.0.1', 4000, 3)
+	values = [(ID, SIZE - 1), (ADDRESS, address), (ADDRESS, ('::1', 4000, 0)), (ADDRESS, ('node.example.org', 1, 0)),
+			  (ADDRESSES, [address, ('10.0.0.1', 4001, 0)]), (JSON, {'a': [1, "b"]}), (TEXT, "some text"),
+			  (LOOKUP, (12345, 3)), (ROUTE, (address, 2, 54321)), (IDS, [0, 1, SIZE - 1]),
+			  (BLOCK, ({'file_name': 'f'}, b"block" * 1000)), (BLOCK, ({}, os.urandom(100)))]
+	for kind, value in values:
+		assert decode(kind, encode(kind, value)) == value, (kind, value)
+
+	expected = local.successor().address_.as_tuple()
+	# a binary client says so first
+	sock = socket.create_connection((local.address_.ip, local.address_.port))
+	reader = BufferedReader(sock)
+	sock.sendall(MAGIC)
+	assert reader.read_exactly(len(MAGIC)) == MAGIC
+	opcode, body = encode_request('get_successor', None)
+	send_frame(sock, 7, opcode, body)
+	request_id, opcode, vnode, body = reader.read_frame()
+	assert request_id == 7 and decode(ADDRESS, body) == expected
+	sock.close()
+	# text clients still work on the same port
+	sock = socket.create_connection((local.address_.ip, local.address_.port))
+	sock.sendall(b"get_successor\r\n")
+	assert decode_text_reply('get_successor', BufferedReader(sock).read_line()) == expected
+	sock.close()
+	print("Finished framing test, all good")
+
+def check_multiplexing(local):
+	print("Running multiplexing test")
+	local.register_command('sleep', lambda seconds: time.sleep(float(seconds)) or "done")
+	sock = socket.create_connection((local.address_.ip, local.address_.port))
+	reader = BufferedReader(sock)
+	sock.sendall(MAGIC)
+	assert reader.read_exactly(len(MAGIC)) == MAGIC
+	for request_id, command, value in ((1, 'sleep', "1"), (2, 'get_successor', None)):
+		opcode, body = encode_request(command, value)
+		send_frame(sock, request_id, opcode, body)
+	# the quick one doesn't wait for the slow one sent before it
+	assert [reader.read_frame()[0] for i in range(2)] == [2, 1]
+	sock.close()
+	# the same with threads sharing a channel
+	channel = Channel(local.address_)
+	with ThreadPoolExecutor(1) as pool:
+		slow = pool.submit(channel.request, 'sleep', "1")
+		time.sleep(0.1)
+		start = time.time()
+		assert channel.request('get_successor') == local.successor().address_.as_tuple()
+		assert time.time() - start < 0.5 and not slow.done()
+		assert slow.result() == "done"
+	channel.close()
+	local.unregister_command('sleep')
+	print("Finished multiplexing test, all good")
+
+def check_liveness(local):
+	print("Running liveness test")
+	fd = FailureDetector(ttl = 0.5, suspect_timeout = 0.3)
+	address = Address('127.0.0.1', 1)
+	assert fd.state(address) == UNKNOWN
+	fd.alive(address)
+	assert fd.state(address) == ALIVE
+	# what we knew gets old
+	time.sleep(0.6)
+	assert fd.state(address) == UNKNOWN
+	fd.failed(address)
+	assert fd.state(address) == SUSPECTED
+	time.sleep(0.4)
+	assert fd.state(address) == UNKNOWN
+	assert fd.stats()['hits'] == 2 and fd.stats()['probes'] == 3
+
+	# every call tells the detector every Remote shares
+	remote = to_remote(local.address_.as_tuple())
+	remote.successor()
+	assert detector.state(remote.address_) == ALIVE and remote.alive()
+	# nobody listens there
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	dead = to_remote(('127.0.0.1', sock.getsockname()[1], 0))
+	sock.close()
+	assert not dead.alive()
+	assert detector.state(dead.address_) == SUSPECTED
+	print("Finished liveness test, all good")
+
+def check_logging():
+	print("Running logging test")
+	path = tempfile.mktemp(suffix = ".log")
+	formatted = []
+	class Argument(object):
+		def __str__(self):
+			formatted.append(self)
+			return "argument"
+	logger = Logger("test", path, 'info')
+	logger.debug("not written %s", Argument())
+	logger.info("written %s", Argument())
+	logger.error("written too")
+	writer.flush()
+	# below the level nothing is even formatted
+	assert len(formatted) == 1
+	with open(path) as f:
+		lines = f.read().splitlines()
+	assert [line.split(" ", 2)[2] for line in lines] == ["INFO test : written argument", "ERROR test : written too"]
+	logger.set_level('off')
+	logger.error("not written")
+	writer.flush()
+	with open(path) as f:
+		assert len(f.read().splitlines()) == 2
+	os.remove(path)
+	print("Finished logging test, all good")
+
+def check_recursive_lookup(peers):
+	print("Running recursive lookup test")
+	ids = sorted(peer.id() for peer in peers)
+	for key in [random.randrange(SIZE) for i in range(N_KEYS)]:
+		peer = random.choice(peers)
+		for recursive in (False, True):
+			node, hops, start = peer.route(key, recursive)
+			assert node.id() == owner(ids, key) and 0 <= hops < len(peers)
+			# nobody sits between start and the owner
+			assert inrange(key, (start + 1) % SIZE, (node.id() + 1) % SIZE)
+		# forwarded by the nodes themselves
+		node, hops, start = to_remote(peer.address_.as_tuple()).find_successor_recursive(key)
+		assert node.id() == owner(ids, key)
+	print("Finished recursive lookup test, all good")
+
+def check_batch_lookup(peers):
+	print("Running batch lookup test")
+	ids = sorted(peer.id() for peer in peers)
+	# some of them twice
+	keys = [random.randrange(SIZE) for i in range(N_KEYS)]
+	keys += keys[:10]
+	for peer in (random.choice(peers), to_remote(random.choice(peers).address_.as_tuple())):
+		found = peer.find_successors_batch(keys)
+		assert sorted(found) == sorted(set(keys))
+		assert all(node.id() == owner(ids, key) for key, node in found.items())
+	assert peers[0].find_successors_batch([]) == {}
+	print("Finished batch lookup test, all good")
+
+def check_lookup_cache(peers):
+	print("Running lookup cache test")
+	nodes = [to_remote(('127.0.0.1', port, 0)) for port in range(1, 5)]
+	node = nodes[0]
+	cache = LookupCache(size = 3, ttl = 0.5)
+	# (start, node] is node's
+	cache.put(node.id(-100), node)
+	assert cache.get(node.id()) is node and cache.get(node.id(-50)) is node
+	assert cache.get(node.id(-100)) is None and cache.get(node.id(1)) is None
+	# the widest range we know about stays
+	cache.put(node.id(-10), node)
+	assert cache.get(node.id(-50)) is node
+	# another node in the range, a redirect, a failure, and time
+	for invalidate in (lambda: cache.invalidate_node(node.id(-50)), lambda: cache.invalidate(node.id(-20)),
+					   lambda: cache.invalidate_owner(node.address_), lambda: time.sleep(0.6)):
+		cache.put(node.id(-100), node)
+		invalidate()
+		assert cache.get(node.id()) is None
+	# the least recently used goes
+	for other in nodes:
+		cache.put(other.id(-1), other)
+	assert cache.get(nodes[0].id()) is None and cache.get(nodes[3].id()) is nodes[3]
+
+	# a node remembers what it looked up, and forgets owners that are gone
+	ids = sorted(peer.id() for peer in peers)
+	peer = peers[0]
+	key = random.choice([id for id in ids if id != peer.id()])
+	assert peer.find_successor(key).id() == key
+	assert peer.lookup_cache_.get(key).id() == key
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	dead = to_remote(('127.0.0.1', sock.getsockname()[1], 0))
+	sock.close()
+	peer.lookup_cache_.put(dead.id(-SIZE // 2), dead)
+	assert peer.find_successor(dead.id()).id() == owner(ids, dead.id())
+	print("Finished lookup cache test, all good")
+
+def check_hashing():
+	print("Running hashing test")
+	address = Address('127.0.0.1', 4000, 2)
+	assert address.id_ == ring_hash("127.0.0.1:4000#2") and 0 <= address.id_ < SIZE
+	if HASH_FUNCTION == 'sha1':
+		assert ring_hash(b"key") == int.from_bytes(hashlib.sha1(b"key").digest(), "big") >> (160 - LOGSIZE)
+	# every process agrees, whatever its str hash seed
+	code = "import sys; sys.path.insert(0, %r); from address import Address; print(Address('127.0.0.1', 4000, 2).id_)" % \
+		   os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core")
+	for seed in ("1", "2"):
+		output = subprocess.check_output([sys.executable, "-c", code], env = dict(os.environ, PYTHONHASHSEED = seed))
+		assert int(output.split()[-1]) == address.id_
+	print("Finished hashing test, all good")
+
+def check_peers(peers):
+	print("Running peer objects test")
+	# one object per peer, whoever tells us about it
+	successor = peers[0].successor()
+	assert to_remote(successor.address_.as_tuple()) is successor
+	assert to_remote(list(successor.address_.as_tuple())) is successor
+	assert successor.id() == successor.address_.id_ == ring_hash("%s:%s" % (successor.address_.ip, successor.address_.port))
+	assert successor.id(SIZE - 1) == successor.id(-1) == (successor.id() - 1) % SIZE
+	# no __dict__ per peer
+	assert not hasattr(successor, '__dict__') and not hasattr(successor.address_, '__dict__')
+	# nobody points to it, it goes
+	to_remote(('127.0.0.1', 9, 0))
+	gc.collect()
+	assert ('127.0.0.1', 9, 0) not in registry
+	print("Finished peer objects test, all good")
+
+def check_vnodes(peers):
+	print("Running virtual nodes test")
+	port = random.choice([port for port in range(50000, 60000) if port not in [peer.address_.port for peer in peers]])
+	host = Host('127.0.0.1', port, peers[0].address_, 4)
+	host.start()
+	time.sleep(SETTLE)
+	# each one its own place on the ring, all of them on the same socket
+	vnodes = [Address('127.0.0.1', port, vnode) for vnode in range(4)]
+	assert sorted(host.nodes_) == list(range(4))
+	assert [host.nodes_[vnode].id() for vnode in range(4)] == [address.id_ for address in vnodes]
+	ids = sorted([peer.id() for peer in peers] + [address.id_ for address in vnodes])
+	for key in [random.randrange(SIZE) for i in range(N_KEYS)]:
+		assert random.choice(peers).find_successor(key).id() == owner(ids, key)
+	for address in vnodes:
+		found = peers[0].find_successor(address.id_)
+		assert found.address_ == address
+	# the shares of the ring add up
+	assert abs(sum(ring_spread(peers[0].address_.as_tuple()).values()) - 1) < 1e-9
+	assert abs(sum(host.spread().values()) - ring_spread(peers[0].address_.as_tuple())["127.0.0.1:%s" % port]) < 1e-9
+	# fewer of them
+	host.set_vnodes(2)
+	assert sorted(host.nodes_) == [0, 1]
+	try:
+		to_remote(vnodes[3].as_tuple()).call('get_successor')
+		assert False, "virtual node 3 still answers"
+	except socket.error:
+		pass
+	host.shutdown()
+	# until the ring notices they are gone
+	time.sleep(SETTLE)
+	print("Finished virtual nodes test, all good")
+
+def check_async(peers):
+	print("Running asyncio node test")
+	async def run():
+		nodes = []
+		for port in random.sample(range(50000, 60000), 2):
+			node = AsyncLocal(Address('127.0.0.1', port), peers[0].address_)
+			await node.start()
+			nodes.append(node)
+		await asyncio.sleep(SETTLE)
+		ids = sorted([peer.id() for peer in peers] + [node.id() for node in nodes])
+		keys = [random.randrange(SIZE) for i in range(N_KEYS)]
+		expected = [owner(ids, key) for key in keys]
+		found = await asyncio.gather(*[random.choice(nodes).find_successor(key) for key in keys])
+		assert [node.id() for node in found] == expected
+		# the threaded nodes know them too
+		found = await asyncio.get_running_loop().run_in_executor(None,
+			lambda: [random.choice(peers).find_successor(key).id() for key in keys])
+		assert found == expected
+		for node in nodes:
+			node.shutdown()
+			await node.wait_closed()
+		# the connections they served see they are closed
+		await asyncio.sleep(0.5)
+	asyncio.run(run())
+	print("Finished asyncio node test, all good")
+
+
+if __name__ == "__main__":
+	# create the ring
+	ports = random.sample(range(40000, 50000), N_NODES)
+	peers = []
+	for port in ports:
+		remote = peers[random.randrange(len(peers))].address_ if peers else None
+		local = Local(Address('127.0.0.1', port), remote)
+		local.start()
+		peers.append(local)
+		time.sleep(0.1)
+
+	# We need to give it some time to stabilize
+	time.sleep(SETTLE)
+
+	check_connection_pool(peers[0])
+	check_server(peers[1])
+	check_framing(peers[2])
+	check_multiplexing(peers[3])
+	check_liveness(peers[4])
+	check_logging()
+	check_recursive_lookup(peers)
+	check_batch_lookup(peers)
+	check_lookup_cache(peers)
+	check_hashing()
+	check_peers(peers)
+	check_vnodes(peers)
+	# last, the ring is left without the nodes it joined
+	check_async(peers)
+
+	# shutdown peers
+	for local in peers:
+		local.shutdown()
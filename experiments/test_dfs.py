@@ -0,0 +1,395 @@
+import os
+import sys
+import time
+import errno
+import random
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+
+import chunks
+from dht import DFS, Local, Address, to_remote, QUORUM, REPLICATION_FACTOR
+from blockcache import BlockCache
+from address import ring_hash, inrange
+from load import LoadTracker
+from vnodes import Host
+from balance import Balancer
+from directory import Directory
+from storage import open_store, open_chunk_store
+
+
+# nodes of the ring, and seconds we give it to settle
+N_NODES = 3
+SETTLE = 6
+# files the join and leave test stores
+N_FILES = 100
+
+def check_dirty_eviction(dfs):
+	print("Running dirty block eviction test")
+	size = dfs.block_size_
+	cache = BlockCache(dfs, size = 2 * size)
+	store, update = dfs.store, dfs.update
+	# the DFS takes nothing for a while
+	dfs.store = lambda *args, **kw: 0
+	dfs.update = lambda *args, **kw: None
+	try:
+		results = [cache.write("evict", b"e" * size, i * size) for i in range(4)]
+		# the first two fit, there is no room for more
+		assert results[:2] == [size, size], results
+		assert results[2:] == [-errno.EIO, -errno.EIO], results
+		# nothing was thrown away
+		assert cache.stats()['dirty'] == 4
+		assert cache.flush("evict") == -errno.EIO
+		assert cache.read("evict", 4 * size, 0) == b"e" * 4 * size
+	finally:
+		dfs.store, dfs.update = store, update
+	assert cache.flush("evict") == 0
+	assert cache.stats()['dirty'] == 0
+	assert dfs.fetch("evict", 4 * size, 0) == b"e" * 4 * size
+	print("Finished dirty block eviction test, all good")
+
+def check_holes(dfss):
+	print("Running holes test")
+	size = dfss[0].block_size_
+	# nobody wrote the first two blocks
+	dfss[0].store("holes", b"h" * 10, 2 * size)
+	assert dfss[0].stat("holes")['size'] == 2 * size + 10
+	for dfs in dfss:
+		assert dfs.fetch("holes", 3 * size, 0) == bytes(2 * size) + b"h" * 10
+	# a short block before the end
+	dfss[1].store("short", b"s" * 10, 0)
+	dfss[1].store("short", b"t" * 10, size + 5)
+	assert dfss[2].fetch("short", 2 * size, 0) == b"s" * 10 + bytes(size - 5) + b"t" * 10
+	# the same through a cache, before and after it writes back
+	cache = BlockCache(dfss[1])
+	assert cache.write("cached", b"a" * 10, 0) == 10
+	assert cache.write("cached", b"b" * 10, 2 * size) == 10
+	expected = b"a" * 10 + bytes(2 * size - 10) + b"b" * 10
+	assert cache.read("cached", 3 * size, 0) == expected
+	assert cache.flush("cached") == 0
+	assert BlockCache(dfss[2]).read("cached", 3 * size, 0) == expected
+	# past the end there is nothing
+	assert dfss[0].fetch("holes", 10, 3 * size) == b""
+	assert dfss[0].fetch("no such file", 10, 0) == b""
+	print("Finished holes test, all good")
+
+def check_truncate(dfss):
+	print("Running truncate test")
+	size = dfss[0].block_size_
+	dfss[0].store("truncate", b"x" * (3 * size), 0)
+	assert dfss[0].truncate("truncate", 10) == 0
+	assert dfss[1].fetch("truncate", 3 * size, 0) == b"x" * 10
+	# what was past the end doesn't come back
+	assert dfss[1].truncate("truncate", 2 * size + 5) == 0
+	assert dfss[2].stat("truncate")['size'] == 2 * size + 5
+	assert dfss[2].fetch("truncate", 3 * size, 0) == b"x" * 10 + bytes(2 * size - 5)
+	assert BlockCache(dfss[0]).read("truncate", 3 * size, 0) == b"x" * 10 + bytes(2 * size - 5)
+	assert dfss[0].truncate("no such file", 10) == -errno.ENOENT
+
+	# growing a file takes no space, shrinking it frees what is past the end
+	def blocks(path):
+		return sum(1 for dfs in dfss for block_id in list(dfs.data_) if block_id.startswith(path + ":"))
+	assert dfss[0].truncate("truncate", 200 * size) == 0
+	assert blocks("truncate") == len(dfss)
+	dfss[1].store("truncate", b"y" * (20 * size), 0)
+	assert blocks("truncate") == 20 * len(dfss)
+	assert dfss[2].truncate("truncate", 5 * size) == 0
+	assert blocks("truncate") == 5 * len(dfss)
+	assert dfss[0].fetch("truncate", 6 * size, 4 * size) == b"y" * size
+	assert dfss[0].truncate("truncate", 0) == 0
+	assert blocks("truncate") == 0
+	assert dfss[1].fetch("truncate", size, 0) == b""
+	print("Finished truncate test, all good")
+
+def check_block_size(dfss):
+	print("Running block size test")
+	size = dfss[0].block_size_
+	dfss[0].store("sized", b"z" * 10, 0)
+	attr = dfss[1].stat("sized")
+	assert attr['block_size'] == size and attr['blocks'] == 1
+	# a client splitting files otherwise is turned away
+	owner = to_remote(dfss[0].get_remote("sized", 0).address_.as_tuple())
+	for command, request in (("read", {'offset': 0, 'size': 10}), ("write", {'offset': 0}), ("attr", {}),
+							 ("cas", {'offset': 0, 'version': None}), ("delete", {'offset': 0})):
+		request = dict(request, file_name = "sized", block_size = size // 2)
+		reply, _ = owner.call(command, (request, b"x"))
+		assert reply == {'status': 'failed', 'code': -errno.EINVAL}, (command, reply)
+	assert dfss[2].fetch("sized", size, 0) == b"z" * 10
+	print("Finished block size test, all good")
+
+def owner_of(dfss, path, offset):
+	port = dfss[0].get_remote(path, offset).address_.port
+	return [dfs for dfs in dfss if dfs.local_.address_.port == port][0]
+
+def check_replication(dfss):
+	print("Running replication test")
+	block_id = dfss[0].get_id("replicated", 0)
+	owner = owner_of(dfss, "replicated", 0)
+	others = [dfs for dfs in dfss if dfs is not owner]
+	assert sorted(node.address_.port for node in owner.replicas()) == \
+		   sorted(dfs.local_.address_.port for dfs in others)[:REPLICATION_FACTOR - 1]
+	# every write is on the owner and its replicas once it returns, the
+	# same block under the same version
+	for i in range(3):
+		assert dfss[i].store("replicated", b"r%d" % i, 0) == 2
+		copies = [(dfs.data_[block_id], dfs.versions_[block_id]) for dfs in dfss]
+		assert copies == [(b"r%d" % i, [i + 1, owner.local_.id()])] * len(dfss), copies
+	print("Finished replication test, all good")
+
+def check_quorum(dfss):
+	print("Running quorum test")
+	block_id = dfss[0].get_id("quorum", 0)
+	owner = owner_of(dfss, "quorum", 0)
+	replica = [dfs for dfs in dfss if dfs is not owner][0]
+	assert dfss[1].store("quorum", b"new", 0, QUORUM) == 3
+
+	def go_back(dfs):
+		with dfs.mutex_:
+			dfs.data_[block_id] = b"old"
+			dfs.versions_[block_id] = [0, 1]
+
+	# the owner lost the write, a majority of the copies still has it
+	go_back(owner)
+	assert dfss[2].fetch("quorum", 3, 0, QUORUM) == b"new"
+	assert owner.data_[block_id] == b"new"
+	# a replica lost it, the owner reads it and gives it back the newest
+	repairs = owner.repairs_
+	go_back(replica)
+	assert dfss[0].fetch("quorum", 3, 0, QUORUM) == b"new"
+	for _ in range(20):
+		if replica.data_[block_id] == b"new":
+			break
+		time.sleep(0.1)
+	assert replica.data_[block_id] == b"new" and replica.versions_[block_id] == owner.versions_[block_id]
+	assert owner.repairs_ > repairs
+	print("Finished quorum test, all good")
+
+def check_handoff(dfss):
+	print("Running join and leave test")
+	for i in range(N_FILES):
+		assert dfss[i % len(dfss)].store("handoff%d" % i, b"h%d" % i, 0) > 0
+	# a new node takes what it owns from its successor
+	port = random.choice([port for port in range(40000, 50000)
+						  if port not in [dfs.local_.address_.port for dfs in dfss]])
+	local = Local(Address('127.0.0.1', port), dfss[0].local_.address_)
+	new = DFS(local)
+	local.start()
+	assert new.joined_.wait(SETTLE)
+	time.sleep(SETTLE)
+	owned = [i for i in range(N_FILES) if new.is_ours(ring_hash(new.get_id("handoff%d" % i, 0)))]
+	assert owned
+	for i in owned:
+		assert new.data_[new.get_id("handoff%d" % i, 0)] == b"h%d" % i
+	for i in range(N_FILES):
+		assert new.fetch("handoff%d" % i, 10, 0) == b"h%d" % i
+	# what it wrote while in the ring stays once it leaves
+	for i in owned:
+		assert dfss[0].store("handoff%d" % i, b"n%d" % i, 0) > 0
+	new.shutdown()
+	time.sleep(SETTLE)
+	# the node before it kept its copy from before the join, a read at ONE
+	# may still see that one
+	for i in range(N_FILES):
+		expected = b"n%d" % i if i in owned else b"h%d" % i
+		assert dfss[i % len(dfss)].fetch("handoff%d" % i, 10, 0, QUORUM) == expected
+	print("Finished join and leave test, all good")
+
+def check_directory(dfss):
+	print("Running directory test")
+	directories = [Directory(dfs, "/dir", buckets = 16) for dfs in dfss]
+	names = ["f%d" % i for i in range(200)]
+	# every name twice, from different nodes
+	with ThreadPoolExecutor(8) as pool:
+		results = list(pool.map(lambda i: directories[i % len(dfss)].insert(names[i % len(names)]),
+								range(2 * len(names))))
+	assert results.count(0) == len(names)
+	assert results.count(-errno.EEXIST) == len(names)
+	listed, cursor = [], None
+	while True:
+		page, cursor = directories[0].page(cursor, 7)
+		assert len(page) <= 7
+		listed += page
+		if cursor is None:
+			break
+	assert sorted(listed) == sorted(names)
+	assert directories[1].remove("f1") == 0
+	assert directories[2].remove("f1") == -errno.ENOENT
+	assert "f1" not in directories[0] and "f2" in directories[0]
+	assert len(list(directories[2])) == len(names) - 1
+	print("Finished directory test, all good")
+
+def check_cas(dfss):
+	print("Running compare and swap test")
+	assert dfss[0].fetch_block("cas", 0) == (None, b"")
+	done, version, block = dfss[0].cas("cas", 0, None, b"first")
+	assert done and block is None
+	# somebody else's write went first
+	done, current, block = dfss[1].cas("cas", 0, None, b"second")
+	assert not done and current == version and block == b"first"
+	assert dfss[2].fetch_block("cas", 0) == (version, b"first")
+
+	# many writers at once, none of their increments is lost
+	def increment(i):
+		return dfss[i % len(dfss)].update("counter", 0, lambda block: b"%d" % (int(block or b"0") + 1), retries = 50)
+	with ThreadPoolExecutor(8) as pool:
+		results = list(pool.map(increment, range(100)))
+	assert None not in results
+	assert dfss[0].fetch_block("counter", 0)[1] == b"100"
+	assert dfss[1].stat("counter")['size'] == 3
+
+	# attributes change only if they are still the ones we read
+	attr = dfss[0].stat("counter")
+	assert dfss[1].stat("counter", expect = [0, 0], size = 1) is None
+	assert dfss[1].stat("counter", expect = attr['version'], size = 1)['size'] == 1
+	print("Finished compare and swap test, all good")
+
+def check_balancer():
+	print("Running load balancer test")
+	# requests that don't cool down while we look
+	tracker = LoadTracker(half_life = 1e6)
+	for id in (10, 20, 30, 40):
+		tracker.hit(id, 100)
+	rate = tracker.rate(0, 15)
+	assert abs(tracker.rate(0, 50) - 4 * rate) < 1e-3 * rate
+	# (30, 50] takes less than 1.5 times the rate of a key, (20, 50] more
+	assert tracker.split(0, 50, 1.5 * rate) == 30
+	tracker.forget(0, 25)
+	assert tracker.rate(0, 25) == 0 and tracker.rate(0, 50) > 0
+
+	# a hot node moves part of its range to the one after it
+	ports = random.sample(range(50000, 60000), 2)
+	hosts = []
+	for port in ports:
+		remote = Address('127.0.0.1', ports[0]) if hosts else None
+		hosts.append(Host('127.0.0.1', port, remote, 1, attach = DFS))
+		hosts[-1].start()
+		time.sleep(0.2)
+	time.sleep(SETTLE)
+	hot, client = hosts[0].layers_[0], hosts[1].layers_[0]
+	for i in range(50):
+		assert client.store("balance%d" % i, b"b%d" % i, 0) > 0
+	predecessor, local = hot.local_.predecessor().id(), hot.local_.id()
+	for block_id in list(hot.data_):
+		if inrange(ring_hash(block_id), (predecessor + 1) % 2 ** 32, (local + 1) % 2 ** 32):
+			hot.load_.hit(ring_hash(block_id), 100)
+	balancer = Balancer(hosts[0])
+	index = balancer.plan(hot)
+	assert index is not None
+	assert inrange(Address('127.0.0.1', ports[0], index).id_, (predecessor + 1) % 2 ** 32, local)
+	balancer.move(0, index)
+	assert sorted(hosts[0].nodes_) == [index] and balancer.moves_ == 1
+	time.sleep(SETTLE)
+	for i in range(50):
+		assert client.fetch("balance%d" % i, 10, 0) == b"b%d" % i
+	for host in hosts:
+		for local in host.nodes_.values():
+			local.shutdown()
+	print("Finished load balancer test, all good")
+
+def check_chunks():
+	print("Running chunks test")
+	compression = chunks.COMPRESSION
+	chunks.COMPRESSION = True
+	try:
+		text = b"the quick brown fox jumps over the lazy dog " * 2000
+		noise = os.urandom(1 << 16)
+		for data in (text, noise, bytes(1 << 18), b"tiny"):
+			assert chunks.unpack(chunks.pack(data)) == data
+			tag, payload = chunks.compress(data, fast = True)
+			assert chunks.decompress(tag, payload) == data
+		assert chunks.compress(text)[0] != chunks.RAW
+		assert chunks.compress(noise)[0] == chunks.RAW
+	finally:
+		chunks.COMPRESSION = compression
+
+	# identical blocks are kept once, and still so after a restart
+	directory = tempfile.mkdtemp()
+	try:
+		for engine in ('log', 'sqlite'):
+			path = os.path.join(directory, engine)
+			store = open_chunk_store(engine, path)
+			block = os.urandom(1 << 12)
+			for i in range(10):
+				store["block%d" % i] = block
+			store["other"] = b"o" * 100
+			assert store.stats()['chunks'] == 2
+			store.close()
+			store = open_chunk_store(engine, path)
+			del store["block0"]
+			assert store["block9"] == block and store.stats()['chunks'] == 2
+			for i in range(1, 10):
+				del store["block%d" % i]
+			assert store.stats()['chunks'] == 1
+			store.close()
+			# a chunk nobody points to (a crash before the key did) goes
+			chunk_store = open_store(engine, "%s-chunks" % path)
+			chunk_store["orphan"] = chunks.pack(b"nobody")
+			chunk_store.close()
+			store = open_chunk_store(engine, path)
+			assert store.stats()['chunks'] == 1 and store["other"] == b"o" * 100
+			store.close()
+	finally:
+		shutil.rmtree(directory)
+	print("Finished chunks test, all good")
+
+def check_storage_recovery():
+	print("Running storage recovery test")
+	directory = tempfile.mkdtemp()
+	try:
+		for engine in ('log', 'sqlite'):
+			path = os.path.join(directory, engine)
+			store = open_store(engine, path)
+			for i in range(100):
+				store["key%d" % i] = b"value%d" % i
+			store["key1"] = b"changed"
+			del store["key2"]
+			store.close()
+			if engine == 'log':
+				# a crash while appending leaves half a record behind
+				with open("%s.log" % path, "ab") as log:
+					log.write(b"\x00\x01\x02")
+			store = open_store(engine, path)
+			assert len(store) == 99
+			assert store["key1"] == b"changed" and "key2" not in store
+			assert all(store["key%d" % i] == b"value%d" % i for i in range(3, 100))
+			store["key2"] = b"back"
+			store.close()
+			assert open_store(engine, path)["key2"] == b"back"
+	finally:
+		shutil.rmtree(directory)
+	print("Finished storage recovery test, all good")
+
+
+if __name__ == "__main__":
+	check_chunks()
+	check_storage_recovery()
+
+	# create the ring
+	ports = random.sample(range(40000, 50000), N_NODES)
+	dfss = []
+	for port in ports:
+		remote = dfss[0].local_.address_ if dfss else None
+		local = Local(Address('127.0.0.1', port), remote)
+		dfss.append(DFS(local))
+		local.start()
+		time.sleep(0.2)
+
+	# We need to give it some time to stabilize
+	time.sleep(SETTLE)
+
+	check_dirty_eviction(dfss[0])
+	check_holes(dfss)
+	check_truncate(dfss)
+	check_block_size(dfss)
+	check_replication(dfss)
+	check_quorum(dfss)
+	check_handoff(dfss)
+	check_directory(dfss)
+	check_cas(dfss)
+	check_balancer()
+
+	# shutdown peers
+	for dfs in dfss:
+		dfs.local_.shutdown()